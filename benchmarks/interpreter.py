@@ -0,0 +1,57 @@
+#!python3
+# Interpreter benchmark
+# Times a few small programs that spend their time in tight loops and recursive words.
+# Run from the project root with `python benchmarks/interpreter.py`, add -u to run unboxed
+# and -n to compile hot words to Python
+import sys, os, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nustack.interpreter import Interpreter
+from nustack.utils import StdoutCapture
+
+PROGRAMS = {
+"fizzbuzz": """
+`Seq imp* 1 3001 range{`n def[[{n 3 % 0 = n 5 % 0 = and}{"FizzBuzz"}][{n 3 % 0 =}{"Fizz"}][{n 5 % 0 =}{"Buzz"}][{#t}{n}]]cond show}for.each
+""",
+"factorial": """
+{dup 1 eq {} {dup 1 - fact *} if} `fact def
+{ 50 fact drop } 1000 repeat.n
+""",
+"while": """
+0 `i def
+{ i 100000 < } { i 1 + `i def } while
+""",
+"qualified": """
+`std::Seq import [ 1 2 3 ] `l def
+{ l 1 Seq::nth l Seq::len + drop } 20000 repeat.n
+""",
+"recursion": """
+{ dup 0 eq { } { 1 - count.down } if } `count.down def
+{ 300 count.down drop } 300 repeat.n
+""",
+"kernel": """
+{ `n def 0 `acc def 0 `i def { i n < } { acc i i * + `acc def i 1 + `i def } while acc } `sumsq def
+{ 300 sumsq drop } 300 repeat.n
+""",
+"locals": """
+{`b def `a def a b + a b * swap drop} `f def
+{ 3 4 f drop } 30000 repeat.n
+""",
+}
+
+def bench(name, code, repeat=5, **options):
+    best = None
+    for _ in range(repeat):
+        interp = Interpreter(**options)
+        start = time.perf_counter()
+        with StdoutCapture():
+            interp.run(code)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    options = {"unboxed": "-u" in args, "native": "-n" in args}
+    names = [arg for arg in args if arg not in ("-u", "-n")] or sorted(PROGRAMS)
+    for name in names:
+        print("%-12s %8.3f s" % (name, bench(name, PROGRAMS[name], **options)))
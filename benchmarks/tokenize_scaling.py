@@ -0,0 +1,29 @@
+#!python3
+# Tokenizer scaling benchmark
+# Tokenizes generated programs from 10 KB to 10 MB and prints the time per KB,
+# which should stay roughly flat if tokenizing is linear in the size of the source.
+# Run from the project root with `python benchmarks/tokenize_scaling.py`
+import sys, os, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nustack import tokenize
+
+SNIPPET = """/* Factorial */
+{dup 1 eq {} {dup 1 - fact *} if} `fact def
+[1 2.5 #t "spam\\n" b'eggs' `sym] show /* comment */
+"""
+
+def program(size):
+    return SNIPPET * (size // len(SNIPPET) + 1)
+
+def bench(size):
+    code = program(size)
+    start = time.perf_counter()
+    toks = tokenize.tokenize(code)
+    elapsed = time.perf_counter() - start
+    return len(code), len(toks), elapsed
+
+if __name__ == '__main__':
+    print("%12s %10s %10s %12s" % ("bytes", "tokens", "seconds", "us per KB"))
+    for size in (10**4, 10**5, 10**6, 10**7):
+        nbytes, ntoks, elapsed = bench(size)
+        print("%12d %10d %10.3f %12.1f" % (nbytes, ntoks, elapsed, elapsed * 1e6 / (nbytes / 1024)))
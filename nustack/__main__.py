@@ -2,8 +2,8 @@
 # Nustack main entry point
 
 import nustack
-from nustack import utils
-import sys, imp, os, argparse
+from nustack import utils, cache
+import sys, importlib, os, argparse
 
 desc = "Nustack is a stack-oriented concatenative programming language with support\
  for high-level modular programming and Python integration."
@@ -13,20 +13,44 @@ parser = argparse.ArgumentParser(prog="nustack",
                                  epilog=epilog,
                                 )
 parser.add_argument("-d", "--debug", action="store_true", help="Turn on debug messages (default: False)")
-parser.add_argument("sourcefile", nargs="?", help="Source file to run, or run the interactive prompt if ommited")
+parser.add_argument("-O", "--optimize", action="store_true", help="Optimize the program before running it (default: False)")
+parser.add_argument("-u", "--unboxed", action="store_true", help="Keep numbers, strings and bools on the stack without Token wrappers (default: False)")
+parser.add_argument("--native", action="store_true", help="Compile words that are called often to Python functions (default: False)")
+parser.add_argument("--budget", type=int, metavar="N", help="Stop the program once it has run N instructions (default: no limit)")
+parser.add_argument("-j", "--jobs", type=int, metavar="N", help="Run every source file given, each as a job of its own, on N worker processes")
+parser.add_argument("--manifest", metavar="FILE", help="With --jobs, also run the jobs listed in FILE, one source file and its arguments per line")
+parser.add_argument("--no-cache", action="store_true", help="Do not read or write parse cache files in __nucache__ directories")
+parser.add_argument("sourcefile", nargs="?", help="Source file to run, - to read the program from stdin, or run the interactive prompt if ommited")
 parser.add_argument("rest", nargs=argparse.REMAINDER, help="Arguments that will be passed to the nustack program.")
-args = parser.parse_args()
-utils.config_logging(on=args.debug)
+
+def batch(args):
+    "Runs the source files and manifest given with --jobs, and returns the exit status"
+    from nustack import batch
+    jobs = [(fname, []) for fname in ([args.sourcefile] + args.rest if args.sourcefile else [])]
+    if args.manifest:
+        with open(args.manifest) as f:
+            jobs.extend(batch.readmanifest(f))
+    results = batch.run(jobs, args.jobs, optimize=args.optimize, unboxed=args.unboxed, native=args.native,
+                        budget=args.budget)
+    return 1 if batch.report(results) else 0
 
 def main():
-    if args.sourcefile:
+    args = parser.parse_args()
+    utils.config_logging(on=args.debug)
+    cache.enabled = not args.no_cache
+    if args.jobs:
+        sys.exit(batch(args))
+    elif args.sourcefile:
         # Run code from a file
         fname = args.sourcefile
-        with open(fname) as f:
-            code = f.read()
-        interp = nustack.interpreter.Interpreter(args.rest)
+        interp = nustack.interpreter.Interpreter(args.rest, optimize=args.optimize, unboxed=args.unboxed, native=args.native,
+                                                budget=args.budget)
         try:
-            interp.run(code, file=fname)
+            if fname == "-":
+                interp.run(sys.stdin)
+            else:
+                # Tokens come from the parse cache, or the file is read in chunks as the program runs
+                interp.run(cache.iter_tokens(fname), file=fname)
         except KeyboardInterrupt:
             pass
         except Exception as e:
@@ -44,14 +68,14 @@ def main():
         print("Running on Python %s" % sys.version)
         print("Enter your EOF character to exit.")
         print("Press Ctrl-C to stop any running code and go back to the prompt.")
-        interp = nustack.interpreter.Interpreter()
+        interp = nustack.interpreter.Interpreter(unboxed=args.unboxed, native=args.native)
         while True:
             try:
                 code = input(">>> ")
                 if code == "reload":
-                    imp.reload(nustack.interpreter)
-                    imp.reload(nustack.stdlib.builtins)
-                    interp = nustack.interpreter.Interpreter()
+                    importlib.reload(nustack.interpreter)
+                    importlib.reload(nustack.stdlib.builtins)
+                    interp = nustack.interpreter.Interpreter(unboxed=args.unboxed, native=args.native)
                 else:
                     try:
                         interp.eval(code)
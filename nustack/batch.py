@@ -0,0 +1,64 @@
+#!python3
+# Nustack batch runner
+# Runs many programs on a pool of worker processes that live for the whole batch (see nustack --jobs),
+# so each program doesn't pay for starting Python and importing Nustack.
+import io, sys, time, shlex, contextlib, collections
+from nustack import interpreter, cache
+
+# What happened to one program. status is 0 if it ran to the end and 1 if it raised an error
+Result = collections.namedtuple("Result", "path argv status output error seconds")
+
+def readmanifest(file):
+    """Returns the jobs listed in a manifest file, one per line, as (path, argv).
+    Each line is a source file followed by the arguments for the program, quoted like a shell command.
+    Blank lines and lines starting with # are skipped."""
+    jobs = []
+    for line in file:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            path, *argv = shlex.split(line)
+            jobs.append((path, argv))
+    return jobs
+
+def runjob(job):
+    "Runs one program in an Interpreter of its own, capturing what it prints"
+    path, argv, options = job
+    out = io.StringIO()
+    status, error = 0, None
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        try:
+            # The program gets the same argv as when it is run on its own with nustack path argv...
+            interp = interpreter.Interpreter(argv, **options)
+            interp.run(cache.iter_tokens(path), file=path)
+        except Exception as e:
+            status, error = 1, "%s - %s" % (e.__class__.__name__, str(e))
+    return Result(path, argv, status, out.getvalue(), error, time.perf_counter() - start)
+
+def run(jobs, workers=None, **options):
+    """Runs each (path, argv) in jobs on a pool of workers processes, and yields their Results in the same order.
+    options are passed to each Interpreter."""
+    import concurrent.futures
+    # Unlike the workers of a multiprocessing.Pool, these aren't daemons, so a job can start workers of
+    # its own (eg. with map.parallel)
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        yield from pool.map(runjob, [(path, argv, options) for (path, argv) in jobs])
+
+def report(results, file=sys.stdout):
+    """Writes the output of each job as it finishes, and then a summary of how each one went.
+    Returns the number of jobs that failed."""
+    summary = []
+    for res in results:
+        print("==> %s <==" % " ".join(shlex.quote(arg) for arg in [res.path] + res.argv), file=file)
+        file.write(res.output)
+        if res.error:
+            print("--ERROR--", file=file)
+            print(res.error, file=file)
+        summary.append(res)
+    print("==> summary <==", file=file)
+    for res in summary:
+        print("%s %8.3f s  %s" % ("ok  " if res.status == 0 else "FAIL", res.seconds, res.path), file=file)
+    failed = sum(1 for res in summary if res.status)
+    print("%d jobs, %d failed, %.3f s in total" % (len(summary), failed, sum(res.seconds for res in summary)),
+          file=file)
+    return failed
@@ -0,0 +1,207 @@
+#!python3
+# Nustack parse cache
+# Parsed token trees are pickled into a __nucache__ directory next to the source file,
+# much like Python's .pyc files. An entry is only used if the path, mtime, and size of
+# the source and the tokenizer version all match.
+# A cache file is a pickled header followed by the tokens pickled in chunks, and then None,
+# so it can be written and read a chunk at a time.
+import os, pickle, tempfile
+from nustack import tokenize
+from nustack.utils import log
+
+CACHEDIR = "__nucache__"
+
+# Set to False to neither read nor write cache files
+enabled = True
+
+# How many tokens are pickled together
+CHUNKSIZE = 1000
+
+def cachepath(path):
+    "Returns the path of the cache file for the source file at path"
+    dirname, basename = os.path.split(os.path.abspath(path))
+    return os.path.join(dirname, CACHEDIR, "%s.tok%d.pickle" % (basename, tokenize.VERSION))
+
+def _key(path):
+    st = os.stat(path)
+    return {
+        "path": os.path.abspath(path),
+        "mtime": st.st_mtime_ns,
+        "size": st.st_size,
+        "version": tokenize.VERSION,
+    }
+
+def _open(path, key):
+    "Returns the cache file for path, open just after its header, or None if there is no valid cache entry"
+    try:
+        f = open(cachepath(path), "rb")
+    except OSError:
+        return None
+    try:
+        header = pickle.load(f)
+    except Exception:
+        f.close()
+        return None
+    if header != key:
+        log("cache: Stale cache entry for", path)
+        f.close()
+        return None
+    return f
+
+def _chunks(f):
+    "Yields the lists of tokens in the cache file f. Raises EOFError if the file ends before it should."
+    while True:
+        chunk = pickle.load(f)
+        if chunk is None:
+            return
+        yield chunk
+
+class _Writer:
+    """Writes the cache file for path a chunk of tokens at a time. It is written to a temporary file
+    in the cache directory, which only replaces the cache file once commit is called.
+    Failures (eg. a read only directory) are logged and the cache is just not written."""
+    def __init__(self, path, key):
+        self.path = path
+        self.cpath = cachepath(path)
+        self.chunk = []
+        self.f = self.tmp = None
+        try:
+            os.makedirs(os.path.dirname(self.cpath), exist_ok=True)
+            # A name of its own, so other processes and threads writing the same entry don't clash
+            fd, self.tmp = tempfile.mkstemp(prefix=os.path.basename(self.cpath) + ".", suffix=".tmp",
+                                            dir=os.path.dirname(self.cpath))
+            self.f = os.fdopen(fd, "wb")
+            pickle.dump(key, self.f, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            self._fail(e)
+
+    def add(self, tok):
+        if self.f is None:
+            return
+        self.chunk.append(tok)
+        if len(self.chunk) >= CHUNKSIZE:
+            self._flush()
+
+    def _flush(self):
+        try:
+            pickle.dump(self.chunk, self.f, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            self._fail(e)
+        self.chunk = []
+
+    def commit(self):
+        "Finishes the cache file and puts it in place"
+        if self.f is None:
+            return
+        if self.chunk:
+            self._flush()
+        try:
+            pickle.dump(None, self.f, pickle.HIGHEST_PROTOCOL)
+            self.f.close()
+            os.replace(self.tmp, self.cpath)
+            self.f = None
+            log("cache: Wrote cached tokens for", self.path)
+        except Exception as e:
+            self._fail(e)
+
+    def abort(self):
+        "Throws away what has been written"
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            self._remove()
+
+    def _fail(self, e):
+        log("cache: Could not write cache for", self.path, e)
+        if self.f is not None:
+            try:
+                self.f.close()
+            except OSError:
+                pass
+            self.f = None
+        self._remove()
+
+    def _remove(self):
+        if self.tmp is not None:
+            try:
+                os.remove(self.tmp)
+            except OSError:
+                pass
+
+def read(path, key=None):
+    "Returns the cached tokens for path, or None if there is no valid cache entry"
+    if key is None:
+        key = _key(path)
+    f = _open(path, key)
+    if f is None:
+        return None
+    try:
+        with f:
+            toks = [tok for chunk in _chunks(f) for tok in chunk]
+    except Exception:
+        return None
+    log("cache: Loaded cached tokens for", path)
+    return toks
+
+def write(path, toks, key=None):
+    "Writes toks to the cache for path. Failures (eg. a read only directory) are ignored."
+    if key is None:
+        key = _key(path)
+    writer = _Writer(path, key)
+    for tok in toks:
+        writer.add(tok)
+    writer.commit()
+
+def load_tokens(path):
+    "Returns the tokens for the source file at path, using and updating the cache"
+    if not enabled:
+        with open(path) as f:
+            return tokenize.tokenize(f.read())
+    key = _key(path)
+    toks = read(path, key)
+    if toks is None:
+        with open(path) as f:
+            toks = tokenize.tokenize(f.read())
+        write(path, toks, key)
+    return toks
+
+def iter_tokens(path):
+    """Yields the tokens for the source file at path, holding only a chunk of them at a time.
+    On a cache hit they are read from the cache file a chunk at a time. On a miss the file is streamed
+    with tokenize.iter_tokens, and each token is written to the cache as it is yielded."""
+    if not enabled:
+        with open(path) as f:
+            yield from tokenize.iter_tokens(f)
+        return
+    key = _key(path)
+    cached = _open(path, key)
+    if cached is not None:
+        log("cache: Loading cached tokens for", path)
+        with cached:
+            for chunk in _chunks(cached):
+                yield from chunk
+        return
+    writer = _Writer(path, key)
+    with open(path) as f:
+        toks = tokenize.iter_tokens(f)
+        # Whether the consumer has the token, so an error now is its own rather than the tokenizer's
+        yielded = finished = False
+        try:
+            for tok in toks:
+                writer.add(tok)
+                yielded = True
+                yield tok
+                yielded = False
+            finished = True
+        finally:
+            if finished or yielded:
+                # The program stopped before the end of the file (eg. with an error), so the rest
+                # of it is tokenized just for the cache
+                try:
+                    for tok in toks:
+                        writer.add(tok)
+                except Exception:
+                    writer.abort()
+                writer.commit()
+            else:
+                writer.abort()
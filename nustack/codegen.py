@@ -0,0 +1,451 @@
+#!python3
+# Nustack code generator
+# Compiles the bodies of words that are called often into Python functions (nustack --native).
+# The compiler runs the word on a simulated stack at compile time, so the values on the stack
+# and the word's locals become Python variables, and only the items the word takes from and
+# leaves on the real stack are popped and pushed.
+# Only words made of literals, the builtins in WORDS, their own locals, and if and while with
+# literal code blocks can be compiled. The interpreter runs everything else as before.
+import math
+from nustack import ffi
+from nustack.tokenize import Token, literal
+from nustack.utils import log
+
+# How many times a word is called before it is compiled
+HOT = 50
+
+class Unsupported(Exception):
+    "Raised when a word can't be compiled"
+
+class Value:
+    """A value on the simulated stack, or in a local.
+    kind is "num" for an int or float and "bool" for a bool, which are held unboxed in the
+    Python variable expr, or "any" for anything else, which is held as it was on the stack.
+    tok is the Token of a literal, and input is k if the value is the kth item the word took
+    from the real stack, counting from the top. tag is the Python expression for the type of
+    Token a number is pushed as in a boxed interpreter, which the builtins work out from the
+    types of their arguments rather than of the result."""
+    __slots__ = ("kind", "expr", "tok", "input", "tag")
+
+    def __init__(self, kind, expr, tok=None, input=None, tag=None):
+        self.kind = kind
+        self.expr = expr
+        self.tok = tok
+        self.input = input
+        self.tag = tag
+
+class State:
+    """The simulated stack and locals at one point in a word.
+    consumed is how many items the word has taken from the real stack so far."""
+    __slots__ = ("stack", "consumed", "locals")
+
+    def __init__(self, stack, consumed, locals_):
+        self.stack = stack
+        self.consumed = consumed
+        self.locals = locals_
+
+    def copy(self):
+        return State(list(self.stack), self.consumed, dict(self.locals))
+
+# Arithmetic and comparison builtins, and the Python operator each is compiled to
+BINARY = {
+    "+": ("+", "num"), "add": ("+", "num"),
+    "-": ("-", "num"), "sub": ("-", "num"),
+    "*": ("*", "num"), "mul": ("*", "num"),
+    "/": ("/", "num"), "div": ("/", "num"),
+    "%": ("%", "num"), "mod": ("%", "num"),
+    "lt": ("<", "bool"), "<": ("<", "bool"),
+    "gt": (">", "bool"), ">": (">", "bool"),
+}
+# The arithmetic builtins whose result is always a lit_float, as in builtins.div.
+# The others give a number of the type of their first argument
+FLOAT_RESULTS = frozenset(["/", "div", "%", "mod"])
+EQUALS = ("eq", "=")
+DEFINERS = ("def", "define")
+# Every builtin a compiled word can use
+WORDS = frozenset(list(BINARY) + list(EQUALS) + list(DEFINERS) +
+                  ["not", "dup", "drop", "swap", "over", "rot", "if", "while"])
+
+def definednames(toks):
+    "Returns the names toks, and the code blocks in it, define with `name def"
+    names = set()
+    for (i, tok) in enumerate(toks):
+        if tok.type == "lit_code":
+            names |= definednames(tok.val)
+        elif (tok.type == "lit_symbol" and i + 1 < len(toks)
+                and toks[i+1].type == "call" and toks[i+1].val in DEFINERS):
+            names.add(tok.val)
+    return names
+
+class Generator:
+    "Generates the source of the Python function for one word"
+    def __init__(self, toks):
+        self.toks = toks
+        self.lines = []
+        self.indent = 1
+        self.count = 0
+        # The items taken from the real stack, the ones that must be numbers, and the ones whose Token type is used
+        self.inputs = []
+        self.numeric = set()
+        self.tagged = set()
+        # Values the generated function gets as globals
+        self.globals = {}
+        # Builtins the word uses, which have to be checked every time it is called
+        self.words = []
+        self.locals = definednames(toks)
+
+    def emit(self, line):
+        self.lines.append("    " * self.indent + line)
+
+    def fresh(self, prefix="t"):
+        self.count += 1
+        return "%s%d" % (prefix, self.count)
+
+    def constant(self, val):
+        name = self.fresh("c")
+        self.globals[name] = val
+        return name
+
+    def word(self, name):
+        if name in self.locals:
+            # The word defines a local with the name of a builtin
+            raise Unsupported(name)
+        if name not in self.words:
+            self.words.append(name)
+
+    def input(self, k):
+        while len(self.inputs) <= k:
+            i = len(self.inputs)
+            self.inputs.append(Value("any", "i%d" % i, input=i))
+        return self.inputs[k]
+
+    def pop(self, state):
+        if state.stack:
+            return state.stack.pop()
+        val = self.input(state.consumed)
+        state.consumed += 1
+        return val
+
+    def number(self, val):
+        "Returns the Python expression for val as a number"
+        if val.kind == "num":
+            return val.expr
+        if val.input is not None and val.kind == "any":
+            self.numeric.add(val.input)
+            return "n%d" % val.input
+        raise Unsupported("not a number")
+
+    def tagof(self, val):
+        "Returns the Python expression for the Token type of the number val in a boxed interpreter"
+        if val.kind == "num":
+            return val.tag
+        if val.input is not None and val.kind == "any":
+            self.tagged.add(val.input)
+            return "y%d" % val.input
+        raise Unsupported("not a number")
+
+    def truth(self, val):
+        "Returns the Python expression for val as a condition"
+        if val.kind == "bool":
+            return val.expr
+        return self.number(val)
+
+    def assign(self, kind, expr, tag=None):
+        name = self.fresh()
+        self.emit("%s = %s" % (name, expr))
+        return Value(kind, name, tag=tag)
+
+    def literal(self, tok):
+        type_, val = tok.type, tok.val
+        if type_ == "lit_int" and type(val) is int:
+            return Value("num", repr(val), tok, tag=repr(type_))
+        if type_ == "lit_float" and type(val) is float:
+            return Value("num", repr(val) if math.isfinite(val) else self.constant(val), tok, tag=repr(type_))
+        if type_ == "lit_bool" and type(val) is bool:
+            return Value("bool", repr(val), tok)
+        # Anything else (eg. strings, symbols and code) is pushed as the Token it is
+        return Value("any", self.constant(tok), tok)
+
+    def block(self, toks, state):
+        "Generates the code for toks, starting from state"
+        for (i, tok) in enumerate(toks):
+            type_ = tok.type
+            if type_ == "lit_liststart" or type_ == "listend":
+                raise Unsupported("list")
+            if type_.startswith("lit_"):
+                state.stack.append(self.literal(tok))
+            elif type_ == "call":
+                self.call(tok.val, state)
+            else:
+                raise Unsupported(type_)
+
+    def call(self, name, state):
+        if name in state.locals:
+            val = state.locals[name]
+            if val.tok is not None and val.tok.type == "lit_code":
+                raise Unsupported("calls a code object")
+            state.stack.append(val)
+            return
+        if name not in WORDS:
+            raise Unsupported(name)
+        self.word(name)
+        if name in BINARY:
+            op, kind = BINARY[name]
+            b = self.number(self.pop(state))
+            aval = self.pop(state)
+            a = self.number(aval)
+            if kind == "bool":
+                tag = None
+            elif name in FLOAT_RESULTS:
+                tag = repr("lit_float")
+            else:
+                tag = self.tagof(aval)
+            state.stack.append(self.assign(kind, "%s %s %s" % (a, op, b), tag))
+        elif name in EQUALS:
+            b, a = self.pop(state), self.pop(state)
+            if a.kind == b.kind == "bool":
+                state.stack.append(self.assign("bool", "%s == %s" % (a.expr, b.expr)))
+            else:
+                state.stack.append(self.assign("bool", "%s == %s" % (self.number(a), self.number(b))))
+        elif name == "not":
+            state.stack.append(self.assign("bool", "not %s" % self.truth(self.pop(state))))
+        elif name == "dup":
+            a = self.pop(state)
+            state.stack += (a, a)
+        elif name == "drop":
+            self.pop(state)
+        elif name == "swap":
+            b, a = self.pop(state), self.pop(state)
+            state.stack += (b, a)
+        elif name == "over":
+            b, a = self.pop(state), self.pop(state)
+            state.stack += (a, b, a)
+        elif name == "rot":
+            c, b, a = self.pop(state), self.pop(state), self.pop(state)
+            state.stack += (b, c, a)
+        elif name in DEFINERS:
+            sym, val = self.pop(state), self.pop(state)
+            if sym.tok is None or sym.tok.type != "lit_symbol" or "::" in sym.tok.val:
+                raise Unsupported("def of something that isn't a literal symbol")
+            state.locals[sym.tok.val] = val
+        elif name == "if":
+            self.if_(state)
+        else:
+            self.while_(state)
+
+    def code(self, val):
+        "Returns the tokens of the literal code object val"
+        if val.tok is None or val.tok.type != "lit_code":
+            raise Unsupported("not a literal code object")
+        return val.tok.val
+
+    def normalize(self, state, consumed):
+        "Makes state take consumed items from the real stack, by moving the ones it didn't take onto its stack"
+        extra = [self.input(k) for k in reversed(range(state.consumed, consumed))]
+        state.stack[:0] = extra
+        state.consumed = consumed
+
+    def merge(self, states, lines):
+        """Returns the State after the branches that end in states, whose code is in lines.
+        Values that differ between the branches are assigned to a new variable at the end of each branch."""
+        pad = "    " * (self.indent + 1)
+        consumed = max(state.consumed for state in states)
+        for state in states:
+            self.normalize(state, consumed)
+        if len(set(len(state.stack) for state in states)) != 1:
+            raise Unsupported("branches leave different numbers of items")
+        merged = State([], consumed, {})
+        slots = [("stack", i) for i in range(len(states[0].stack))]
+        # Locals that only some branches define aren't defined after them
+        names = set.intersection(*(set(state.locals) for state in states))
+        slots += [("locals", name) for name in sorted(names)]
+        for (where, key) in slots:
+            vals = [getattr(state, where)[key] for state in states]
+            if all(val is vals[0] for val in vals):
+                val = vals[0]
+            else:
+                kinds = set(val.kind for val in vals)
+                if kinds == {"num", "any"}:
+                    # Items taken from the stack can be used as numbers
+                    exprs = [self.number(val) for val in vals]
+                    kind = "num"
+                elif len(kinds) == 1 and not any(val.tok is not None and val.tok.type == "lit_code" for val in vals):
+                    exprs = [val.expr for val in vals]
+                    kind = vals[0].kind
+                else:
+                    raise Unsupported("branches leave different kinds of values")
+                val = Value(kind, self.fresh("m"))
+                for (branch, expr) in zip(lines, exprs):
+                    branch.append(pad + "%s = %s" % (val.expr, expr))
+                if kind == "num":
+                    tags = [self.tagof(v) for v in vals]
+                    if len(set(tags)) == 1:
+                        val.tag = tags[0]
+                    else:
+                        val.tag = self.fresh("g")
+                        for (branch, tag) in zip(lines, tags):
+                            branch.append(pad + "%s = %s" % (val.tag, tag))
+            if where == "stack":
+                merged.stack.append(val)
+            else:
+                merged.locals[key] = val
+        return merged
+
+    def branch(self, toks, state):
+        "Generates toks into a list of lines of their own, and returns the lines and the end State"
+        outer, self.lines = self.lines, []
+        self.indent += 1
+        try:
+            self.block(toks, state)
+            return self.lines, state
+        finally:
+            self.lines = outer
+            self.indent -= 1
+
+    def if_(self, state):
+        f, t, b = self.pop(state), self.pop(state), self.pop(state)
+        cond = self.truth(b)
+        tlines, tstate = self.branch(self.code(t), state.copy())
+        flines, fstate = self.branch(self.code(f), state.copy())
+        merged = self.merge([tstate, fstate], [tlines, flines])
+        pad = "    " * (self.indent + 1)
+        self.emit("if %s:" % cond)
+        self.lines += tlines or [pad + "pass"]
+        self.emit("else:")
+        self.lines += flines or [pad + "pass"]
+        state.stack, state.consumed, state.locals = merged.stack, merged.consumed, merged.locals
+
+    def while_(self, state):
+        body, cond = self.pop(state), self.pop(state)
+        condtoks, bodytoks = self.code(cond), self.code(body)
+        # A trial run finds the values the loop changes, which need a variable of their own
+        trial = Generator(self.toks)
+        trial.inputs, trial.count, trial.locals = self.inputs, self.count, self.locals
+        end = state.copy()
+        trial.block(condtoks, end)
+        trial.pop(end)
+        trial.block(bodytoks, end)
+        self.count = trial.count
+        if end.consumed != state.consumed or len(end.stack) != len(state.stack):
+            raise Unsupported("loop changes the depth of the stack")
+        entry = state.copy()
+        # The values whose Token type has a variable of its own
+        retagged = []
+        for (where, key) in self.slots(state):
+            old = getattr(state, where)[key]
+            new = end.stack[key] if where == "stack" else end.locals.get(key)
+            if new is not old:
+                if new is None or new.kind != old.kind or old.kind == "any":
+                    raise Unsupported("loop changes the kind of a value")
+                var = Value(old.kind, self.fresh("v"), tag=old.tag)
+                self.emit("%s = %s" % (var.expr, old.expr))
+                if old.kind == "num" and new.tag != old.tag:
+                    # The type of Token the number is pushed as can change too
+                    var.tag = self.fresh("g")
+                    self.emit("%s = %s" % (var.tag, old.tag))
+                    retagged.append(var)
+                getattr(entry, where)[key] = var
+        self.emit("while True:")
+        self.indent += 1
+        after = entry.copy()
+        self.block(condtoks, after)
+        self.emit("if not %s: break" % self.truth(self.pop(after)))
+        loop = after.copy()
+        self.block(bodytoks, loop)
+        # Carry the changed values into the next time around
+        pairs = [(getattr(entry, where)[key], getattr(loop, where)[key])
+                 for (where, key) in self.slots(entry) if getattr(entry, where)[key] is not getattr(state, where)[key]]
+        exprs = [(var.expr, val.expr) for (var, val) in pairs]
+        for (var, val) in pairs:
+            if var in retagged:
+                exprs.append((var.tag, self.tagof(val)))
+            elif var.kind == "num" and self.tagof(val) != var.tag:
+                raise Unsupported("loop changes the type of a number")
+        if exprs:
+            self.emit("%s = %s" % (", ".join(var for (var, _) in exprs), ", ".join(val for (_, val) in exprs)))
+        self.indent -= 1
+        # Locals first defined in the loop might not be defined after it
+        after.locals = {name: val for (name, val) in after.locals.items() if name in entry.locals}
+        state.stack, state.consumed, state.locals = after.stack, after.consumed, after.locals
+
+    def slots(self, state):
+        return [("stack", i) for i in range(len(state.stack))] + [("locals", name) for name in sorted(state.locals)]
+
+    def output(self, val):
+        "Returns the expressions that push val in a boxed and an unboxed interpreter"
+        if val.kind == "any":
+            return val.expr, val.expr
+        if val.kind == "num":
+            # Typed as the builtins would have, which isn't always the type of the result
+            return "literal(%s, %s)" % (val.tag, val.expr), val.expr
+        return "totoken(%s)" % val.expr, val.expr
+
+    def generate(self):
+        "Returns the source of the function"
+        state = State([], 0, {})
+        self.block(self.toks, state)
+        self.normalize(state, len(self.inputs))
+        body, self.lines = self.lines, []
+        n = len(self.inputs)
+        if self.words:
+            # The builtins the word uses must not have been redefined
+            self.emit("if not (%s):" % " and ".join("isbuiltin(NAMES, CACHE, %d, BUILTINS[%d])" % (i, i)
+                                                    for i in range(len(self.words))))
+            self.emit("    return False")
+        if n:
+            self.emit("if len(stack) < %d:" % n)
+            self.emit("    return False")
+            self.emit("%s, = stack[-%d:]" % (", ".join("i%d" % k for k in reversed(range(n))), n))
+            for k in sorted(self.numeric):
+                self.emit("n%d = i%d.val if type(i%d) is Token else i%d" % (k, k, k, k))
+                self.emit("if type(n%d) not in NUMBERS:" % k)
+                self.emit("    return False")
+            for k in sorted(self.tagged):
+                # Only used in a boxed interpreter, where every item is a Token
+                self.emit("y%d = i%d.type if type(i%d) is Token else None" % (k, k, k))
+        self.lines += body
+        boxed, unboxed = zip(*map(self.output, state.stack)) if state.stack else ((), ())
+        target = "stack[-%d:]" % n if n else "stack[len(stack):]"
+        self.emit("if env.unboxed:")
+        self.emit("    %s = [%s]" % (target, ", ".join(unboxed)))
+        self.emit("else:")
+        self.emit("    %s = [%s]" % (target, ", ".join(boxed)))
+        self.emit("return True")
+        return "def word(env, stack):\n    isbuiltin = env._isbuiltin\n" + "\n".join(self.lines) + "\n"
+
+def compile_word(toks):
+    """Returns a Python function that runs toks as the body of a word, or None if it can't be compiled.
+    The function is called as f(env, stack), where stack is the list of env's Stack. It returns
+    False without doing anything when it can't run the word (eg. a builtin it uses was redefined,
+    or the stack doesn't hold numbers where they are needed), and the interpreter should run it."""
+    from nustack.stdlib import builtins
+    gen = Generator(list(toks))
+    try:
+        source = gen.generate()
+    except Unsupported as e:
+        log("codegen: Can not compile word:", e)
+        return None
+    log("codegen: Compiled word\n" + source)
+    namespace = dict(gen.globals)
+    namespace.update({
+        "Token": Token,
+        "NUMBERS": frozenset((int, float)),
+        "totoken": ffi.totoken,
+        "literal": literal,
+        "NAMES": gen.words,
+        "CACHE": [None] * len(gen.words),
+        "BUILTINS": [builtins.module.get(name) for name in gen.words],
+    })
+    exec(compile(source, "<nustack word>", "exec"), namespace)
+    word = namespace["word"]
+    word.source = source
+    return word
+
+def warm(block):
+    """Counts a call of the word whose body is the Block block. Returns its compiled function
+    once it is hot, False if it can't be compiled, or None if it isn't hot yet."""
+    block.calls += 1
+    if block.calls < HOT:
+        return None
+    native = block.native = compile_word(block) or False
+    return native
@@ -0,0 +1,214 @@
+#!python3
+# Nustack bytecode compiler
+# Compiles a list of tokens into a Code object: a flat list of integer opcodes and
+# arguments, a constant pool, and a name pool. The interpreter runs Code objects in
+# a dispatch loop (see Interpreter.execute).
+from nustack.utils import log
+from nustack.ffi import unbox
+
+# Opcodes. Every instruction is an opcode followed by one argument in Code.ops.
+PUSH_CONST = 0 # Push consts[arg]
+BUILD_LIST = 1 # Pop everything down to the last "[" and push it as a list. arg is unused
+CALL       = 2 # Look up names[arg] and call it
+CALL_QUALIFIED = 3 # Look up the path names[arg], eg. ("Mod", "word") for Mod::word, and call it
+# Local variables of a word live in slots of its Frame. Both of these are followed by the
+# instructions they replace, which are run instead when the fast path can't be used.
+LOAD_LOCAL  = 4 # Call the value in slot arg, followed by CALL name
+STORE_LOCAL = 5 # Pop into slot arg, followed by PUSH_CONST `name and CALL def
+FUSED       = 6 # Run the superinstruction FUSIONS[arg], followed by the instructions it stands for
+
+OPNAMES = {
+    PUSH_CONST: "PUSH_CONST",
+    BUILD_LIST: "BUILD_LIST",
+    CALL:       "CALL",
+    CALL_QUALIFIED: "CALL_QUALIFIED",
+    LOAD_LOCAL: "LOAD_LOCAL",
+    STORE_LOCAL: "STORE_LOCAL",
+    FUSED:      "FUSED",
+}
+
+# Words that define a name in the current scope
+DEFINERS = ("def", "define")
+
+# Superinstructions: short sequences of tokens that are common enough to be run as one
+# instruction. Each is (name, pattern), where each item of the pattern matches one token:
+# ("call", words) matches a call of any of the words, and ("lit", types) a literal of any of the types.
+# The interpreter only uses a superinstruction while its words still resolve to the builtins.
+FUSIONS = [
+    ("dup *",     (("call", ("dup",)), ("call", ("*", "mul")))),
+    ("over over", (("call", ("over",)), ("call", ("over",)))),
+    ("swap drop", (("call", ("swap",)), ("call", ("drop",)))),
+    ("n +",       (("lit", ("lit_int",)), ("call", ("+", "add")))),
+    ("n -",       (("lit", ("lit_int",)), ("call", ("-", "sub")))),
+    ("n eq",      (("lit", ("lit_int", "lit_float")), ("call", ("eq", "=")))),
+    ("`x def",    (("lit", ("lit_symbol",)), ("call", DEFINERS))),
+]
+
+class Code:
+    __slots__ = ("ops", "consts", "rawconsts", "names", "cache", "localnames", "layout")
+
+    def __init__(self, ops, consts, names, localnames=()):
+        self.ops = ops
+        self.consts = consts
+        # The constants as pushed by an interpreter that keeps plain values unboxed
+        self.rawconsts = [unbox(const) for const in consts]
+        self.names = names
+        # The names of the slots in a Frame for this code, and a map from name to slot
+        self.localnames = list(localnames)
+        self.layout = {name: i for (i, name) in enumerate(self.localnames)}
+        # Inline cache for each name, filled in by the interpreter when it is called.
+        # See Interpreter._resolve
+        self.cache = [None] * len(names)
+
+    def __len__(self):
+        return len(self.ops) // 2
+
+    def disassemble(self):
+        "Returns a human readable listing of the instructions"
+        lines = []
+        for pc in range(0, len(self.ops), 2):
+            op, arg = self.ops[pc], self.ops[pc+1]
+            if op == PUSH_CONST:
+                detail = repr(self.consts[arg])
+            elif op == CALL:
+                detail = self.names[arg]
+            elif op == CALL_QUALIFIED:
+                detail = "::".join(self.names[arg])
+            elif op in (LOAD_LOCAL, STORE_LOCAL):
+                detail = self.localnames[arg]
+            elif op == FUSED:
+                detail = FUSIONS[arg][0]
+            else:
+                detail = ""
+            lines.append("%4d %-12s %s" % (pc // 2, OPNAMES[op], detail))
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return "Code(%d instructions)" % len(self)
+
+class Block(list):
+    """The val of a lit_code token once it has been seen by the compiler.
+    Behaves exactly like a list, but remembers its compiled Code so that running the
+    same code object again does not compile it again. Changing the list forgets the Code.
+    native and calls are used by interpreters that compile hot words to Python (see codegen)."""
+    __slots__ = ("code", "wordcode", "native", "calls")
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self.code = None
+        self.wordcode = None
+        self.native = None
+        self.calls = 0
+
+    def __reduce__(self):
+        return (Block, (list(self),))
+
+def _forgetting(name):
+    method = getattr(list, name)
+    def wrapper(self, *args):
+        self.code = self.wordcode = self.native = None
+        self.calls = 0
+        return method(self, *args)
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ("append", "extend", "insert", "pop", "remove", "reverse", "sort", "clear",
+              "__setitem__", "__delitem__", "__iadd__", "__imul__"):
+    setattr(Block, _name, _forgetting(_name))
+del _name
+
+def localnames(toks):
+    "Returns the names that toks defines with `name def, in the order they are first defined"
+    names = []
+    for (sym, call) in zip(toks, toks[1:]):
+        if (sym.type == "lit_symbol" and call.type == "call" and call.val in DEFINERS
+                and "::" not in sym.val and sym.val not in names):
+            names.append(sym.val)
+    return names
+
+def fusion(toks, i, layout):
+    "Returns the index in FUSIONS of the superinstruction that starts at toks[i], or None"
+    for (idx, (_, pattern)) in enumerate(FUSIONS):
+        if i + len(pattern) > len(toks):
+            continue
+        for ((kind, vals), tok) in zip(pattern, toks[i:]):
+            if kind == "call":
+                # Calls of locals are compiled to more than one instruction
+                if tok.type != "call" or tok.val not in vals or tok.val in layout:
+                    break
+            elif tok.type not in vals or (tok.type == "lit_symbol" and tok.val in layout):
+                # `x def of a local is a STORE_LOCAL
+                break
+        else:
+            return idx
+    return None
+
+def compile_tokens(toks, word=False):
+    """Compiles a list of tokens into a Code object.
+    If word is True, the code is compiled to run as the body of a word, with its own Frame."""
+    toks = list(toks)
+    ops, consts, names = [], [], []
+    constidx, nameidx = {}, {}
+    locals_ = localnames(toks) if word else []
+    layout = {name: i for (i, name) in enumerate(locals_)}
+
+    def const(tok):
+        if tok.type == "lit_code" and type(tok.val) is not Block:
+            tok.val = Block(tok.val)
+        # Tokens are shared, so each one only needs one slot in the pool
+        idx = constidx.get(id(tok))
+        if idx is None:
+            idx = constidx[id(tok)] = len(consts)
+            consts.append(tok)
+        return idx
+
+    def name(name):
+        idx = nameidx.get(name)
+        if idx is None:
+            idx = nameidx[name] = len(names)
+            # Qualified names are split once here instead of every time they are called
+            names.append(tuple(name.split("::")) if "::" in name else name)
+        return idx
+
+    # Superinstructions don't overlap, so the tokens of one are compiled to consecutive instructions
+    fusable = 0
+    for (i, tok) in enumerate(toks):
+        if i >= fusable:
+            fused = fusion(toks, i, layout)
+            if fused is not None:
+                ops += (FUSED, fused)
+                fusable = i + len(FUSIONS[fused][1])
+        type_ = tok.type
+        if type_.startswith("lit_"):
+            if (type_ == "lit_symbol" and tok.val in layout and i + 1 < len(toks)
+                    and toks[i+1].type == "call" and toks[i+1].val in DEFINERS):
+                ops += (STORE_LOCAL, layout[tok.val])
+            ops += (PUSH_CONST, const(tok))
+        elif type_ == "listend":
+            ops += (BUILD_LIST, 0)
+        elif type_ == "call":
+            if tok.val in layout:
+                ops += (LOAD_LOCAL, layout[tok.val])
+            ops += (CALL_QUALIFIED if "::" in tok.val else CALL, name(tok.val))
+        # Anything else (eg. an unclosed "{") does nothing when run
+    code = Code(ops, consts, names, locals_)
+    log("compiler: Compiled", code)
+    return code
+
+def get_code(toks):
+    "Returns the Code for a list of tokens, reusing the compiled Code of a Block"
+    if type(toks) is Block:
+        code = toks.code
+        if code is None:
+            code = toks.code = compile_tokens(toks)
+        return code
+    return compile_tokens(toks)
+
+def get_wordcode(toks):
+    "Returns the Code for a list of tokens that is being called as a word"
+    if type(toks) is Block:
+        code = toks.wordcode
+        if code is None:
+            code = toks.wordcode = compile_tokens(toks, word=True)
+        return code
+    return compile_tokens(toks, word=True)
@@ -1,6 +1,6 @@
 #!python3
 # Nustack extension module base class
-from nustack.tokenize import Token # Re-export Token
+from nustack.tokenize import Token, boolean, integer, literal, hashkey # Re-export Token and its helpers
 class NotDefinedError(Exception): pass
 
 class Module:
@@ -9,6 +9,8 @@ class Module:
         self.modname = modname
 
     def register(self, *names):
+        """Registers the decorated function under each of names. It is called with the interpreter,
+        and can be an async def function, which interpreters run with eval_async await"""
         def dec(f):
             for name in names:
                 self.contents[name] = f
@@ -16,6 +18,15 @@ class Module:
             return f
         return dec
 
+    def unboxed(self, func):
+        """Registers the decorated function as the version of func that is called by interpreters
+        that keep plain values on the stack (see interpreter.UnboxedStack)"""
+        def dec(f):
+            f.nustack = True
+            func.unboxed = f
+            return f
+        return dec
+
     def registerValue(self, name, value):
         self.contents[name] = value
 
@@ -0,0 +1,100 @@
+#!python3
+# Nustack foreign function interface
+# Calls Python functions that weren't registered with an extension Module.
+# How many arguments a function takes is worked out with inspect the first time it is
+# called, and kept in an Adapter that is reused for every later call.
+import inspect, types, weakref
+from nustack.tokenize import Token, literal
+
+# The Token type a Python value of each of these types is returned as.
+# Anything else comes back as lit_any.
+LITERAL_TYPES = {
+    bool: "lit_bool",
+    int: "lit_int",
+    float: "lit_float",
+    str: "lit_string",
+    bytes: "lit_bytes",
+}
+
+def getnumargs(func):
+    if hasattr(inspect, "signature"):
+        sig = inspect.signature(func)
+        return len(sig.parameters)
+    else:
+        return len(inspect.getfullargspec(func).args)
+
+def totoken(val):
+    "Wraps a value returned by a Python function in a Token of the right type"
+    if type(val) is Token:
+        return val
+    return literal(LITERAL_TYPES.get(type(val), "lit_any"), val)
+
+def unbox(tok):
+    "Returns the Python value tok holds if totoken would give tok's type back for it, else tok"
+    if type(tok) is Token and LITERAL_TYPES.get(type(tok.val)) == tok.type:
+        return tok.val
+    return tok
+
+class Adapter:
+    "Calls a Python function with arguments taken from a Stack"
+    __slots__ = ("numargs",)
+
+    def __init__(self, numargs):
+        self.numargs = numargs
+
+    def __call__(self, func, stack):
+        if self.numargs:
+            ret = func(*[arg.val for arg in stack.popN(self.numargs)])
+        else:
+            ret = func()
+        if ret is not None:
+            stack.push(totoken(ret))
+
+    def __repr__(self):
+        return "Adapter(numargs=%d)" % self.numargs
+
+# Adapters of functions, and of the functions behind bound methods, which are made anew
+# every time they are looked up. Both are dropped once the function goes away.
+_functions = weakref.WeakKeyDictionary()
+_methods = weakref.WeakKeyDictionary()
+# Adapters of builtin functions, which can't be weakly referenced.
+# Builtin methods are keyed by the type they are bound to, so this stays small.
+_builtins = {}
+
+def _cachefor(func):
+    "Returns the cache func's adapter goes in and its key there"
+    type_ = type(func)
+    if type_ is types.FunctionType:
+        return _functions, func
+    if type_ is types.MethodType:
+        return _methods, func.__func__
+    owner = getattr(func, "__self__", None)
+    if owner is None or type(owner) is types.ModuleType:
+        return _builtins, func
+    if isinstance(owner, type):
+        # A classmethod, eg. dict.fromkeys, whose arguments depend on the class itself
+        return _builtins, (owner, func.__name__)
+    return _builtins, (type(owner), func.__name__)
+
+def adapter(func):
+    "Returns the Adapter for func"
+    cache, key = _cachefor(func)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # Not hashable or not weakly referenceable, so it can't be cached
+        return Adapter(getnumargs(func))
+    adapt = cache[key] = Adapter(getnumargs(func))
+    return adapt
+
+def call(func, stack):
+    "Calls the Python function func with its arguments from stack and pushes its return value"
+    adapter(func)(func, stack)
+
+def clear():
+    "Forgets every adapter"
+    _functions.clear()
+    _methods.clear()
+    _builtins.clear()
@@ -0,0 +1,94 @@
+#!python3
+# Nustack green threads
+# A program can run several threads of its own with spawn. They take turns on the interpreter,
+# switching when one calls yield, waits on a Channel, or waits for an async word
+# (see Interpreter._schedule). Each has its own stack and return stack, and they share scopes.
+# Any other word that waits, like IO::readall, Shell::run, Time::sleep or input, blocks every
+# green thread until it returns. Use the .async variant of the word where there is one.
+import collections
+
+class DeadlockError(Exception): pass
+
+# Returned by a registered function to make the interpreter switch to another green thread.
+# The function has to have put the thread that is running somewhere first, or it never runs again.
+SWITCH = object()
+
+class GreenThread:
+    """A thread of a Nustack program.
+    records is its return stack, and outcome is what the async word it is waiting for did"""
+    __slots__ = ("stack", "scope", "records", "outcome", "channel", "shouldbreak")
+
+    def __init__(self, stack, scope, records):
+        self.stack = stack
+        self.scope = scope
+        self.records = records
+        self.outcome = None
+        # The Channel the thread is waiting on
+        self.channel = None
+        # Set by break to end the innermost loop the thread is running
+        self.shouldbreak = False
+
+    def __repr__(self):
+        return "<GreenThread at 0x%x>" % id(self)
+
+class Channel:
+    """Passes values from one green thread to another in the order they were sent.
+    Up to maxsize values can wait in the channel before send blocks, or any number if maxsize is 0."""
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        # The threads waiting to receive, and (thread, value) for the threads waiting to send
+        self.receivers = collections.deque()
+        self.senders = collections.deque()
+
+    def send(self, env, val):
+        "Sends val from the green thread that is running in env. Returns SWITCH if the thread has to wait"
+        if self.receivers:
+            self._wake(env, self.receivers.popleft()).stack.push(val)
+        elif not self.maxsize or len(self.items) < self.maxsize:
+            self.items.append(val)
+        else:
+            self._wait(env, self.senders, (env.thread, val))
+            return SWITCH
+
+    def receive(self, env):
+        "Pushes the next value to env's stack. Returns SWITCH if the thread has to wait for it"
+        if self.items:
+            env.stack.push(self.items.popleft())
+            if self.senders:
+                (thread, val) = self.senders.popleft()
+                self.items.append(val)
+                self._wake(env, thread)
+        elif self.senders:
+            (thread, val) = self.senders.popleft()
+            env.stack.push(val)
+            self._wake(env, thread)
+        else:
+            self._wait(env, self.receivers, env.thread)
+            return SWITCH
+
+    def forget(self, thread):
+        "Stops thread from waiting on this channel"
+        if thread in self.receivers:
+            self.receivers.remove(thread)
+        for waiting in list(self.senders):
+            if waiting[0] is thread:
+                self.senders.remove(waiting)
+        thread.channel = None
+
+    def _wait(self, env, queue, entry):
+        if not env.canswitch():
+            raise DeadlockError("Can't wait on a channel here!")
+        queue.append(entry)
+        env.thread.channel = self
+
+    def _wake(self, env, thread):
+        thread.channel = None
+        env.runnable.append(thread)
+        return thread
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return "<Channel with %d values>" % len(self.items)
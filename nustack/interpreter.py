@@ -1,44 +1,91 @@
 #!python3
-import types, os, inspect
-from nustack import tokenize
-from nustack.utils import log
+import types, os, sys, copy, asyncio, time, collections, contextvars, concurrent.futures
+from nustack import tokenize, compiler, ffi, codegen
+from nustack.utils import log, logging_config
 from nustack.stdlib import builtins
 
+from nustack.compiler import PUSH_CONST, BUILD_LIST, CALL, CALL_QUALIFIED, LOAD_LOCAL, STORE_LOCAL, FUSED
+from nustack.tokenize import Token, boolean, literal
+from nustack.extensionbase import Module
+from nustack.green import GreenThread, DeadlockError, SWITCH
+
+# Namespaces whose members don't change once they are imported
+NAMESPACE_TYPES = (builtins.ScopeWrapper, Module)
+
+GeneratorType = types.GeneratorType
+CoroutineType = types.CoroutineType
+# Stands in for a record that has nothing left to run
+EMPTY_CODE = compiler.compile_tokens([])
+
 class StackUnderflowError(Exception): pass
+class BudgetExceededError(Exception): pass
 class ScopeUnderflowError(Exception): pass
 class ScopeLookupError(Exception): pass
 
-def getnumargs(func):
-    if hasattr(inspect, "signature"):
-        sig = inspect.signature(func)
-        return len(sig.parameters)
-    else:
-        return len(inspect.getfullargspec(func).args)
+# Returned by _run when it stops at the end of a slice (see Interpreter.step)
+PAUSED = object()
+# The limit _run counts up to when there is no budget or slice
+NO_LIMIT = sys.maxsize
+
+getnumargs = ffi.getnumargs
 
 class Stack:
     def __init__(self, start=None):
         if start:
             self._stack = list(start)
         else:
-            self.clear()
+            self._stack = []
 
     def clear(self):
-        self._stack = []
+        # Cleared in place, since the interpreter holds on to the list while it runs
+        del self._stack[:]
+
+    def _underflow(self, n):
+        if len(self._stack) < n:
+            raise StackUnderflowError("Stack is empty!" if not self._stack else
+                                      "Stack has %d items, %d needed!" % (len(self._stack), n))
 
     def pop(self):
-        if len(self) == 0:
+        if not self._stack:
             raise StackUnderflowError("Stack is empty!")
-        thing = self._stack.pop()
-        return thing
+        return self._stack.pop()
 
     def popN(self, n):
-        if n == 0: return ()
-        pops = reversed([self.pop() for _ in range(n)])
-        return tuple(pops)
+        "Pops the top n items, in the order they were pushed"
+        if n <= 0: return ()
+        self._underflow(n)
+        stack = self._stack
+        pops = tuple(stack[-n:])
+        del stack[-n:]
+        return pops
 
     def push(self, *args):
-        for arg in args:
-            self._stack.append(arg)
+        self._stack.extend(args)
+
+    def pushN(self, items):
+        "Pushes every item in the iterable items"
+        self._stack.extend(items)
+
+    def drop(self, n=1):
+        "Throws away the top n items"
+        if n <= 0: return
+        self._underflow(n)
+        del self._stack[-n:]
+
+    def peek(self, i=0):
+        "Returns the item i places below the top without popping it"
+        self._underflow(i + 1)
+        return self._stack[-1 - i]
+
+    def pick(self, i):
+        "Pushes a copy of the item i places below the top"
+        self._underflow(i + 1)
+        self._stack.append(self._stack[-1 - i])
+
+    def roll(self, i):
+        "Moves the item i places below the top to the top"
+        self._underflow(i + 1)
+        self._stack.append(self._stack.pop(-1 - i))
 
     def __len__(self):
         return len(self._stack)
@@ -46,30 +93,294 @@ class Stack:
     def __repr__(self):
         return "Stack( %s )" % repr(self._stack)
 
-class Scope:
+# The Python types an UnboxedStack keeps without a Token
+UNBOXED_TYPES = ffi.LITERAL_TYPES
+
+class UnboxedStack(Stack):
+    """A Stack that keeps bools, ints, floats, strings and bytes as plain Python values.
+    pop still returns Tokens, with the type worked out from the Python type, so builtins
+    and extension modules work unchanged. Words registered with Module.unboxed work on
+    the plain values in _stack instead.
+    The local slots of words hold whatever was popped into them, so they can hold plain values too."""
+    def pop(self):
+        thing = Stack.pop(self)
+        if type(thing) in UNBOXED_TYPES:
+            return ffi.totoken(thing)
+        return thing
+
+    def popN(self, n):
+        return tuple([ffi.totoken(thing) if type(thing) in UNBOXED_TYPES else thing
+                      for thing in Stack.popN(self, n)])
+
+    def push(self, *args):
+        self._stack.extend(map(ffi.unbox, args))
+
+    def pushN(self, items):
+        self._stack.extend(map(ffi.unbox, items))
+
+    def peek(self, i=0):
+        thing = Stack.peek(self, i)
+        if type(thing) in UNBOXED_TYPES:
+            return ffi.totoken(thing)
+        return thing
+
+# The superinstructions in compiler.FUSIONS, by name.
+# Each is called as fused(env, stack, const), where stack is the list of the Stack and const is
+# the literal Token of the superinstruction, if it has one. It returns False if it can't be used
+# (eg. the stack doesn't hold numbers), and then the instructions it stands for are run instead.
+NUMBERS = frozenset((int, float))
+
+def _square(env, stack, const):
+    if not stack:
+        return False
+    a = stack[-1]
+    if type(a) is Token:
+        if type(a.val) not in NUMBERS:
+            return False
+        stack[-1] = literal(a.type, a.val * a.val)
+    elif type(a) in NUMBERS:
+        stack[-1] = a * a
+    else:
+        return False
+    return True
+
+def _over_over(env, stack, const):
+    if len(stack) < 2:
+        return False
+    stack.extend(stack[-2:])
+    return True
+
+def _nip(env, stack, const):
+    if len(stack) < 2:
+        return False
+    del stack[-2]
+    return True
+
+def _add_const(env, stack, const):
+    if not stack:
+        return False
+    a = stack[-1]
+    if type(a) is Token:
+        if type(a.val) not in NUMBERS:
+            return False
+        stack[-1] = literal(a.type, a.val + const.val)
+    elif type(a) in NUMBERS:
+        stack[-1] = a + const.val
+    else:
+        return False
+    return True
+
+def _sub_const(env, stack, const):
+    if not stack:
+        return False
+    a = stack[-1]
+    if type(a) is Token:
+        if type(a.val) not in NUMBERS:
+            return False
+        stack[-1] = literal(a.type, a.val - const.val)
+    elif type(a) in NUMBERS:
+        stack[-1] = a - const.val
+    else:
+        return False
+    return True
+
+def _eq_const(env, stack, const):
+    if not stack:
+        return False
+    a = stack[-1]
+    if type(a) is Token:
+        eq = a == const
+    elif type(a) in NUMBERS:
+        eq = a == const.val
+    else:
+        return False
+    stack[-1] = eq if env.unboxed else boolean(eq)
+    return True
+
+def _define(env, stack, const):
+    if not stack:
+        return False
+    val = stack.pop()
+    if type(val) in UNBOXED_TYPES:
+        val = ffi.totoken(val)
+    env.scope.assign(const.val, val)
+    return True
+
+FUSED_FUNCTIONS = {
+    "dup *": _square,
+    "over over": _over_over,
+    "swap drop": _nip,
+    "n +": _add_const,
+    "n -": _sub_const,
+    "n eq": _eq_const,
+    "`x def": _define,
+}
+
+def _fusedops():
+    """Returns (fused, calls, constat, size) for each superinstruction in compiler.FUSIONS.
+    calls holds (at, builtin) for each word, where ops[pc+at] is the name of the word when the
+    superinstruction is followed by the instructions at pc. ops[pc+constat] is its constant,
+    and size is how many ops it stands for."""
+    table = []
+    for (name, pattern) in compiler.FUSIONS:
+        calls = tuple((2*j + 1, builtins.module.get(vals[0]))
+                      for (j, (kind, vals)) in enumerate(pattern) if kind == "call")
+        lits = [2*j + 1 for (j, (kind, vals)) in enumerate(pattern) if kind == "lit"]
+        table.append((FUSED_FUNCTIONS[name], calls, lits[0] if lits else None, 2 * len(pattern)))
+    return table
+
+FUSED_OPS = _fusedops()
+
+class NameCell:
+    """Holds the definition version of one name in a Scope.
+    The version changes whenever the name is added to or removed from any scope dict,
+    which is when a cached resolution of that name might no longer be right."""
+    __slots__ = ("version",)
+
     def __init__(self):
+        self.version = 0
+
+# The value of a Frame slot that hasn't been defined yet
+UNBOUND = object()
+
+class Frame:
+    """The local scope of a call to a Nustack word.
+    Names the word defines with `name def are kept in a list of slots laid out by its Code,
+    so the word itself can get at them by index. Everything else (eg. names defined by
+    code the word runs with if, or names from other words) goes in a dict.
+    To the rest of the interpreter a Frame looks like a dict."""
+    __slots__ = ("layout", "slots", "bound", "extra")
+
+    def __init__(self, code):
+        self.layout = code.layout
+        self.slots = [UNBOUND] * len(code.localnames)
+        # How many slots are bound
+        self.bound = 0
+        self.extra = None
+
+    def __contains__(self, name):
+        i = self.layout.get(name)
+        if i is None:
+            return self.extra is not None and name in self.extra
+        return self.slots[i] is not UNBOUND
+
+    def __getitem__(self, name):
+        i = self.layout.get(name)
+        if i is None:
+            if self.extra is None:
+                raise KeyError(name)
+            return self.extra[name]
+        val = self.slots[i]
+        if val is UNBOUND:
+            raise KeyError(name)
+        return val
+
+    def __setitem__(self, name, val):
+        i = self.layout.get(name)
+        if i is None:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[name] = val
+        else:
+            if self.slots[i] is UNBOUND:
+                self.bound += 1
+            self.slots[i] = val
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def keys(self):
+        names = [name for (name, i) in self.layout.items() if self.slots[i] is not UNBOUND]
+        if self.extra:
+            names.extend(self.extra)
+        return names
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def __len__(self):
+        return self.bound + (len(self.extra) if self.extra else 0)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class Scope:
+    def __init__(self, globals=None):
+        "globals is the dict to use as the global scope, a new one if it is None"
         self._scopes = []
-        self.pushScope()
+        # name -> NameCell, for the names whose resolution has been cached
+        self._cells = {}
+        self.pushScope({} if globals is None else globals)
+
+    def _changed(self, scope):
+        "Bumps the version of every cached name in scope"
+        cells = self._cells
+        if not cells:
+            return
+        if len(scope) <= len(cells):
+            for name in scope:
+                cell = cells.get(name)
+                if cell is not None:
+                    cell.version += 1
+        else:
+            for (name, cell) in cells.items():
+                if name in scope:
+                    cell.version += 1
+
+    def cell(self, name):
+        "Returns the NameCell for name"
+        cell = self._cells.get(name)
+        if cell is None:
+            cell = self._cells[name] = NameCell()
+        return cell
 
     def pushScope(self, scope=None):
-        if scope == None:
+        if scope is None:
             self._scopes.append({})
         else:
+            if scope:
+                self._changed(scope)
             self._scopes.append(scope)
 
     def popScope(self):
         if len(self._scopes) <= 1:
             raise ScopeUnderflowError("Can not pop global scope!")
-        self._scopes.pop()
+        scope = self._scopes.pop()
+        if scope:
+            self._changed(scope)
 
-    def lookup(self, name):
+    def find(self, name):
+        "Returns the innermost scope that defines name, or None"
         for scope in reversed(self._scopes):
             if name in scope:
-                return scope[name]
-        raise ScopeLookupError("%s does not exist!" % name)
+                return scope
+        return None
+
+    def lookup(self, name):
+        scope = self.find(name)
+        if scope is None:
+            raise ScopeLookupError("%s does not exist!" % name)
+        return scope[name]
 
     def assign(self, name, val):
-        self._scopes[-1][name] = val
+        scope = self._scopes[-1]
+        if name not in scope:
+            cell = self._cells.get(name)
+            if cell is not None:
+                cell.version += 1
+        scope[name] = val
+
+    def share(self):
+        """Returns a new Scope with the same scope dicts as this one, for a green thread.
+        Names it pushes and pops are its own, but definitions in the shared dicts are seen by both."""
+        scope = Scope.__new__(Scope)
+        scope._scopes = self._scopes[:]
+        # Shared so that a definition through either one bumps the version of the name for both
+        scope._cells = self._cells
+        return scope
 
     def getGlobal(self, name):
         try:
@@ -80,17 +391,145 @@ class Scope:
     def __repr__(self):
         return "Scope: %s" % repr(self._scopes)
 
+# The types of values a program can change in place
+MUTABLE_TYPES = (list, dict, set, bytearray)
+
+def _mutable(thing):
+    "Returns True if thing holds a value a program could change in place. Code objects are left out"
+    return (type(thing) is Token and isinstance(thing.val, MUTABLE_TYPES)
+            and type(thing.val) is not compiler.Block)
+
+def _outcome(coro, task):
+    "Returns (coro, result, exception) for the asyncio task that ran coro"
+    exc = task.exception()
+    return (coro, None if exc is not None else task.result(), exc)
+
+class Parked:
+    """Awaits the coroutine of an async word for a green thread that has given way to others.
+    The interpreter's stack and scope are the thread's whenever the coroutine runs."""
+    def __init__(self, interp, thread, coro):
+        self.interp = interp
+        self.thread = thread
+        self.coro = coro
+
+    def __await__(self):
+        interp, thread = self.interp, self.thread
+        send, val = self.coro.send, None
+        while True:
+            stack, scope = interp.stack, interp.scope
+            interp.stack, interp.scope = thread.stack, thread.scope
+            try:
+                future = send(val)
+            except StopIteration as e:
+                return e.value
+            finally:
+                interp.stack, interp.scope = stack, scope
+            try:
+                val = yield future
+                send = self.coro.send
+            except BaseException as e:
+                val = e
+                send = self.coro.throw
+
+async def _parked(interp, thread, coro):
+    return await Parked(interp, thread, coro)
+
+def looprunning():
+    "Returns True if an asyncio event loop is running in this thread"
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+def wait(coro):
+    """Runs the coroutine of an async word to the end and returns its result.
+    This is how interpreters that aren't run with eval_async call async words.
+    A thread can only run one event loop, so if one is running here already (eg. code that a registered
+    function runs while eval_async is waiting), the coroutine is run on a loop in another thread."""
+    if not looprunning():
+        return asyncio.run(coro)
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        return pool.submit(contextvars.copy_context().run, asyncio.run, coro).result()
+
+class Snapshot:
+    """The global scope and stack of an interpreter after its setup code has run, see Interpreter.snapshot.
+    Interpreters spawned from a snapshot start with a copy of its global scope dict. The values in it are
+    shared, so imported modules and compiled words are reused as they are. Only lists, hashes and other
+    values that a program could change in place are copied for each interpreter."""
+    def __init__(self, interp):
+        self.globals = {name: copy.deepcopy(val) if _mutable(val) else val
+                        for (name, val) in interp.scope._scopes[0].items()}
+        self.stack = [copy.deepcopy(thing) if _mutable(thing) else thing for thing in interp.stack._stack]
+        # The names and stack positions whose values have to be copied
+        self.mutable = [name for (name, val) in self.globals.items() if _mutable(val)]
+        self.mutablestack = [i for (i, thing) in enumerate(self.stack) if _mutable(thing)]
+        self.file = interp.file
+        self.options = {"optimize": interp.optimize, "unboxed": interp.unboxed, "native": interp.native,
+                        "budget": interp.budget}
+
+    def restore(self, interp):
+        "Gives interp a fresh copy of the snapshot's global scope and stack"
+        globals = self.globals.copy()
+        for name in self.mutable:
+            globals[name] = copy.deepcopy(globals[name])
+        stack = self.stack[:]
+        for i in self.mutablestack:
+            stack[i] = copy.deepcopy(stack[i])
+        interp.stack = UnboxedStack(stack) if interp.unboxed else Stack(stack)
+        interp.scope = Scope(globals)
+
+    def spawn(self, argv=["<<INTERACTIVE>>"]):
+        """Returns a new Interpreter that starts from this snapshot.
+        Its run method goes back to the snapshot instead of starting from nothing."""
+        interp = Interpreter(argv, snapshot=self, **self.options)
+        interp.file = self.file
+        return interp
+
 class Interpreter:
     FUNCTION_TYPES = (types.FunctionType,
                       types.MethodType,
                       types.BuiltinFunctionType,
                       types.BuiltinMethodType)
 
-    def __init__(self, argv=["<<INTERACTIVE>>"]):
+    def __init__(self, argv=["<<INTERACTIVE>>"], optimize=False, unboxed=False, native=False, snapshot=None,
+                 budget=None):
+        # Keep plain values on the stack without Tokens (see UnboxedStack)
+        self.unboxed = unboxed
+        # Compile words that are called often to Python functions (see codegen)
+        self.native = native
+        # This interpreter's own logging configuration, see config_logging
+        self.log_config = None
+        # How many times each superinstruction was used, see fusionstats
+        self.fusions = [0] * len(FUSED_OPS)
+        # The most instructions this interpreter may run, or None for no limit. Running out raises BudgetExceededError
+        self.budget = budget
+        # How many instructions this interpreter has run, and how many seconds it has spent running them
+        self.instructions = 0
+        self.walltime = 0.0
+        # How many _runs are running, and other places that can't switch green threads, one inside the other
+        self._depth = 0
+        # The return stack of the program started with start, see step
+        self._task = None
+        # The Snapshot _reset goes back to, if this interpreter was spawned from one
+        self._snapshot = snapshot
         self._reset()
+        # Run programs through the optimizer before running them
+        self.optimize = optimize
         self.file = os.path.abspath(os.curdir)
         self.argv = [tokenize.Token("lit_string", arg) for arg in argv]
 
+    def config_logging(self, on=False, file=sys.stderr):
+        """Gives this interpreter a logging configuration of its own, which is used instead of the one
+        set by utils.config_logging while it runs. Interpreters in other threads aren't affected"""
+        self.log_config = {"on": on, "file": file}
+
+    def snapshot(self):
+        """Returns a Snapshot of this interpreter's global scope and stack, which includes everything
+        it has imported and defined. New interpreters can be spawned from it without running
+        the setup code again."""
+        return Snapshot(self)
+
     def getDir(self):
         if '.' in os.path.basename(self.file):
             return os.path.dirname(self.file)
@@ -98,61 +537,635 @@ class Interpreter:
             return self.file
 
     def run(self, code, file=None):
+        "Runs code, which can be a string, a list of tokens, or a file object that will be read in chunks"
         if not file:
             self.file = os.path.abspath(os.curdir)
         else:
             self.file = os.path.abspath(file)
         self._code = code
         self._reset()
-        self._parse()
-        self.eval(self._code)
+        with logging_config(self.log_config):
+            self._parse()
+            self.eval(self._toks)
+            log("run: superinstructions used", self.fusionstats())
         return self.stack, self.scope
 
+    def start(self, code):
+        """Gets code ready to be run a slice at a time with step, for running several interpreters
+        on one thread (see scheduler.Scheduler). code can be a string or a list of tokens."""
+        if type(code) == str:
+            code = tokenize.tokenize(code)
+        self._task = [[compiler.get_code(list(code)), 0, None, 0]]
+        self._main = self.thread = GreenThread(self.stack, self.scope, self._task)
+
+    def step(self, n):
+        "Runs the program given to start for about n more instructions. Returns True once it is finished"
+        if self._task is None:
+            return True
+        with logging_config(self.log_config):
+            try:
+                done = self._finish(None, None, n) is None
+            except BaseException:
+                done = True
+                raise
+            finally:
+                if done:
+                    self._task = None
+        return done
+
+    def spawn(self, code):
+        """Starts a green thread that runs code, a code object or list of tokens.
+        It gets a new stack and the scopes of the thread that is running, and runs when this one gives way."""
+        stack = UnboxedStack() if self.unboxed else Stack()
+        thread = GreenThread(stack, self.scope.share(), [[compiler.get_code(code), 0, None, 0]])
+        self.runnable.append(thread)
+        return thread
+
+    @property
+    def shouldbreak(self):
+        "Set by break to end the innermost loop. Each green thread has its own"
+        thread = self.thread
+        return self._shouldbreak if thread is None else thread.shouldbreak
+
+    @shouldbreak.setter
+    def shouldbreak(self, val):
+        thread = self.thread
+        if thread is None:
+            self._shouldbreak = val
+        else:
+            thread.shouldbreak = val
+
+    def canswitch(self):
+        "Returns True if the green thread that is running can give way to another one here"
+        return self._depth == 1 and self.thread is not None
+
+    def fusionstats(self):
+        "Returns how many times each superinstruction was used instead of the words it stands for, by name"
+        return {compiler.FUSIONS[i][0]: n for (i, n) in enumerate(self.fusions) if n}
+
     def _reset(self):
-        self.stack = Stack()
-        self.scope = Scope()
+        if self._snapshot is None:
+            self.stack = UnboxedStack() if self.unboxed else Stack()
+            self.scope = Scope()
+        else:
+            self._snapshot.restore(self)
+        # Set by break when no green thread is running, see shouldbreak
+        self._shouldbreak = False
+        # The green thread that is running and the one the program started in, and the threads that are ready
+        # to run. The first two are only set while the program runs, see _schedule
+        self.thread = self._main = None
+        self.runnable = collections.deque()
 
     def _parse(self):
-        self._toks = tokenize.tokenize(self._code)
+        if type(self._code) == str:
+            self._toks = tokenize.tokenize(self._code)
+        elif hasattr(self._code, "read"):
+            # Stream tokens from the file so the program can start before it is fully read
+            self._toks = tokenize.iter_tokens(self._code)
+        else:
+            self._toks = self._code
+        if self.optimize:
+            from nustack import optimizer
+            self._toks = optimizer.optimize(list(self._toks), self)
 
     def eval(self, code):
         if type(code) == str:
             toks = tokenize.tokenize(code)
         else:
             toks = code
-        for tok in toks:
-            #print(tok)
-            # Push any literals to the stack
-            if tok.type.startswith("lit_"):
-                self.stack.push(tok)
-            # Create a list
-            elif tok.type == "listend":
-                contents = []
-                while True:
-                    thing = self.stack.pop()
-                    if hasattr(thing, "type") and thing.type == "lit_liststart":
-                        break
-                    contents.append(thing)
-                self.stack.push(tokenize.Token("lit_list", list(reversed(contents))))
-            # "Call" something
-            elif tok.type == "call":
-                val = self.lookup(tok.val)
-                if type(val) in self.FUNCTION_TYPES:
-                    # If the final value is a function, we call it. This is how extension modules work
-                    self.call_external(val)
-                elif type(val) == tokenize.Token and val.type == "lit_code":
-                    # We got a Nustack function, so we should call it.
-                    namesplit = tok.val.split("::")
-                    if len(namesplit) > 1:
-                        newscope = self.scope.getGlobal(namesplit[0])
+        if isinstance(toks, list):
+            self.execute(compiler.get_code(toks))
+        else:
+            # A stream of tokens, so run each one as soon as it arrives
+            for tok in toks:
+                self.execute(compiler.compile_tokens((tok,)))
+
+    async def eval_async(self, code):
+        """Like eval, but awaits the async words it calls (eg. Time::sleep.async) instead of
+        blocking until they are done, so other tasks on the event loop can run meanwhile"""
+        if type(code) == str:
+            toks = tokenize.tokenize(code)
+        else:
+            toks = code
+        if isinstance(toks, list):
+            await self.execute_async(compiler.get_code(toks))
+        else:
+            for tok in toks:
+                await self.execute_async(compiler.compile_tokens((tok,)))
+
+    async def execute_async(self, code, frame=None):
+        "Runs a compiled Code object like execute, awaiting the async words it calls"
+        schedule = self._schedule([code, 0, frame, 0], [])
+        try:
+            with logging_config(self.log_config):
+                started = next(schedule)
+        except StopIteration:
+            return
+        await self._await_schedule(schedule, started)
+
+    async def _await_schedule(self, schedule, started):
+        """Drives the generator schedule from _schedule, which has yielded the coroutines started,
+        on the running event loop. Returns what schedule returns."""
+        tasks = {}
+        try:
+            while True:
+                for coro in started:
+                    tasks[asyncio.ensure_future(coro)] = coro
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                with logging_config(self.log_config):
+                    started = schedule.send([_outcome(tasks.pop(task), task) for task in done])
+        except StopIteration as e:
+            return e.value
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def execute(self, code, frame=None):
+        """Runs a compiled Code object.
+        frame is the Frame that was pushed for code when it is being run as a word"""
+        with logging_config(self.log_config):
+            self._finish([code, 0, frame, 0], [])
+
+    def _drive(self, gen):
+        "Runs a generator returned by a registered function until it is finished"
+        with logging_config(self.log_config):
+            self._finish([EMPTY_CODE, 0, None, 0], [gen])
+
+    def _finish(self, rec, records, slice=None):
+        """Runs rec and the return stack records to the end, and any green threads they start.
+        Async words are run on an event loop of their own, see wait. Returns PAUSED if it stopped at the end of slice."""
+        schedule = self._schedule(rec, records, slice)
+        try:
+            started = next(schedule)
+        except StopIteration as e:
+            return e.value
+        return wait(self._await_schedule(schedule, started))
+
+    def _schedule(self, rec, records, slice=None):
+        """Runs rec and the return stack records, switching green threads when one gives way.
+        A generator, which yields a list of coroutines of async words for its caller to start, and is
+        sent a list of (coroutine, result, exception) for those that have finished. It yields when
+        every green thread that can run is waiting for an async word.
+        If rec is None, the green thread that stopped at the end of the last slice carries on."""
+        if self._depth:
+            # Inside another _run, which is the one that switches threads, so this one just waits
+            pending = self._run(rec, records)
+            while pending is not None:
+                (_, ret, exc), = yield [pending]
+                pending = self._run(self._awaited(ret, exc, records), records)
+            return None
+        if rec is not None:
+            self._main = self.thread = GreenThread(self.stack, self.scope, records)
+        main = self._main
+        thread = self.thread
+        self.stack, self.scope = thread.stack, thread.scope
+        runnable = self.runnable
+        # The coroutines threads are waiting for, and those that haven't been started yet
+        waiting = {}
+        started = []
+        pending = None
+        try:
+            while True:
+                if thread.outcome is not None:
+                    ret, exc = thread.outcome
+                    thread.outcome = None
+                    rec = self._awaited(ret, exc, thread.records)
+                elif rec is None:
+                    rec = self._resume(thread.records)
+                pending = self._run(rec, thread.records, slice)
+                rec = None
+                if pending is PAUSED:
+                    if not waiting:
+                        return PAUSED
+                    continue
+                if pending is not None and pending is not SWITCH:
+                    # An async word
+                    if not runnable and not waiting:
+                        # Nothing else can run, so just wait for it
+                        (_, ret, exc), = yield [pending]
+                        thread.outcome = (ret, exc)
+                        continue
+                    pending = _parked(self, thread, pending)
+                    waiting[pending] = thread
+                    started.append(pending)
+                elif pending is None and thread is main:
+                    main = None
+                while not runnable:
+                    if waiting:
+                        for (coro, ret, exc) in (yield started):
+                            waiting[coro].outcome = (ret, exc)
+                            runnable.append(waiting.pop(coro))
+                        started = []
+                    elif main is None:
+                        return None
                     else:
-                        newscope = None
-                    self.scope.pushScope(newscope)
-                    self.eval(val.val)
-                    self.scope.popScope()
+                        # The program is waiting on a channel that nothing can send to
+                        if main.channel is not None:
+                            main.channel.forget(main)
+                        main.outcome = (None, DeadlockError("Every green thread is waiting on a channel!"))
+                        runnable.append(main)
+                thread = self.thread = runnable.popleft()
+                self.stack, self.scope = thread.stack, thread.scope
+        except BaseException:
+            if thread is not self._main and self._main is not None:
+                # A green thread failed, which ends the program it is part of
+                self._abandon([EMPTY_CODE, 0, None, 0], self._main.records)
+            raise
+        finally:
+            if self._main is not None:
+                self.stack, self.scope = self._main.stack, self._main.scope
+            if pending is not PAUSED:
+                self.thread = self._main = None
+
+    def _awaited(self, ret, exc, records):
+        """Returns the record to carry on with once the coroutine of an async word has returned ret
+        or raised exc. Like a registered function, an async word can return code to run in its place."""
+        if exc is not None:
+            return self._unwind(exc, [EMPTY_CODE, 0, None, 0], records)
+        return [EMPTY_CODE if ret is None else compiler.get_code(ret), 0, None, 0]
+
+    def _run(self, rec, records, slice=None):
+        """The dispatch loop.
+        Calls don't recurse in Python: the interpreter keeps its own return stack in records.
+        A code record is a list [code, pc, frame, npops], where npops is the number of scopes to
+        pop when the code is finished. A generator in records is a registered function that is
+        waiting for the code it yielded to finish. rec is the record that is running; a call in
+        tail position replaces it instead of waiting on the return stack.
+        Returns None when everything is finished, or the coroutine of an async word. The caller
+        awaits it and then calls _run again with the record from _awaited to carry on.
+        If slice is given, _run returns PAUSED after about that many instructions, leaving rec on
+        the return stack. Instructions are counted whenever a record stops running, with one more
+        for every call and return, so a slice or the budget can be overrun by the length of one
+        piece of straight-line code. Code that a registered function runs in a _run of its own (eg. with
+        eval) counts against this run's budget and slice, though that run can't stop at the end of it."""
+        self._depth += 1
+        outer = self._depth == 1
+        if outer:
+            started = time.perf_counter()
+        # Counted in units of two, the size of an instruction in ops. committed is how many of them
+        # have been added to self.instructions already
+        executed = committed = 0
+        budget = NO_LIMIT if self.budget is None else 2 * (self.budget - self.instructions)
+        limit = budget if slice is None else min(budget, 2 * slice)
+        try:
+            stack = self.stack._stack
+            push = stack.append
+            # Values from scopes are pushed through the Stack, which unboxes them if it can
+            push_value = self.stack.push if self.unboxed else push
+            unboxed = self.unboxed
+            scope = self.scope
+            scopes = scope._scopes
+            function_types = self.FUNCTION_TYPES
+            Token = tokenize.Token
+            get_code, get_wordcode = compiler.get_code, compiler.get_wordcode
+            isbuiltin, fused_ops, fusions = self._isbuiltin, FUSED_OPS, self.fusions
+            # Compiled words run their loops in Python, where instructions can't be counted
+            native = self.native and limit == NO_LIMIT
+            Block, warm = compiler.Block, codegen.warm
+            pc = start = 0
+            while True:
+                # Count the instructions the last record ran, and one more for getting to this record
+                executed += pc - start + 2
+                if executed >= limit:
+                    if executed >= budget:
+                        self._abandon(rec, records)
+                        raise BudgetExceededError("Ran more than %d instructions!" % self.budget)
+                    records.append(rec)
+                    return PAUSED
+                code, pc, frame, _ = rec
+                start = pc
+                ops, names, cache = code.ops, code.names, code.cache
+                consts = code.rawconsts if unboxed else code.consts
+                if frame is not None:
+                    slots = frame.slots
+                end = len(ops)
+                try:
+                    while pc < end:
+                        op = ops[pc]
+                        arg = ops[pc+1]
+                        pc += 2
+                        if op == PUSH_CONST:
+                            # Push any literals to the stack
+                            push(consts[arg])
+                            continue
+                        elif op == CALL:
+                            # "Call" something
+                            # Use the cached resolution of the name if nothing has redefined it since
+                            entry = cache[arg]
+                            if entry is not None and entry[0] is scope and entry[1].version == entry[2]:
+                                where = entry[3]
+                                val = entry[4] if where is None else where[names[arg]]
+                            else:
+                                val = self._resolve(names[arg], cache, arg)
+                            newscope = None
+                        elif op == LOAD_LOCAL:
+                            if frame is None:
+                                continue
+                            val = slots[arg]
+                            if val is UNBOUND:
+                                # Not defined yet, so it must come from an outer scope
+                                continue
+                            # Skip the CALL that would look it up by name
+                            pc += 2
+                            newscope = None
+                        elif op == STORE_LOCAL:
+                            if frame is None or not self._isbuiltin(names, cache, ops[pc+3], builtins.define):
+                                # Run the `name def that follows
+                                continue
+                            if not stack:
+                                raise StackUnderflowError("Stack is empty!")
+                            if slots[arg] is UNBOUND:
+                                # A new name in scope, so any cached resolution of it is out of date
+                                frame.bound += 1
+                                cell = scope._cells.get(code.localnames[arg])
+                                if cell is not None:
+                                    cell.version += 1
+                            slots[arg] = stack.pop()
+                            pc += 4
+                            continue
+                        elif op == FUSED:
+                            # A superinstruction, which is used if its words still resolve to the builtins
+                            fused, calls, constat, size = fused_ops[arg]
+                            for (at, func) in calls:
+                                if not isbuiltin(names, cache, ops[pc+at], func):
+                                    break
+                            else:
+                                if fused(self, stack, None if constat is None else code.consts[ops[pc+constat]]):
+                                    fusions[arg] += 1
+                                    pc += size
+                            continue
+                        elif op == CALL_QUALIFIED:
+                            # "Call" something from a module, eg. Mod::word
+                            # The member is bound once and reused for as long as Mod is still the same module
+                            entry = cache[arg]
+                            if (entry is not None and entry[0] is scope and entry[1].version == entry[2]
+                                    and (entry[3] is None or entry[3][names[arg][0]] is entry[5])):
+                                val = entry[4]
+                                newscope = entry[5]
+                            else:
+                                val, newscope = self._resolve_qualified(names[arg], cache, arg)
+                        else:
+                            # Create a list
+                            contents = []
+                            while True:
+                                thing = self.stack.pop()
+                                if hasattr(thing, "type") and thing.type == "lit_liststart":
+                                    break
+                                contents.append(thing)
+                            contents.reverse()
+                            push(Token("lit_list", contents))
+                            continue
+                        type_ = type(val)
+                        if type_ in function_types:
+                            # If the final value is a function, we call it. This is how extension modules work
+                            if not hasattr(val, "nustack"):
+                                self.call_external(val)
+                                continue
+                            if limit == NO_LIMIT:
+                                ret = val(self)
+                            else:
+                                # The function might run code in a _run of its own, which works out its
+                                # budget from self.instructions, so they have to be up to date
+                                executed += pc - start
+                                start = pc
+                                self.instructions += (executed >> 1) - committed
+                                committed = executed >> 1
+                                mark = self.instructions
+                                ret = val(self)
+                                nested = self.instructions - mark
+                                executed += 2 * nested
+                                committed += nested
+                            if ret is None:
+                                continue
+                            if type(ret) is GeneratorType:
+                                # The function runs code by yielding it, so it waits on the return stack
+                                rec[1] = pc
+                                records.append(rec)
+                                records.append(ret)
+                                rec = [EMPTY_CODE, 0, None, 0]
+                            elif type(ret) is CoroutineType:
+                                # An async word, which whoever is running the interpreter has to wait for
+                                rec[1] = pc
+                                records.append(rec)
+                                return ret
+                            elif ret is SWITCH:
+                                # The function made this green thread give way to another one
+                                rec[1] = pc
+                                records.append(rec)
+                                return SWITCH
+                            elif pc < end:
+                                # The function returned code to run in its place
+                                rec[1] = pc
+                                records.append(rec)
+                                rec = [get_code(ret), 0, None, 0]
+                            else:
+                                rec = [get_code(ret), 0, None, rec[3]]
+                            break
+                        elif type_ is Token and val.type == "lit_code":
+                            # We got a Nustack function, so we should call it.
+                            if native and newscope is None and type(val.val) is Block:
+                                # Run its Python version if it has one, and it can run this time
+                                func = val.val.native
+                                if func is None:
+                                    func = warm(val.val)
+                                if func and func(self, stack):
+                                    continue
+                            wordcode = get_wordcode(val.val)
+                            wordframe = Frame(wordcode) if wordcode.localnames else None
+                            if pc < end:
+                                rec[1] = pc
+                                records.append(rec)
+                                npops = 0
+                            else:
+                                # A tail call. Nothing is left to run here, so the word replaces this record,
+                                # and the scopes of this record are dropped now if nothing was defined in them
+                                npops = rec[3]
+                                while npops and not scopes[-1]:
+                                    scope.popScope()
+                                    npops -= 1
+                                if npops > 1:
+                                    # The word can still see what was defined in them, so they are collapsed
+                                    npops = self._collapse(npops, newscope)
+                            if newscope is not None:
+                                # Words from a module run with the module as their scope, with their locals on top
+                                scope.pushScope(newscope)
+                                npops += 1
+                            scope.pushScope(wordframe)
+                            rec = [wordcode, 0, wordframe, npops + 1]
+                            break
+                        else:
+                            # Else, we got a literal and we should push it on the stack
+                            push_value(val)
+                    else:
+                        # The code is finished, so go back to whatever was waiting for it
+                        for _ in range(rec[3]):
+                            scope.popScope()
+                        rec[3] = 0
+                        rec = self._resume(records)
+                        if rec is None:
+                            return
+                except BaseException as e:
+                    rec = self._unwind(e, rec, records)
+        finally:
+            self.instructions += (executed >> 1) - committed
+            self._depth -= 1
+            if outer:
+                self.walltime += time.perf_counter() - started
+
+    def _collapse(self, npops, newscope):
+        """Replaces the npops scopes at the top, which belong to a record that a tail call is replacing,
+        with as few scopes as will resolve every name the same way, so that they don't pile up with each call.
+        Adjacent local scopes are merged into one dict, and a module scope is dropped if it is
+        also higher up or is newscope, which is pushed next. Returns how many scopes are left."""
+        scope = self.scope
+        scopes = scope._scopes
+        old = scopes[-npops:]
+        seen = set() if newscope is None else {id(newscope)}
+        # Innermost first. Each item is a module scope, or a list of local scopes to merge
+        groups = []
+        for s in reversed(old):
+            if type(s) in NAMESPACE_TYPES:
+                if id(s) not in seen:
+                    seen.add(id(s))
+                    groups.append(s)
+            elif s:
+                if groups and type(groups[-1]) is list:
+                    groups[-1].append(s)
                 else:
-                    # Else, we got a literal and we should push it on the stack
-                    self.stack.push(val)
+                    groups.append([s])
+        new = []
+        for group in reversed(groups):
+            if type(group) is list:
+                if len(group) == 1:
+                    group = group[0]
+                else:
+                    merged = {}
+                    for s in group:
+                        for name in s:
+                            if name not in merged:
+                                merged[name] = s[name]
+                    group = merged
+            new.append(group)
+        if len(new) == npops and all(a is b for (a, b) in zip(new, old)):
+            return npops
+        for _ in range(npops):
+            scope.popScope()
+        for s in new:
+            scope.pushScope(s)
+        return len(new)
+
+    def _resume(self, records):
+        "Returns the next record to run from the return stack, or None if it is empty"
+        while records:
+            top = records[-1]
+            if type(top) is list:
+                return records.pop()
+            try:
+                nxt = next(top)
+            except StopIteration as e:
+                records.pop()
+                if e.value is not None:
+                    # The generator returned code to run in its place
+                    return [compiler.get_code(e.value), 0, None, 0]
+                continue
+            except BaseException:
+                records.pop()
+                raise
+            return [compiler.get_code(nxt), 0, None, 0]
+        return None
+
+    def _unwind(self, exc, rec, records):
+        """Unwinds the return stack after exc was raised while rec was running.
+        The scopes of each record are popped, and exc is thrown into each waiting generator,
+        which can handle it (eg. try). Returns the record to carry on with, or raises exc."""
+        scope = self.scope
+        for _ in range(rec[3]):
+            scope.popScope()
+        while records:
+            top = records.pop()
+            if type(top) is list:
+                for _ in range(top[3]):
+                    scope.popScope()
+                continue
+            try:
+                nxt = top.throw(exc)
+            except StopIteration as e:
+                if e.value is not None:
+                    return [compiler.get_code(e.value), 0, None, 0]
+                return [EMPTY_CODE, 0, None, 0]
+            except BaseException as e:
+                exc = e
+                continue
+            records.append(top)
+            return [compiler.get_code(nxt), 0, None, 0]
+        raise exc
+
+    def _abandon(self, rec, records):
+        "Drops rec and the return stack records without running any more of them, closing waiting generators"
+        scope = self.scope
+        for _ in range(rec[3]):
+            scope.popScope()
+        while records:
+            top = records.pop()
+            if type(top) is list:
+                for _ in range(top[3]):
+                    scope.popScope()
+            else:
+                top.close()
+
+    def _resolve(self, name, cache, idx):
+        "Looks up an unqualified name and stores where it was found in cache[idx]"
+        scope = self.scope
+        cell = scope.cell(name)
+        where = scope.find(name)
+        if where is not None:
+            cache[idx] = (scope, cell, cell.version, where, None)
+            return where[name]
+        # If it's not defined by the program, it might be a builtin. If it's not, the builtins module will raise a NotDefinedError
+        val = builtins.module.get(name)
+        if self.unboxed:
+            val = getattr(val, "unboxed", val)
+        cache[idx] = (scope, cell, cell.version, None, val)
+        return val
+
+    def _isbuiltin(self, names, cache, idx, func):
+        "Returns True if names[idx] resolves to the builtin function func"
+        if self.unboxed:
+            func = getattr(func, "unboxed", func)
+        entry = cache[idx]
+        if entry is not None and entry[0] is self.scope and entry[1].version == entry[2]:
+            return entry[3] is None and entry[4] is func
+        return self._resolve(names[idx], cache, idx) is func and cache[idx][3] is None
+
+    def _resolve_qualified(self, path, cache, idx):
+        """Looks up a qualified name that was split into path, eg. ("Seq", "nth").
+        Returns the value and the module it came from. If every step of the path is a module,
+        the result is stored in cache[idx]."""
+        head = path[0]
+        if head == "":
+            # "::attr" gets an attribute of the thing on top of the stack
+            val = self.stack.pop()
+            for name in path[1:]:
+                val = val.get(name)
+            return val, None
+        scope = self.scope
+        cell = scope.cell(head)
+        where = scope.find(head)
+        if where is None:
+            # If it's not defined by the program, it might be a builtin. If it's not, the builtins module will raise a NotDefinedError
+            val = builtins.module.get(head)
+            cache[idx] = (scope, cell, cell.version, None, val, None)
+            return val, None
+        module = val = where[head]
+        cacheable = True
+        for name in path[1:]:
+            cacheable = cacheable and type(val) in NAMESPACE_TYPES
+            val = val.get(name)
+        if cacheable:
+            if self.unboxed:
+                val = getattr(val, "unboxed", val)
+            cache[idx] = (scope, cell, cell.version, where, val, module)
+        return val, module
 
     def lookup(self, name):
         # First, if we are actually loading something from a module ("Mod::thing"), split it up around the "::"
@@ -161,37 +1174,37 @@ class Interpreter:
         else:
             # Else, we are only getting the top-leval object
             valname = [name]
-        try:
-            # First, we try to look it up through the scpes
-            if valname[0] != "":
-                val = self.scope.lookup(valname[0])
-            else:
-                val = self.stack.pop()
-        except ScopeLookupError:
-            # If it's not defined by the program, it might be a builtin. If it's not, the builtins module will raise a NotDefinedError
-            return builtins.module.get(valname[0])
-        else:
-            # The scope lookup completed without an error
-            # If len(valname) > 1, we need to lookup any sub-modules
-            if len(valname) > 1:
-                # Lookup any sub-modules
-                top = valname[0]
-                valname = valname[1:]
-                for name in valname:
-                    val = val.get(name)
-            return val
+        # First, we try to look it up through the scopes
+        if valname[0] != "":
+            where = self.scope.find(valname[0])
+            if where is None:
+                # If it's not defined by the program, it might be a builtin. If it's not, the builtins module will raise a NotDefinedError
+                return builtins.module.get(valname[0])
+            val = where[valname[0]]
+        else:
+            val = self.stack.pop()
+        # If len(valname) > 1, we need to lookup any sub-modules
+        for name in valname[1:]:
+            val = val.get(name)
+        return val
 
     def call_external(self, val):
         if hasattr(val, "nustack"):
             # This function was marked by the extension module register, so call with the interpreter
             log("call_extenal: calling registered function", val)
-            val(self)
+            # Called from outside the dispatch loop, so the function can't switch green threads
+            self._depth += 1
+            try:
+                ret = val(self)
+            finally:
+                self._depth -= 1
+            if type(ret) is CoroutineType:
+                ret = wait(ret)
+            if type(ret) is GeneratorType:
+                self._drive(ret)
+            elif ret is not None:
+                self.eval(ret)
         else:
-            numargs = getnumargs(val)
+            # The adapter knows how many arguments val takes, so it only has to be worked out once
             log("call_extenal: calling unregisted function", val)
-            log("call_extenal: num args", numargs)
-            func_args = [arg.val for arg in self.stack.popN(numargs)]
-            log("call_extenal: function args", func_args)
-            ret = val(*func_args)
-            tok = tokenize.Token("any", ret)
-            if ret is not None: self.stack.push(tok)
+            ffi.call(val, self.stack)
@@ -0,0 +1,198 @@
+#!python3
+# Nustack optimizer
+# An optional pass between tokenize and eval (nustack -O) that rewrites token lists:
+#   - literal arithmetic and comparisons are folded, eg. `2 3 +` becomes `5`
+#   - no-op pairs are removed: `swap swap` and `dup drop`
+#   - `if` with a literal condition is replaced by the body of the branch it would run
+# Words are only rewritten if they still mean the builtin, so any name that the program
+# (or a module it imports) might define is left alone. If the program defines names that
+# can not be worked out before it runs, nothing is rewritten at all.
+from nustack import cache
+from nustack.tokenize import Token
+from nustack.utils import log
+from nustack.stdlib import builtins
+
+# Builtins without side effects that can be run ahead of time on literal arguments
+FOLDABLE = {"+", "add", "-", "sub", "*", "mul", "/", "div", "%", "mod",
+            "eq", "=", "lt", "<", "gt", ">", "not", "or", "|", "and", "&",
+            "to.string", "to.int", "to.float", "to.bool"}
+# Literal types that folding accepts as arguments
+CONSTANT_TYPES = {"lit_int", "lit_float", "lit_bool", "lit_string"}
+DEFINERS = {"def", "define"}
+IMPORTERS = {"import", "imp"}
+IMPORTERS_ALL = {"import*", "imp*"}
+# Words that redefine the word whose symbol they are given, and how many arguments come after the symbol
+MEMOIZERS = {"memo": 1, "memo.sized": 2}
+# Words that run something that isn't written in the program when they are given a value that isn't a literal
+# of the type they take, eg. "de" "f" + lookup call
+INDIRECT = {"lookup": ("lit_symbol", "lit_string"), "call": ("lit_code",)}
+# Words whose meaning the analysis itself relies on
+ANALYSIS_WORDS = DEFINERS | IMPORTERS | IMPORTERS_ALL | set(MEMOIZERS) | set(INDIRECT)
+
+class _Dynamic(Exception):
+    "Raised when the names a program defines can not be worked out statically"
+
+def stack_effect(func):
+    """Returns (inputs, outputs) from a builtin's stack effect annotation, eg. "(n n -- n)" gives (2, 1).
+    Returns None if it doesn't have one."""
+    effect = getattr(func, "__annotations__", {}).get("return")
+    if not effect or "--" not in effect:
+        return None
+    ins, outs = effect.strip().strip("()").split("--")
+    return len(ins.split()), len(outs.split())
+
+class _FoldEnv:
+    "Just enough of an Interpreter to run a foldable builtin"
+    def __init__(self, args):
+        import nustack.interpreter
+        self.stack = nustack.interpreter.Stack(args)
+
+def _module_file(name, env):
+    "Returns the path to the .nu file that loadModule would load for name, or None"
+    return builtins.resolver.find(name, env)
+
+def _module_names(name, env, seen):
+    "Returns the names an imported module could define"
+    pth = _module_file(name, env)
+    if pth is not None:
+        if pth in seen:
+            return set()
+        seen.add(pth)
+        return _defined(cache.load_tokens(pth), env, seen)
+    std = name.startswith("std::")
+    pyname = ".".join(name[5:].split("::") if std else name.split("::"))
+    try:
+        return set(builtins.resolver.extension(pyname, std).module.contents)
+    except ImportError:
+        raise _Dynamic("Can not find module %s" % name)
+
+def _defined(toks, env, seen):
+    "Returns every name that toks could define, raising _Dynamic if that can't be known"
+    names = set()
+    toks = list(toks)
+    for i, tok in enumerate(toks):
+        prev = toks[i-1] if i else None
+        nxt = toks[i+1] if i + 1 < len(toks) else None
+        if tok.type == "lit_code":
+            names |= _defined(tok.val, env, seen)
+        elif (tok.type in ("lit_symbol", "lit_string") and tok.val in ANALYSIS_WORDS
+              and not (nxt is not None and nxt.type == "call" and nxt.val in DEFINERS | IMPORTERS | IMPORTERS_ALL)):
+            # Eg. `def lookup call, which defines a name the analysis can't see
+            raise _Dynamic("%s is used other than as a name to define or import" % tok.val)
+        elif tok.type == "call" and tok.val in INDIRECT:
+            if prev is None or prev.type not in INDIRECT[tok.val]:
+                raise _Dynamic("%s is used with a value that is not a literal" % tok.val)
+        elif tok.type == "call" and tok.val in MEMOIZERS:
+            nargs = MEMOIZERS[tok.val]
+            args = toks[max(i-nargs, 0):i]
+            word = toks[i-nargs-1] if i > nargs else None
+            if len(args) < nargs or not all(arg.type == "lit_int" for arg in args) or word is None:
+                raise _Dynamic("%s is used with arguments that are not literals" % tok.val)
+            if word.type == "lit_symbol":
+                names.add(word.val)
+            elif word.type != "lit_code":
+                raise _Dynamic("%s is used with a word that is not a literal" % tok.val)
+        elif tok.type == "call" and tok.val in ANALYSIS_WORDS:
+            if prev is None or prev.type not in ("lit_symbol", "lit_string"):
+                raise _Dynamic("%s is used with a name that is not a literal" % tok.val)
+            if tok.val in DEFINERS:
+                names.add(prev.val)
+            else:
+                if env is None:
+                    raise _Dynamic("Can not find modules without an interpreter")
+                modnames = _module_names(prev.val, env, seen)
+                if tok.val in IMPORTERS:
+                    name = prev.val[5:] if prev.val.startswith("std::") else prev.val
+                    names.add(name.split("::")[0])
+                # Calling a word from an imported module brings its globals into scope
+                names |= modnames
+    return names
+
+def defined_names(toks, env=None):
+    "Returns the set of names toks could define, or None if that can not be worked out"
+    try:
+        names = _defined(toks, env, set())
+    except _Dynamic as e:
+        log("optimizer: Not optimizing,", e)
+        return None
+    if names & ANALYSIS_WORDS:
+        log("optimizer: Not optimizing, the program redefines", names & ANALYSIS_WORDS)
+        return None
+    return names
+
+class Optimizer:
+    def __init__(self, redefined):
+        self.redefined = redefined
+
+    def isbuiltin(self, tok, *names):
+        "Returns True if tok is a call to one of names and it still means the builtin"
+        return tok.type == "call" and tok.val in names and tok.val not in self.redefined
+
+    def optimize(self, toks):
+        out = []
+        for tok in toks:
+            if tok.type == "lit_code":
+                tok = Token("lit_code", self.optimize(tok.val))
+            self.emit(out, tok)
+        return out
+
+    def emit(self, out, tok):
+        out.append(tok)
+        while self.reduce(out):
+            pass
+
+    def reduce(self, out):
+        "Rewrites the end of out once, returning True if anything changed"
+        last = out[-1]
+        if last.type != "call" or last.val in self.redefined:
+            return False
+        name = last.val
+        if name == "swap" and len(out) >= 2 and self.isbuiltin(out[-2], "swap"):
+            del out[-2:]
+            log("optimizer: Removed swap swap")
+            return True
+        if name == "drop" and len(out) >= 2 and self.isbuiltin(out[-2], "dup"):
+            del out[-2:]
+            log("optimizer: Removed dup drop")
+            return True
+        if name == "if" and len(out) >= 4:
+            b, t, f = out[-4:-1]
+            if b.type in CONSTANT_TYPES and t.type == "lit_code" and f.type == "lit_code":
+                del out[-4:]
+                log("optimizer: Inlined if with constant condition", b)
+                # The branch was already optimized, but its start may combine with what comes before it
+                for tok in (t.val if b.val else f.val):
+                    self.emit(out, tok)
+                return False
+        if name in FOLDABLE:
+            return self.fold(out)
+        return False
+
+    def fold(self, out):
+        func = builtins.module.contents[out[-1].val]
+        ins, outs = stack_effect(func)
+        if len(out) <= ins:
+            return False
+        args = out[-1-ins:-1]
+        if not all(arg.type in CONSTANT_TYPES for arg in args):
+            return False
+        env = _FoldEnv(args)
+        try:
+            func(env)
+        except Exception:
+            # Leave it to fail when the program is run
+            return False
+        res = env.stack._stack
+        if len(res) != outs or not all(isinstance(r, Token) and r.type.startswith("lit_") for r in res):
+            return False
+        log("optimizer: Folded", args, out[-1].val, "to", res)
+        out[-1-ins:] = res
+        return True
+
+def optimize(toks, env=None):
+    """Returns an optimized copy of the token list toks.
+    env is the Interpreter that will run it, which is used to find imported modules."""
+    redefined = defined_names(toks, env)
+    if redefined is None:
+        return list(toks)
+    return Optimizer(redefined).optimize(toks)
@@ -0,0 +1,34 @@
+#!python3
+# Nustack scheduler
+# Runs several interpreters on one thread, giving each a turn of a fixed number of instructions,
+# so a long running program can't hold up the others.
+import collections
+
+class Scheduler:
+    def __init__(self, slice=1000):
+        # How many instructions each interpreter runs per turn
+        self.slice = slice
+        self.waiting = collections.deque()
+        # (interpreter, exception or None) for each program, in the order they finished
+        self.finished = []
+
+    def add(self, interp, code):
+        "Adds an interpreter that will run code, which can be a string or a list of tokens"
+        interp.start(code)
+        self.waiting.append(interp)
+
+    def run(self):
+        "Runs every interpreter that was added until they are all finished, and returns finished"
+        waiting = self.waiting
+        while waiting:
+            interp = waiting.popleft()
+            try:
+                done = interp.step(self.slice)
+            except Exception as e:
+                self.finished.append((interp, e))
+                continue
+            if done:
+                self.finished.append((interp, None))
+            else:
+                waiting.append(interp)
+        return self.finished
@@ -1,6 +1,6 @@
 #!python3
 "IO - basic file IO\nImport with `std::IO import"
-import os.path
+import os.path, asyncio
 from nustack.extensionbase import Module, Token
 
 module = Module("std::IO")
@@ -17,24 +17,39 @@ def open_(env) -> "(s s -- file)":
 
 @module.register("readall")
 def readall(env) -> "(file -- s file)":
-    "Takes a file object, reads everything from it as a string, and returns that string and the original file object"
+    "Takes a file object, reads everything from it as a string, and returns that string and the original file object.\nBlocks every green thread while it reads; readall.async does not"
     f = env.stack.pop()
     cont = f.val.read()
     env.stack.push(Token("lit_string", cont), f)
 
+@module.register("readall.async")
+async def readall_async(env) -> "(file -- s file)":
+    "Like readall, but reads in another thread so other green threads can run meanwhile"
+    f = env.stack.pop()
+    cont = await asyncio.get_running_loop().run_in_executor(None, f.val.read)
+    env.stack.push(Token("lit_string", cont), f)
+
 @module.register("read.n")
 def readn(env) -> "(file i -- s file)":
-    "Takes a file object and an integer i, reads i charactors or bytes from it as a string, and returns that string and the original file object"
+    "Takes a file object and an integer i, reads i charactors or bytes from it as a string, and returns that string and the original file object.\nBlocks every green thread while it reads"
     f, n = env.stack.popN(2)
     cont = f.val.read(n.val)
     env.stack.push(Token("lit_string", cont), f)
 
 @module.register("write")
 def write(env) -> "(file s -- file)":
-    "Takes a file object and a string, writes that string to the file, and returns the file"
+    "Takes a file object and a string, writes that string to the file, and returns the file.\nBlocks every green thread while it writes; write.async does not"
     f, s =  env.stack.popN(2)
     f.val.write(s.val)
     env.stack.push(f)
+
+@module.register("write.async")
+async def write_async(env) -> "(file s -- file)":
+    "Like write, but writes in another thread so other green threads can run meanwhile"
+    f, s = env.stack.popN(2)
+    await asyncio.get_running_loop().run_in_executor(None, f.val.write, s.val)
+    env.stack.push(f)
+
 @module.register("close")
 def close(env) -> "(file -- )":
     "Takes a file object and closes it. Returns nothing"
@@ -5,7 +5,7 @@ Import with `std::Path import
 In this module, `path` always refers to a string that is a pathname."""
 
 import os, os.path, glob
-from nustack.extensionbase import Module, Token
+from nustack.extensionbase import Module, Token, boolean, integer
 module = Module("std::Path")
 
 
@@ -70,27 +70,27 @@ def dirname(env) -> "(path -- path)":
 @module.register("exists?")
 def exists(env) -> "(path -- bool)":
     "Returns #t if path exists."
-    env.stack.push(Token("lit_bool", os.path.exists(env.stack.pop().val)))
+    env.stack.push(boolean(os.path.exists(env.stack.pop().val)))
 
 @module.register("size")
 def size(env) -> "(path -- int)":
     "Returns the size of the file given by path in bytes"
-    env.stack.push(Token("lit_int", os.path.getsize(env.stack.pop().val)))
+    env.stack.push(integer(os.path.getsize(env.stack.pop().val)))
 
 @module.register("is.dir?")
 def is_dir(env) -> "(path -- bool)":
     "Returns #t if path is a directory"
-    env.stack.push(Token("lit_bool", os.path.isdir(env.stack.pop().val)))
+    env.stack.push(boolean(os.path.isdir(env.stack.pop().val)))
 
 @module.register("is.file?")
 def is_file(env) -> "(path -- bool)":
     "Returns #t if path is a file"
-    env.stack.push(Token("lit_bool", os.path.isfile(env.stack.pop().val)))
+    env.stack.push(boolean(os.path.isfile(env.stack.pop().val)))
 
 @module.register("is.link?")
 def is_link(env) -> "(path -- bool)":
     "Returns #t if path is a directory entry that is a symbolic link"
-    env.stack.push(Token("lit_bool", os.path.islink(env.stack.pop().val)))
+    env.stack.push(boolean(os.path.islink(env.stack.pop().val)))
 
 @module.register("glob")
 def glob_(env) -> "(pattern -- list)":
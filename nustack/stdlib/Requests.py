@@ -17,6 +17,7 @@ module = Module("std::Requests")
 
 import requests
 import urllib.parse
+import asyncio
 
 def wrap_req(req):
     return Token("request_obj", req)
@@ -28,6 +29,13 @@ def get(env) -> "(url -- response_object)":
     req = wrap_req(requests.get(url))
     env.stack.push(req)
 
+@module.register("get.async")
+async def get_async(env) -> "(url -- response_object)":
+    "Like get, but makes the request in another thread so other green threads can run meanwhile"
+    url = env.stack.pop().val
+    req = wrap_req(await asyncio.get_running_loop().run_in_executor(None, requests.get, url))
+    env.stack.push(req)
+
 @module.register("head")
 def get(env) -> "(url -- response_object)":
     "Returns a request object that represents a HEAD request to the given url"
@@ -1,7 +1,7 @@
 #!python3
 "Seq - Sequence operations\nImport with `std::Seq import"
 
-from nustack.extensionbase import Module, Token
+from nustack.extensionbase import Module, Token, boolean, integer, literal
 module = Module("std::Seq")
 
 @module.register("nth")
@@ -37,7 +37,7 @@ def slice_(env) -> "(sequence1 n1 n2 -- sequence2)":
     "Slices a seuence from n1 to n2"
     seq, n1, n2 = env.stack.popN(3)
     t = seq.type
-    env.stack.push(Token(t, seq.val[n1.val:n2.val]))
+    env.stack.push(literal(t, seq.val[n1.val:n2.val]))
 
 @module.register("set.nth")
 def set_nth(env) -> "(sequence a n -- sequence)":
@@ -74,27 +74,27 @@ def reverse_(env) -> "(sequence1 -- sequence2)":
 def range_(env) -> "(n n -- l)":
     start, stop = env.stack.popN(2)
     step = 1 if start.val < stop.val else -1
-    res = [Token("lit_int", i) for i in range(start.val, stop.val, step)]
+    res = [integer(i) for i in range(start.val, stop.val, step)]
     env.stack.push(Token("lit_list", res))
 
 @module.register("range.step")
 def range_step(env) -> "(n n -- l)":
     start, stop, step = env.stack.popN(3)
-    res = [Token("lit_int", i) for i in range(start.val, stop.val, step.val)]
+    res = [integer(i) for i in range(start.val, stop.val, step.val)]
     env.stack.push(Token("lit_list", res))
 
 @module.register("length", "len")
 def length(env) -> "(sequence -- i)":
     "Return the length of a sequence"
     seq = env.stack.pop().val
-    env.stack.push(Token("lit_int", len(seq)))
+    env.stack.push(integer(len(seq)))
 
 @module.register("contains")
 def contains(env) -> "(sequence a -- b)":
     "Returns #t if the sequence contains a.\nDo not use this for string, use String::contains instead."
     seq, thing = env.stack.popN(2)
     b = thing in seq.val
-    env.stack.push(Token("lit_bool", b))
+    env.stack.push(boolean(b))
 
 @module.register("repeat")
 def repeat(env) -> "(sequence1 i -- sequence2)":
@@ -127,4 +127,4 @@ def unpack(env) -> "(sequence -- a...)":
         seq = [Token("lit_string", c) for c in seq.val]
     else:
         seq = seq.val
-    env.stack.push(*seq)
+    env.stack.pushN(seq)
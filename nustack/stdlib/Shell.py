@@ -3,7 +3,7 @@
 from nustack.extensionbase import Module, Token
 module = Module("std::Shell")
 
-import subprocess, shlex, sys
+import subprocess, shlex, sys, asyncio
 
 if sys.platform == "win32":
     out = subprocess.check_output("chcp", shell=True)
@@ -22,7 +22,8 @@ def encoding(env) -> "( -- s)":
 def run(env) -> "(s1 -- l)":
     """Runs s1 as a shell command string and returns a two item list [return-code output]
     Note that this run using the subprocess module with shell=False,
-    so if you need to use a built in shell command use run.shell"""
+    so if you need to use a built in shell command use run.shell.
+    Blocks every green thread until the command exits; run.async does not"""
     args = env.stack.pop().val
     args = shlex.split(args)
     try:
@@ -37,10 +38,23 @@ def run(env) -> "(s1 -- l)":
         ret = e.returncode
     env.stack.push(Token('lit_list', [Token('lit_int', ret), Token('lit_string', out.decode(enc))]))
 
+@module.register("run.async")
+async def run_async(env) -> "(s1 -- l)":
+    "Like run, but waits for the command on the event loop so other green threads can run meanwhile"
+    args = shlex.split(env.stack.pop().val)
+    proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+    )
+    out, _ = await proc.communicate()
+    env.stack.push(Token('lit_list', [Token('lit_int', proc.returncode), Token('lit_string', out.decode(enc))]))
+
 @module.register("run.shell")
 def run_shell(env) -> "(s1 -- l)":
     """Runs s1 as a shell command string and returns a two item list [return-code output]
-    Note that this run using the subprocess module with shell=True, which can be a security risk!"""
+    Note that this run using the subprocess module with shell=True, which can be a security risk!
+    Blocks every green thread until the command exits"""
     args = env.stack.pop().val
     args = shlex.split(args)
     try:
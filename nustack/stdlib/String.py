@@ -1,7 +1,7 @@
 #!python3
 "String - String utils and constants\nImport with `std::String import"
 import string
-from nustack.extensionbase import Module, Token
+from nustack.extensionbase import Module, Token, boolean
 module = Module("std::Seq")
 
 def strtok(val):
@@ -37,7 +37,7 @@ def contains(env) -> "(s1 s2 -- b)":
     "Returns #t if the string s1 contains s2.\nDo not use this for arbitary sequences, use Seq::contains instead."
     s1, s2 = env.stack.popN(2)
     b = s2.val in s1.val
-    env.stack.push(Token("lit_bool", b))
+    env.stack.push(boolean(b))
 
 @module.register("replace")
 def replace(env) -> "(s1 s2 s3 -- s4)":
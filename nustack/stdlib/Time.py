@@ -1,6 +1,6 @@
 #!python3
 "Time - time wrapper for Nustack\nImport with`std::Time import"
-import time
+import time, asyncio
 from nustack.extensionbase import Module, Token
 
 module = Module("std::Time")
@@ -12,10 +12,16 @@ def time_(env) -> "( -- f)":
 
 @module.register("sleep")
 def sleep(env) -> "(n -- )":
-    "Sleeps for n seconds"
+    "Sleeps for n seconds, blocking every green thread; sleep.async does not"
     n = env.stack.pop().val
     time.sleep(n)
 
+@module.register("sleep.async")
+async def sleep_async(env) -> "(n -- )":
+    "Sleeps for n seconds, letting other tasks run meanwhile if the interpreter was run with eval_async"
+    n = env.stack.pop().val
+    await asyncio.sleep(n)
+
 @module.register("ctime")
 def ctime(env) -> "(n -- s)":
     "Converts n, the number of seconds since the epoch to a human readable time string"
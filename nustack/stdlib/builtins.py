@@ -2,8 +2,18 @@
 "Nustack Standard Library\nYou don't need to import this, it is loaded automatically."
 import os
 import importlib
-from nustack.extensionbase import Module, Token
+import operator
+import collections
+import atexit
+import threading
+import time
+import asyncio
+import contextvars
+import concurrent.futures
+from nustack.extensionbase import Module, Token, boolean, integer, literal, hashkey
 import nustack.interpreter
+from nustack import cache, ffi
+from nustack.green import Channel, SWITCH
 from nustack.utils import log
 import nustack.stdlib; stddir = os.path.dirname(nustack.stdlib.__file__); del nustack.stdlib
 
@@ -16,6 +26,10 @@ class ScopeWrapper:
         return "ScopeWrapper: " + repr(self.scope)
     def __iter__(self):
         return iter(self.scope)
+    def __contains__(self, name):
+        return name in self.scope
+    def __len__(self):
+        return len(self.scope)
     def __getitem__(self, name):
         return self.get(name)
 
@@ -92,21 +106,21 @@ def plus(env) -> "(n n -- n)":
     "Adds two numbers"
     a, b = env.stack.popN(2)
     t = a.type
-    env.stack.push(Token(t, a.val + b.val))
+    env.stack.push(literal(t, a.val + b.val))
 
 @module.register("-", "sub")
 def sub(env) -> "(n n -- n)":
     "Subtracts 2 numbers"
     a, b = env.stack.popN(2)
     t = a.type
-    env.stack.push(Token(t, a.val - b.val))
+    env.stack.push(literal(t, a.val - b.val))
 
 @module.register("*", "mul")
 def mul(env) -> "(n n -- n)":
     'Multiplies 2 numbers'
     a, b = env.stack.popN(2)
     t = a.type
-    env.stack.push(Token(t, a.val * b.val))
+    env.stack.push(literal(t, a.val * b.val))
 
 @module.register("/", "div")
 def div(env) -> "(n n -- n)":
@@ -125,7 +139,7 @@ def eq_(env) -> "(a1 a2 -- b)":
     "Returns true if the top two values on the stack equal each other"
     a, b = env.stack.popN(2)
     eq = a == b
-    env.stack.push(Token("lit_bool", eq))
+    env.stack.push(boolean(eq))
 
 @module.register("lt", "<")
 def lt_(env) -> "(a1 a2 -- b)":
@@ -135,7 +149,7 @@ def lt_(env) -> "(a1 a2 -- b)":
         val = a < b
     except TypeError:
         val = False
-    env.stack.push(Token("lit_bool", val))
+    env.stack.push(boolean(val))
 
 @module.register("gt", ">")
 def lt_(env) -> "(a1 a2 -- b)":
@@ -145,13 +159,13 @@ def lt_(env) -> "(a1 a2 -- b)":
         val = a > b
     except TypeError:
         val = False
-    env.stack.push(Token("lit_bool", val))
+    env.stack.push(boolean(val))
 
 @module.register("not")
 def not_(env) -> "(b1 -- b)":
     "Returns true if b1 and b2 are true"
     b1 = env.stack.pop()
-    env.stack.push(Token("lit_bool", not b1.val))
+    env.stack.push(boolean(not b1.val))
 
 @module.register("or", "|")
 def or_(env) -> "(b1 b2 -- b)":
@@ -170,9 +184,9 @@ def if_(env) -> "(b c c -- )":
     'Performs if branching'
     b, t, f = env.stack.popN(3)
     if b.val:
-        env.eval(t.val)
+        return t.val
     else:
-        env.eval(f.val)
+        return f.val
 @module.register("cond")
 def cond_(env) -> "(l -- )":
     """Takes a list of 2 item lists.
@@ -181,10 +195,9 @@ def cond_(env) -> "(l -- )":
     which must be a code object, is run."""
     conds = env.stack.pop().val
     for cond in conds:
-        env.eval(cond.val[0].val)
+        yield cond.val[0].val
         if env.stack.pop().val:
-            env.eval(cond.val[1].val)
-            break
+            return cond.val[1].val
 
 @module.register("define", "def")
 def define(env) -> "(a s -- )":
@@ -203,7 +216,7 @@ def show_scopes(env) -> "( -- )":
 
 @module.register("input", "in")
 def input_(env) -> "(a -- s)":
-    'Shows a, prompts for input, and returns it as a string'
+    'Shows a, prompts for input, and returns it as a string. Blocks every green thread while it waits'
     a = env.stack.pop().val
     s = input(a)
     env.stack.push(Token("lit_string", s))
@@ -224,7 +237,7 @@ def to_int(env) -> "(a -- i)":
     'Pops a value a from the stack and converts it to an int'
     a = env.stack.pop().val
     v = int(a)
-    env.stack.push(Token("lit_int", v))
+    env.stack.push(integer(v))
 
 @module.register("to.float")
 def to_float(env) -> "(a -- f)":
@@ -249,39 +262,71 @@ def to_bool(env) -> "(a -- b)":
     'Pops a value a from the stack and converts it to a bool'
     a = env.stack.pop().val
     v = bool(a)
-    env.stack.push(Token("lit_bool", v))
+    env.stack.push(boolean(v))
 
 @module.register("swap")
 def swap(env) -> "(a1 a2 -- a2 a1)":
     "Swaps the two things on top of the stack"
-    a, b = env.stack.popN(2)
-    env.stack.push(b, a)
+    env.stack.roll(1)
 
 @module.register("drop")
 def drop(env) -> "(a -- )":
     "Pops the top of the stack"
-    env.stack.pop()
+    env.stack.drop()
 
 @module.register("dup")
 def dub(env) -> "(a -- a a)":
     "Duplicates the top of the stack"
-    a = env.stack.pop()
-    env.stack.push(a, a)
+    env.stack.pick(0)
 
 @module.register("over")
 def over(env) -> "(a1 a2 -- a1 a2 a1)":
     "Adds the item next to the top of the stack to the top of the stack"
-    a, b = env.stack.popN(2)
-    env.stack.push(a, b, a)
+    env.stack.pick(1)
 
 
 @module.register("rot")
 def rot(env) -> "(a1 a2 a3 -- a2 a3 a1)":
     "Rotates the top 3 items on the stack"
-    a1, a2, a3 = env.stack.popN(3)
-    env.stack.push(a2, a3, a1)
-
-shouldbreak = False
+    env.stack.roll(2)
+
+# Unboxed versions of the most used words, for interpreters that keep plain values on the stack
+# (see interpreter.UnboxedStack). They work on the values in the stack list directly,
+# and leave anything they don't handle, like Tokens or a short stack, to the boxed word.
+NUMBERS = frozenset((int, float))
+
+def unboxedop(name, op, strings=False):
+    "Registers op as the unboxed version of the binary operator word name"
+    boxed = module.get(name)
+    @module.unboxed(boxed)
+    def unboxed(env):
+        s = env.stack._stack
+        if len(s) > 1:
+            ta, tb = type(s[-2]), type(s[-1])
+            if (ta in NUMBERS and tb in NUMBERS) or (strings and ta is tb is str):
+                # Both are popped before op runs, as the boxed word does, so a failing op consumes them too
+                b = s.pop()
+                a = s.pop()
+                s.append(op(a, b))
+                return
+        return boxed(env)
+
+unboxedop("+", operator.add, strings=True)
+unboxedop("-", operator.sub)
+unboxedop("*", operator.mul)
+unboxedop("/", operator.truediv)
+unboxedop("%", operator.mod)
+unboxedop("eq", operator.eq, strings=True)
+unboxedop("lt", operator.lt, strings=True)
+unboxedop("gt", operator.gt, strings=True)
+
+@module.unboxed(not_)
+def not_unboxed(env):
+    s = env.stack._stack
+    if s and type(s[-1]) in nustack.interpreter.UNBOXED_TYPES:
+        s[-1] = not s[-1]
+    else:
+        not_(env)
 
 @module.register("for.each")
 def for_each(env) -> "(sequence c -- )":
@@ -292,14 +337,14 @@ def for_each(env) -> "(sequence c -- )":
             env.stack.push(item)
         else:
             env.stack.push(Token("lit_any", item))
-        env.eval(code.val)
+        yield code.val
 
 @module.register("repeat.n")
 def for_each(env) -> "(cn -- )":
     "Calls c n times"
     code, n = env.stack.popN(2)
     for i in range(n.val):
-        env.eval(code.val)
+        yield code.val
 
 @module.register("map")
 def map_(env) -> "(sequence1 c -- sequence2)":
@@ -311,7 +356,7 @@ def map_(env) -> "(sequence1 c -- sequence2)":
             env.stack.push(item)
         else:
             env.stack.push(Token("lit_any", item))
-        env.eval(code.val)
+        yield code.val
         res.append(env.stack.pop())
     env.stack.push(Token("lit_list", res))
 
@@ -326,12 +371,102 @@ def filter_(env) -> "(sequence1 c -- sequence2)":
         else:
             item = Token("lit_any", item)
         env.stack.push(item)
-        env.eval(code.val)
+        yield code.val
         cond = env.stack.pop().val
         if cond:
             res.append(item)
     env.stack.push(Token("lit_list", res))
 
+# The pools of worker processes map.parallel and filter.parallel use, by number of workers
+_pools = {}
+
+def getpool(workers):
+    "Returns a multiprocessing pool of workers processes, which is started the first time it is needed"
+    pool = _pools.get(workers)
+    if pool is None:
+        import multiprocessing
+        pool = _pools[workers] = multiprocessing.Pool(workers)
+    return pool
+
+@atexit.register
+def closepools():
+    for pool in _pools.values():
+        pool.terminate()
+    _pools.clear()
+
+def shareddefs(env):
+    """Returns the names in scope that are defined as code or plain values, which can be sent to worker processes,
+    and the names of the extension modules that are imported, which the workers import themselves"""
+    defs = {}
+    imports = {}
+    for scope in env.scope._scopes:
+        for (name, val) in scope.items():
+            if type(val) is Token and val.type.startswith("lit_") and val.type != "lit_any":
+                defs[name] = val
+            elif type(val) is Module and val.modname:
+                imports[name] = val.modname
+    return defs, imports
+
+def runchunk(job):
+    """Runs code on each item of a chunk in a worker process, and returns the results.
+    Values go back and forth without their Tokens where they can, so there is less to pickle."""
+    code, (defs, imports), items, filtering = job
+    interp = nustack.interpreter.Interpreter()
+    for (name, modname) in imports.items():
+        interp.scope.assign(name, loadModule(interp, modname)[1])
+    interp.scope._scopes[0].update(defs)
+    stack = interp.stack
+    results = []
+    for item in items:
+        stack.push(ffi.totoken(item))
+        interp.eval(code)
+        res = stack.pop()
+        results.append(bool(res.val) if filtering else ffi.unbox(res))
+    return results
+
+def parallel(env, filtering, chunksize=0, workers=0):
+    """Runs the code object on top of the stack on each item of the sequence under it in a pool of
+    worker processes, in chunks of chunksize items. Returns the results in the order of the items.
+    Each worker runs the code in an interpreter of its own, which only has the definitions from shareddefs."""
+    seq, code = env.stack.popN(2)
+    items = [ffi.unbox(item) for item in seq.val]
+    if not items:
+        return []
+    workers = workers or os.cpu_count() or 1
+    chunksize = chunksize or max(1, len(items) // (workers * 4))
+    defs = shareddefs(env)
+    jobs = [(code.val, defs, items[i:i+chunksize], filtering) for i in range(0, len(items), chunksize)]
+    results = []
+    for chunk in getpool(workers).map(runchunk, jobs):
+        results.extend(chunk)
+    if filtering:
+        return [item for (item, keep) in zip(seq.val, results) if keep]
+    return [ffi.totoken(res) for res in results]
+
+@module.register("map.parallel")
+def map_parallel(env) -> "(sequence1 c -- sequence2)":
+    """Like map, but runs c on the items in a pool of worker processes, one for each CPU.
+    c can use the words and values defined in scope and the extension modules that are imported,
+    but not Nustack modules or Python functions."""
+    env.stack.push(Token("lit_list", parallel(env, False)))
+
+@module.register("map.parallel.with")
+def map_parallel_with(env) -> "(sequence1 c i1 i2 -- sequence2)":
+    "Like map.parallel, but sends the items to i2 workers in chunks of i1 items. 0 means the default for either"
+    chunksize, workers = env.stack.popN(2)
+    env.stack.push(Token("lit_list", parallel(env, False, chunksize.val, workers.val)))
+
+@module.register("filter.parallel")
+def filter_parallel(env) -> "(sequence1 c -- sequence2)":
+    "Like filter, but runs c on the items in a pool of worker processes, as map.parallel does"
+    env.stack.push(Token("lit_list", parallel(env, True)))
+
+@module.register("filter.parallel.with")
+def filter_parallel_with(env) -> "(sequence1 c i1 i2 -- sequence2)":
+    "Like filter.parallel, but sends the items to i2 workers in chunks of i1 items. 0 means the default for either"
+    chunksize, workers = env.stack.popN(2)
+    env.stack.push(Token("lit_list", parallel(env, True, chunksize.val, workers.val)))
+
 @module.register("reduce")
 def reduce_(env) -> "(sequence1 a c -- a)":
     "Reduces a sequence to a single value"
@@ -342,127 +477,322 @@ def reduce_(env) -> "(sequence1 a c -- a)":
         else:
             item = Token("lit_any", item)
         env.stack.push(start, item)
-        env.eval(code.val)
+        yield code.val
         start = env.stack.pop()
     env.stack.push(start)
 
 @module.register("forever")
 def forever(env) -> "(c -- )":
     "Executes a code object repeatedly forever"
-    global shouldbreak
     code = env.stack.pop().val
     while True:
-        if shouldbreak:
-            shouldbreak = False
+        if env.shouldbreak:
+            env.shouldbreak = False
             break
-        env.eval(code)
+        yield code
 
 @module.register("break")
 def break_(env) -> "( -- )":
     "Breaks out of a loop"
-    global shouldbreak
-    shouldbreak = True
+    env.shouldbreak = True
 
 @module.register("while")
 def while_(env) -> "(c c -- )":
     '''Pops two code objects. While running the first code object results in #t, the second code object is run.
     The second code object might not run at all'''
-    global shouldbreak
     cond, code = env.stack.popN(2)
     while True:
-        env.eval(cond.val)
-        if not env.stack.pop().val or shouldbreak:
-            shouldbreak = False
+        yield cond.val
+        if not env.stack.pop().val or env.shouldbreak:
+            env.shouldbreak = False
             break
-        env.eval(code.val)
+        yield code.val
 
 @module.register("do.while")
 def do_while_(env) -> "(c c -- )":
     '''Pops two code objects. While running the first code object results in #t, the second code object is run.
     The second code object is run at least once.'''
-    global shouldbreak
     cond, code = env.stack.popN(2)
-    env.eval(code.val)
+    yield code.val
     while True:
-        env.eval(cond.val)
-        if not env.stack.pop().val or shouldbreak:
-            shouldbreak = False
+        yield cond.val
+        if not env.stack.pop().val or env.shouldbreak:
+            env.shouldbreak = False
             break
-        env.eval(code.val)
+        yield code.val
+
+class Resolver:
+    """Finds the files and extension modules that imports refer to, remembering what it has looked at.
+    The listing of a directory is read again if its mtime has changed. That is checked at most once every
+    interval seconds while files are found in it, and always before a file is reported missing.
+    Which extension module a name is, or that no module by that name exists, is remembered until clear."""
+    interval = 1.0
+
+    def __init__(self):
+        # The last NUSTACKPATH that was parsed, and its directories
+        self.envpath = (None, [])
+        # directory -> (mtime, names in it, when the mtime was checked)
+        self.listings = {}
+        # (name, std) -> the name of the Python module it is, or None if it isn't one
+        self.extensions = {}
+        self.lock = threading.Lock()
+
+    def searchpath(self, env):
+        "Returns the directories to look for Nustack modules in: env's directory, then NUSTACKPATH"
+        raw = os.environ.get("NUSTACKPATH", "")
+        if raw != self.envpath[0]:
+            dirs = [path.strip().rstrip(os.path.sep) for path in raw.split(os.path.pathsep)]
+            self.envpath = (raw, [path for path in dirs if path])
+        return [env.getDir()] + self.envpath[1]
+
+    def listing(self, dirname, fresh=False):
+        """Returns the names in the directory dirname, or nothing if it doesn't exist.
+        If fresh is True, the mtime is checked however recently it was."""
+        now = time.monotonic()
+        entry = self.listings.get(dirname)
+        if entry is not None and not fresh and now - entry[2] < self.interval:
+            return entry[1]
+        try:
+            mtime = os.stat(dirname).st_mtime_ns
+        except OSError:
+            mtime = None
+        if entry is not None and entry[0] == mtime:
+            names = entry[1]
+        elif mtime is None:
+            names = frozenset()
+        else:
+            try:
+                names = frozenset(os.listdir(dirname))
+            except OSError:
+                names = frozenset()
+        with self.lock:
+            self.listings[dirname] = (mtime, names, now)
+        return names
+
+    def findfile(self, namesplit, dirs):
+        "Returns the path of the .nu file for the module namesplit in the first of dirs that has it, or None"
+        fname = namesplit[-1] + ".nu"
+        # A listing can be up to interval seconds old, so a file that isn't in them may just be new
+        for fresh in (False, True):
+            for dirname in dirs:
+                for part in namesplit[:-1]:
+                    if part not in self.listing(dirname, fresh):
+                        break
+                    dirname = os.path.join(dirname, part)
+                else:
+                    if fname in self.listing(dirname, fresh):
+                        return os.path.join(dirname, fname)
+        return None
+
+    def find(self, name, env):
+        "Returns the path of the .nu file that importing name would load, or None"
+        if name.startswith("std::"):
+            return self.findfile(name[5:].split("::"), [stddir])
+        return self.findfile(name.split("::"), self.searchpath(env))
+
+    def extension(self, name, std=False):
+        """Imports and returns the Python module for the extension module name (eg. Foo.Bar).
+        It is looked for in the nu_ext package, then as nu_ext_name, then in the stdlib, or only
+        in the stdlib if std is True. Raises ImportError if there isn't one."""
+        key = (name, std)
+        if key in self.extensions:
+            modname = self.extensions[key]
+            if modname is None:
+                raise ImportError("No extension module named %s" % name)
+            return importlib.import_module(modname)
+        candidates = ["nustack.stdlib.%s"] if std else ["nu_ext.%s", "nu_ext_%s", "nustack.stdlib.%s"]
+        for pattern in candidates:
+            try:
+                m = importlib.import_module(pattern % name)
+            except ModuleNotFoundError as e:
+                # Only a module that isn't there means try the next one. An error raised while importing
+                # one that is there is passed on, and not remembered
+                modname = pattern % name
+                if e.name is None or not (modname == e.name or modname.startswith(e.name + ".")):
+                    raise
+                continue
+            log("loadModule: Loading extension module", name, "as", pattern % name)
+            self.extensions[key] = pattern % name
+            return m
+        self.extensions[key] = None
+        raise ImportError("No extension module named %s" % name)
+
+    def clear(self):
+        "Forgets everything, eg. after modules have been installed"
+        with self.lock:
+            self.envpath = (None, [])
+            self.listings.clear()
+            self.extensions.clear()
+
+resolver = Resolver()
 
 def getsearchpath(env):
-    nupath = os.environ.get("NUSTACKPATH", "").split(os.path.pathsep)
-    nupath.insert(0, env.getDir())
-    return [path.strip().rstrip(os.path.sep) for path in nupath if path]
-
-def loadModule(env, name):
-    "Returns a module"
-    curdir = env.getDir()
+    return resolver.searchpath(env)
+
+class ModuleCache:
+    """The Nustack modules that have been loaded in this process, by absolute path, so that each one only runs once
+    however many times it is imported. An entry is used for as long as the file's mtime and size are the same.
+    Like Python modules, a module is shared by everything in the process that imports it, including other
+    Interpreters, threads, and the programs a batch worker runs one after another. Its scope can't be changed
+    by an importer, but a list or other mutable value it defines is the same value for all of them.
+    clear forgets every module, for programs that must each get new ones."""
+    def __init__(self):
+        # path -> ((mtime, size), ScopeWrapper)
+        self.modules = {}
+        self.hits = 0
+        self.misses = 0
+        # Held while a module runs with load, so other threads wait for it instead of running it too.
+        # It is reentrant, since a module can import other modules.
+        self.lock = threading.RLock()
+        # path -> a Future that is done once load_async has run the module. The lock isn't held while
+        # load_async awaits, so other tasks and threads wait for this instead
+        self.loading = {}
+
+    def isloaded(self, path):
+        """Returns True if the module at path is loaded and hasn't changed.
+        A module that load_async is running is only loaded for the imports it makes itself."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        entry = self.modules.get(path)
+        if path in self.loading and path not in _loadchain.get():
+            return False
+        return entry is not None and entry[0] == (st.st_mtime_ns, st.st_size)
+
+    def _begin(self, path):
+        """Returns (path, scope, interp, toks) for the module at path, where interp is the Interpreter to run
+        the tokens toks in, or None if the module is loaded already. Called with the lock held."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        entry = self.modules.get(path)
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return path, entry[1], None, None
+        self.misses += 1
+        toks = cache.load_tokens(path)
+        interp = nustack.interpreter.Interpreter()
+        scope = ScopeWrapper(interp.scope._scopes[0])
+        # Added before the module runs, so a module it imports that imports it back gets it as it is so far
+        self.modules[path] = (key, scope)
+        return path, scope, interp, toks
+
+    def load(self, path):
+        "Returns the scope of the module at path, running the module first if it isn't loaded or has changed"
+        path = os.path.abspath(path)
+        pending = self.loading.get(path)
+        if pending is not None and path not in _loadchain.get() and not nustack.interpreter.looprunning():
+            # load_async is running it on an event loop in another thread
+            pending.result()
+        with self.lock:
+            path, scope, interp, toks = self._begin(path)
+            if interp is not None:
+                try:
+                    interp.eval(toks)
+                except BaseException:
+                    del self.modules[path]
+                    raise
+            return scope
+
+    async def load_async(self, path):
+        """Like load, but the module is run with eval_async, so the async words it calls are awaited
+        on the event loop that is running. Other tasks that import it meanwhile wait until it has run,
+        and only the modules it imports itself get it as it is so far."""
+        path = os.path.abspath(path)
+        while True:
+            with self.lock:
+                pending = self.loading.get(path)
+                if pending is None or path in _loadchain.get():
+                    path, scope, interp, toks = self._begin(path)
+                    if interp is None:
+                        return scope
+                    done = self.loading[path] = concurrent.futures.Future()
+                    break
+            # Shielded, so a task that is cancelled while it waits doesn't cancel the Future for the others
+            await asyncio.shield(asyncio.wrap_future(pending))
+        chain = _loadchain.set(_loadchain.get() + (path,))
+        try:
+            await interp.eval_async(toks)
+        except BaseException:
+            with self.lock:
+                del self.modules[path]
+            raise
+        finally:
+            _loadchain.reset(chain)
+            with self.lock:
+                del self.loading[path]
+            done.set_result(None)
+        return scope
+
+    def info(self):
+        "Returns the hits, misses and number of loaded modules"
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.modules)}
+
+    def clear(self):
+        "Forgets every module, so they run again the next time they are imported"
+        with self.lock:
+            self.modules.clear()
+
+modules = ModuleCache()
+# The paths of the modules that load_async is running, which the code running now was imported by
+_loadchain = contextvars.ContextVar("_loadchain", default=())
+
+def findModule(env, name):
+    "Returns the parts of the module name, and the path of its .nu file or None if it is an extension module"
     if name.startswith("std::"):
         usestd = True
         name = name[5:]
     else:
         usestd = False
     namesplit = name.split("::")
-    try:
-        if usestd:
-            log("loadModule: Force loading stdlib", os.path.join(stddir, *namesplit) + ".nu")
-            f = open(os.path.join(stddir, *namesplit) + '.nu', "r")
-            code = f.read()
-            f.close()
-            interp = nustack.interpreter.Interpreter()
-            _, s = interp.run(code)
-            scope = ScopeWrapper(s._scopes[0])
-            return namesplit, scope
-        nupath = getsearchpath(env)
+    if usestd:
+        pth = resolver.findfile(namesplit, [stddir])
+    else:
+        nupath = resolver.searchpath(env)
         log("loadModule: Module Search Path =", nupath)
-        for pth in nupath:
-            pth = os.path.join(pth, *namesplit) + ".nu"
-            log("loadModule: Trying to load", pth)
-            if os.path.exists(pth):
-                f = open(pth, "r")
-                code = f.read()
-                f.close()
-                interp = nustack.interpreter.Interpreter()
-                _, s = interp.run(code)
-                scope = ScopeWrapper(s._scopes[0])
-                return namesplit, scope
-        raise IOError()
-    except IOError:
-        log("loadModule: Couldn't find nustack module, trying extensions...")
-        name = ".".join(namesplit)
-        if usestd:
-            m = importlib.import_module("nustack.stdlib.%s" % name)
-            log("loadModule: Force loading stdlib", name)
-        else:
-            try:
-                m = importlib.import_module("nu_ext.%s" % name )
-                log("loadModule: Loading extension module", name, "in nu_ext package")
-            except ImportError:
-                try:
-                    m = importlib.import_module("nu_ext_%s" % name)
-                    log("loadModule: Loading extension module", name, "with nu_ext prefix")
-                except ImportError:
-                    m = importlib.import_module("nustack.stdlib.%s" % name)
-                    log("loadModule: Loading stdlib", name)
-        return namesplit, m.module
+        pth = resolver.findfile(namesplit, nupath)
+    return namesplit, pth, usestd
+
+def loadModule(env, name):
+    "Returns a module"
+    namesplit, pth, usestd = findModule(env, name)
+    if pth is not None:
+        log("loadModule: Loading", pth)
+        return namesplit, modules.load(pth)
+    log("loadModule: Couldn't find nustack module, trying extensions...")
+    m = resolver.extension(".".join(namesplit), usestd)
+    return namesplit, m.module
+
+def importModule(env, name, bind):
+    """Loads the module name and calls bind(namesplit, module).
+    If the module has to be run while an event loop is running (eg. the program was run with eval_async),
+    returns a coroutine that does it instead. The interpreter awaits that, so the async words the
+    module calls are awaited on that loop rather than on one of their own."""
+    namesplit, pth, usestd = findModule(env, name)
+    if pth is not None and nustack.interpreter.looprunning() and not modules.isloaded(pth):
+        async def load():
+            log("loadModule: Loading", pth, "on the event loop")
+            bind(namesplit, await modules.load_async(pth))
+        return load()
+    bind(*loadModule(env, name))
 
 @module.register("import", "imp")
 def import_(env) -> "(sym -- )":
     name = env.stack.pop().val
-    namesplit, mod = loadModule(env, name)
-    env.scope.assign(namesplit[0], namespaceWrapper(namesplit, mod))
+    def bind(namesplit, mod):
+        env.scope.assign(namesplit[0], namespaceWrapper(namesplit, mod))
+    return importModule(env, name, bind)
 
 @module.register("import*", "imp*")
 def import_all(env) -> "(sym -- )":
     name = env.stack.pop().val
-    namesplit, mod = loadModule(env, name)
-    if type(mod) == ScopeWrapper:
-        conts  = mod.scope
-    else:
-        conts = mod.contents
-    for (k,v) in conts.items():
-        env.scope.assign(k,v)
+    def bind(namesplit, mod):
+        if type(mod) == ScopeWrapper:
+            conts  = mod.scope
+        else:
+            conts = mod.contents
+        for (k,v) in conts.items():
+            env.scope.assign(k,v)
+    return importModule(env, name, bind)
 
 @module.register("argv")
 def argv(env) -> "( -- l)":
@@ -482,13 +812,13 @@ def raisename(name, args):
 def try_(env):
     tclause, eclauses = env.stack.popN(2)
     try:
-        env.eval(tclause.val)
+        yield tclause.val
     except BaseException as e:
         bases = getBaseNames(e.__class__)
         for (name, handler) in eclauses.val:
             if name.val in bases:
                 env.stack.push(Token("lit_list", [Token("lit_any", val) for val in e.args]))
-                env.eval(handler.val)
+                yield handler.val
                 break
         else:
             raise e
@@ -514,6 +844,128 @@ def call(env) -> "(code -- )":
     "Runs `code`, which can be either a code object or a python function"
     code = env.stack.pop()
     if type(code) in env.FUNCTION_TYPES:
+        if hasattr(code, "nustack"):
+            # Returned as if the function had been called by name, so the interpreter deals with
+            # what it returns (eg. the coroutine of an async word) instead of waiting here
+            return code(env)
         env.call_external(code)
     else:
-        env.eval(code.val)
+        return code.val
+
+# How many results memo keeps for each word by default
+MEMO_SIZE = 1024
+
+class Memo:
+    """A code object whose results are cached by its arguments, see memo.
+    The cache keeps the maxsize most recently used results."""
+    def __init__(self, code, arity, maxsize=MEMO_SIZE):
+        self.code = code
+        self.arity = arity
+        self.maxsize = maxsize
+        self.results = collections.OrderedDict()
+        self.hits = self.misses = 0
+
+    def call(self, env):
+        args = env.stack.popN(self.arity)
+        try:
+            key = tuple([hashkey(arg) for arg in args])
+        except TypeError:
+            # An argument can't be hashed, so the result can't be cached
+            key = None
+        else:
+            results = self.results.get(key)
+            if results is not None:
+                self.hits += 1
+                self.results.move_to_end(key)
+                env.stack.push(*results)
+                return
+        self.misses += 1
+        env.stack.push(*args)
+        base = len(env.stack) - self.arity
+        # Run the code as a word, with a scope of its own
+        env.scope.pushScope()
+        try:
+            yield self.code.val
+        finally:
+            env.scope.popScope()
+        n = len(env.stack) - base
+        if key is None or n < 0:
+            return
+        results = env.stack.popN(n)
+        env.stack.push(*results)
+        self.results[key] = results
+        if len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+    call.nustack = True
+
+    def info(self):
+        "Returns the number of hits and misses, and the current and maximum size of the cache"
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.results), "maxsize": self.maxsize}
+
+    def __repr__(self):
+        return "Memo(%r, %d)" % (self.code, self.arity)
+
+def memoize(env, maxsize):
+    code, arity = env.stack.popN(2)
+    if code.type == "lit_symbol":
+        # Redefine the word, so the calls it makes to itself are cached too
+        name = code.val
+        env.scope.assign(name, Memo(env.lookup(name), arity.val, maxsize).call)
+    else:
+        env.stack.push(Memo(code, arity.val, maxsize).call)
+
+@module.register("memo")
+def memo(env) -> "(c i -- f)":
+    """Makes a word that runs the code object c, which takes i arguments, and caches its results.
+    The word must not have side effects, and only arguments that can be hashed are cached.
+    If c is the symbol of a defined word, the word is replaced by the memoized word instead."""
+    memoize(env, MEMO_SIZE)
+
+@module.register("memo.sized")
+def memo_sized(env) -> "(c i1 i2 -- f)":
+    "Like memo, but keeps the results of at most i2 calls"
+    size = env.stack.pop().val
+    memoize(env, size)
+
+@module.register("memo.info")
+def memo_info(env) -> "(f -- hash)":
+    "Returns a hash of the hits, misses, size, and maxsize of the cache of a memoized word"
+    info = env.stack.pop().__self__.info()
+    env.stack.push(Token("lit_hash", {Token("lit_string", k): integer(v) for (k, v) in info.items()}))
+
+@module.register("spawn")
+def spawn(env) -> "(c -- )":
+    """Runs c in a green thread of its own, which gets a new empty stack.
+    Green threads take turns, switching when one calls yield or has to wait on a channel or an async word"""
+    code = env.stack.pop()
+    env.spawn(code.val)
+
+@module.register("yield")
+def yield_(env) -> "( -- )":
+    "Lets the other green threads that are ready run before this one carries on"
+    if env.runnable and env.canswitch():
+        env.runnable.append(env.thread)
+        return SWITCH
+
+@module.register("chan")
+def chan(env) -> "( -- chan)":
+    "Returns a new channel for sending values between green threads. Any number of values can wait in it"
+    env.stack.push(Token("lit_any", Channel()))
+
+@module.register("chan.sized")
+def chan_sized(env) -> "(i -- chan)":
+    "Returns a new channel that at most i values can wait in before send waits for them to be received"
+    size = env.stack.pop().val
+    env.stack.push(Token("lit_any", Channel(size)))
+
+@module.register("send")
+def send(env) -> "(chan any -- )":
+    "Sends any to chan"
+    chan, val = env.stack.popN(2)
+    return chan.val.send(env, val)
+
+@module.register("recv")
+def recv(env) -> "(chan -- any)":
+    "Receives the next value sent to chan, waiting for it if there isn't one yet"
+    chan = env.stack.pop()
+    return chan.val.receive(env)
@@ -3,6 +3,10 @@
 
 from nustack.utils import log
 import re, pprint
+
+# Bump this whenever the tokens produced for a program change, so cached parses are thrown away
+VERSION = 2
+
 LEGAL_IDS = re.escape(r'abcdefghijklmnopqrstuvwxyz0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ!#$%&()*+,-./:;<=>?@\^_|~')
 COMMENT = re.compile(r"(?:/\*.+?\*/)|(?:[ \t\n\r\x0b\x0c]+)|(?://.+?$)", re.DOTALL)
 INT     = re.compile(r"(?:-)?\d+(?!\.)")
@@ -13,6 +17,23 @@ BYTE    = re.compile(r"b(('.*?(?<!\\)')|(\".*?(?<!\\)\"))")
 SYMBOL  = re.compile(r"`[%s]+" % LEGAL_IDS)
 CALL    = re.compile(r"[%s]+" % LEGAL_IDS)
 
+# All of the token patterns joined into one, in order of precedence.
+# The lexer walks this with a position offset so the source is never copied.
+TOKEN = re.compile("|".join("(?P<%s>%s)" % pair for pair in (
+    ("COMMENT",   "(?s:%s)" % COMMENT.pattern),
+    ("INT",       INT.pattern),
+    ("FLOAT",     FLOAT.pattern),
+    ("BOOL",      BOOL.pattern),
+    ("STRING",    STRING.pattern),
+    ("BYTE",      BYTE.pattern),
+    ("LISTSTART", r"\["),
+    ("LISTEND",   r"\]"),
+    ("CODESTART", r"\{"),
+    ("CODEEND",   r"\}"),
+    ("CALL",      CALL.pattern),
+    ("SYMBOL",    SYMBOL.pattern),
+)))
+
 class TokenizeError(Exception): pass
 
 def addescapes(s):
@@ -30,13 +51,18 @@ def addescapes(s):
         s = s.replace(k,v)
     return s
 
+# The types of Tokens that hold numbers
+NUMBER_TYPES = frozenset(("lit_int", "lit_float"))
+
 class Token:
+    __slots__ = ("type", "val")
+
     def __init__(self, type, val):
         self.type = type
         self.val  = val
 
     def __eq__(self, other):
-        if self.type in ("lit_int", "lit_float") and other.type in ("lit_int", "lit_float"):
+        if self.type in NUMBER_TYPES and other.type in NUMBER_TYPES:
             # Numbers can be equal even if they are of different types.
             eq = self.val == other.val
         else:
@@ -44,7 +70,7 @@ class Token:
         return eq
 
     def __lt__(self, other):
-        if self.type in ("lit_int", "lit_float") and other.type in ("lit_int", "lit_float"):
+        if self.type in NUMBER_TYPES and other.type in NUMBER_TYPES:
             # Numbers can be equal even if they are of different types.
             eq = self.val < other.val
         else:
@@ -52,7 +78,7 @@ class Token:
         return eq
 
     def __gt__(self, other):
-        if self.type in ("lit_int", "lit_float") and other.type in ("lit_int", "lit_float"):
+        if self.type in NUMBER_TYPES and other.type in NUMBER_TYPES:
             # Numbers can be equal even if they are of different types.
             eq = self.val > other.val
         else:
@@ -60,7 +86,7 @@ class Token:
         return eq
 
     def __hash__(self):
-        return hash(self.type) & hash((self.val, ))
+        return hash(hashkey(self))
 
     def detailstr(self):
          return "Token(type=%s, val=%s)" % (repr(self.type), repr(self.val),)
@@ -86,97 +112,160 @@ class Token:
         else:
             return val
 
-def tokenize(code):
-    tokens = []
-    while code:
-        commentmatch = COMMENT.match(code)
-        intmatch = INT.match(code)
-        floatmatch = FLOAT.match(code)
-        boolmatch = BOOL.match(code)
-        stringmatch = STRING.match(code)
-        bytematch = BYTE.match(code)
-        symbolmatch = SYMBOL.match(code)
-        callmatch = CALL.match(code)
-        if commentmatch:
+def hashkey(tok):
+    """Returns a hashable snapshot of tok. Tokens that are equal have equal keys, and the key
+    doesn't change when a list in tok is changed later.
+    Raises TypeError if tok holds something that can't be hashed, eg. a lit_hash."""
+    if type(tok) is not Token:
+        hash(tok)
+        return tok
+    type_, val = tok.type, tok.val
+    if type_ in NUMBER_TYPES:
+        # Numbers of different types can be equal
+        return ("number", val)
+    if isinstance(val, list):
+        return (type_, tuple([hashkey(item) for item in val]))
+    hash(val)
+    return (type_, val)
+
+# Tokens for values that are made all the time. They are shared, so they must never be changed.
+TRUE = Token("lit_bool", True)
+FALSE = Token("lit_bool", False)
+EMPTY_STRING = Token("lit_string", "")
+SMALL_INT_MIN, SMALL_INT_MAX = -5, 256
+SMALL_INTS = tuple(Token("lit_int", i) for i in range(SMALL_INT_MIN, SMALL_INT_MAX + 1))
+
+def boolean(b):
+    "Returns the shared Token for the truth value of b"
+    return TRUE if b else FALSE
+
+def integer(n):
+    "Returns a lit_int Token for n, which is shared if n is small"
+    if SMALL_INT_MIN <= n <= SMALL_INT_MAX:
+        return SMALL_INTS[n - SMALL_INT_MIN]
+    return Token("lit_int", n)
+
+def literal(type_, val):
+    "Returns a Token of type_ for val, which is shared if there is a shared Token for val"
+    t = type(val)
+    if t is int and type_ == "lit_int":
+        return integer(val)
+    if t is bool and type_ == "lit_bool":
+        return TRUE if val else FALSE
+    if t is str and not val and type_ == "lit_string":
+        return EMPTY_STRING
+    return Token(type_, val)
+
+# How many characters iter_tokens reads from a file at a time
+CHUNKSIZE = 64 * 1024
+
+def _incomplete(buf, pos, m):
+    "Returns True if the token at buf[pos] could change when more source is read"
+    if m is None or m.end() == len(buf):
+        return True
+    start = buf[pos:pos+2]
+    if start == "//":
+        # Line comments run to the end of the source
+        return True
+    if start == "/*":
+        return m.lastgroup != "COMMENT"
+    if start in ("b'", 'b"'):
+        # Byte strings can not span lines, so only wait if there is no newline yet
+        return m.lastgroup != "BYTE" and "\n" not in buf[pos:]
+    return False
+
+def _lex(buf, read=None, chunksize=CHUNKSIZE):
+    """Yields (kind, text) pairs for the source in buf, followed by the source returned
+    by calling read(size) until it returns an empty string. Tokens that reach the end of
+    the buffer are held back until more source is read, so they can span chunks."""
+    pos, final = 0, read is None
+    match = TOKEN.match
+    while True:
+        if pos < len(buf):
+            m = match(buf, pos)
+        else:
+            m = None
+        if not final and _incomplete(buf, pos, m):
+            # Read at least as much as we are holding so joining stays linear
+            chunk = read(max(chunksize, len(buf) - pos))
+            if chunk:
+                buf = buf[pos:] + chunk
+                pos = 0
+            else:
+                final = True
+            continue
+        if pos >= len(buf):
+            return
+        if m is None:
+            raise TokenizeError("Can not find a token at position %d: %r" % (pos, buf[pos:pos+20]))
+        pos = m.end()
+        yield m.lastgroup, m.group()
+
+def _parse(lexed):
+    "Builds Tokens from (kind, text) pairs, yielding each top level token as soon as it is complete"
+    blocks = []
+    for kind, text in lexed:
+        if kind == "COMMENT":
             log("Parsing: Found comment/whitespace")
-            commentend = commentmatch.span()[1]
-            code = code[commentend:]
-        elif intmatch:
-            span = intmatch.span()[1]
-            n = code[:span]
-            n = int(n)
-            tokens.append(Token("lit_int", n))
-            code = code[span:]
+            continue
+        elif kind == "INT":
+            n = int(text)
+            tok = integer(n)
             log("Parsing: Found int", n)
-        elif floatmatch:
-            span = floatmatch.span()[1]
-            n = code[:span]
-            n = float(n)
-            tokens.append(Token("lit_float", n))
-            code = code[span:]
+        elif kind == "FLOAT":
+            n = float(text)
+            tok = Token("lit_float", n)
             log("Parsing: Found float", n)
-        elif boolmatch:
-            span = boolmatch.span()[1]
-            b = code[:span]
-            if b == "#t":
-                bool = True
-            else:
-                bool = False
-            code = code[span:]
-            tokens.append(Token("lit_bool", bool))
-            log("Parsing: Found bool", b)
-        elif stringmatch:
-            span = stringmatch.span()[1]
-            s = code[:span]
-            s = addescapes(s)
-            tokens.append(Token("lit_string", s[1:-1]))
-            code = code[span:]
+        elif kind == "BOOL":
+            tok = TRUE if text == "#t" else FALSE
+            log("Parsing: Found bool", text)
+        elif kind == "STRING":
+            s = addescapes(text)
+            tok = literal("lit_string", s[1:-1])
             log("Parsing: Found string", s[1:-1])
-        elif bytematch:
-            span = bytematch.span()[1]
-            s = code[:span]
-            s = addescapes(s)
-            tokens.append(Token("lit_bytes", bytes(s[2:-1], "utf8")))
-            code = code[span:]
+        elif kind == "BYTE":
+            s = addescapes(text)
+            tok = Token("lit_bytes", bytes(s[2:-1], "utf8"))
             log("Parsing: Found bytes", bytes(s[2:-1], "utf8"))
-        elif code[0] == "[":
-            tokens.append(Token("lit_liststart","["))
-            code = code[1:]
+        elif kind == "LISTSTART":
+            tok = Token("lit_liststart","[")
             log("Parsing: Found list start")
-        elif code[0] == "]":
-            tokens.append(Token("listend", "]"))
-            code = code[1:]
+        elif kind == "LISTEND":
+            tok = Token("listend", "]")
             log("Parsing: Found list end")
-        elif code[0] == "{":
-            tokens.append(Token("codestart", "{"))
-            code = code[1:]
+        elif kind == "CODESTART":
+            blocks.append([])
             log("Parsing: Found code start")
-        elif code[0] == "}":
-            subcode = []
-            while True:
-                t = tokens.pop()
-                if t.type == "codestart":
-                    break
-                subcode.append(t)
-            tokens.append(Token("lit_code", list(reversed(subcode))))
-            code = code[1:]
+            continue
+        elif kind == "CODEEND":
+            if not blocks:
+                raise TokenizeError("Found } without a matching {")
+            tok = Token("lit_code", blocks.pop())
             log("Parsing: Found code end")
-        elif callmatch:
-            span = callmatch.span()[1]
-            sym = code[:span]
-            code = code[span:]
-            tokens.append(Token("call", sym))
-            log("Parsing: Found call", sym)
-        elif symbolmatch:
-            span = symbolmatch.span()[1]
-            sym = code[1:span]
-            code = code[span:]
-            tokens.append(Token("lit_symbol", sym))
-            log("Parsing: Found symbol", sym)
+        elif kind == "CALL":
+            tok = Token("call", text)
+            log("Parsing: Found call", text)
+        else:
+            tok = Token("lit_symbol", text[1:])
+            log("Parsing: Found symbol", text[1:])
+        if blocks:
+            blocks[-1].append(tok)
         else:
-            print(code)
-            raise TokenizeError("Can not find a token!")
-    return tokens
+            yield tok
+    # Unclosed code blocks are left in the token stream as they were found
+    for block in blocks:
+        yield Token("codestart", "{")
+        for tok in block:
+            yield tok
+
+def iter_tokens(fileobj, chunksize=CHUNKSIZE):
+    """Yields the tokens of the program read from fileobj in chunks of chunksize characters.
+    Each top level token is yielded as soon as it has been read, so it can be run
+    before the rest of the file is read."""
+    return _parse(_lex("", fileobj.read, chunksize))
+
+def tokenize(code):
+    return list(_parse(_lex(code)))
 
 if __name__ == '__main__':
     code = input("Enter code: ")
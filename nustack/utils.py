@@ -1,6 +1,7 @@
-import sys, io
+import sys, io, contextlib, contextvars
 
 def config_logging(on=False, file=sys.stderr):
+    "Sets the logging configuration used by everything that doesn't have its own"
     global log_config
     log_config = {
                   "on": on,
@@ -8,9 +9,25 @@ def config_logging(on=False, file=sys.stderr):
                   }
 config_logging()
 
+# The logging configuration of the interpreter that is running in this thread, if it has its own
+current_log_config = contextvars.ContextVar("current_log_config", default=None)
+
+@contextlib.contextmanager
+def logging_config(config):
+    "Logs with config in this thread until the with block ends. None keeps the configuration as it is"
+    if config is None:
+        yield
+        return
+    token = current_log_config.set(config)
+    try:
+        yield
+    finally:
+        current_log_config.reset(token)
+
 def log(*args, **kwargs):
-    if log_config["on"]:
-        print("DEBUG LOG:", *args, file=log_config["file"], **kwargs)
+    config = current_log_config.get() or log_config
+    if config["on"]:
+        print("DEBUG LOG:", *args, file=config["file"], **kwargs)
 
 class StdoutCapture:
     def __init__(self):
@@ -66,3 +66,57 @@ def test_getGlobal():
         s.getGlobal("c")
     with pytest.raises(ScopeLookupError):
         s.getGlobal("spam")
+
+def test_find():
+    s = Scope()
+    s.assign("a", 1)
+    s.pushScope()
+    s.assign("b", 2)
+    assert s.find("a") is s._scopes[0]
+    assert s.find("b") is s._scopes[1]
+    assert s.find("c") is None
+
+def test_cell():
+    s = Scope()
+    cell = s.cell("a")
+    assert s.cell("a") is cell
+    v = cell.version
+    s.assign("a", 1)
+    assert cell.version == v + 1
+    # Rebinding a name in the same scope doesn't change where it is found
+    s.assign("a", 2)
+    assert cell.version == v + 1
+    s.pushScope()
+    s.assign("a", 3)
+    assert cell.version == v + 2
+    s.popScope()
+    assert cell.version == v + 3
+    s.pushScope({"a": 4})
+    assert cell.version == v + 4
+    s.popScope()
+    s.pushScope()
+    s.assign("b", 1)
+    s.popScope()
+    assert cell.version == v + 5
+
+def test_Frame():
+    from nustack.interpreter import Frame
+    from nustack.compiler import compile_tokens
+    from nustack.tokenize import tokenize
+    f = Frame(compile_tokens(tokenize("`a def `b def"), word=True))
+    assert len(f) == 0 and not f
+    assert "a" not in f
+    f["a"] = 1
+    f["c"] = 3
+    assert f.slots[0] == 1
+    assert "a" in f and "b" not in f and "c" in f
+    assert f["a"] == 1 and f["c"] == 3
+    assert sorted(f.keys()) == ["a", "c"]
+    assert len(f) == 2
+    with pytest.raises(KeyError):
+        f["b"]
+    s = Scope()
+    s.pushScope(f)
+    s.assign("b", 2)
+    assert f.slots[1] == 2
+    assert s.lookup("b") == 2
@@ -53,7 +53,57 @@ def test_popN():
     t = s.popN(0)
     assert t == ()
 
+def test_popN_underflow():
+    s = Stack([1, 2])
+    with pytest.raises(StackUnderflowError):
+        s.popN(3)
+    # Nothing is popped when there aren't enough items
+    assert s._stack == [1, 2]
+
+def test_pushN():
+    s = Stack([1])
+    s.pushN(iter([2, 3]))
+    assert s._stack == [1, 2, 3]
+
+def test_drop():
+    s = Stack([1, 2, 3])
+    s.drop()
+    assert s._stack == [1, 2]
+    s.drop(2)
+    assert s._stack == []
+    with pytest.raises(StackUnderflowError):
+        s.drop()
+
+def test_peek_pick_roll():
+    s = Stack([1, 2, 3])
+    assert s.peek() == 3 and s.peek(2) == 1
+    with pytest.raises(StackUnderflowError):
+        s.peek(3)
+    s.pick(1)
+    assert s._stack == [1, 2, 3, 2]
+    s.roll(3)
+    assert s._stack == [2, 3, 2, 1]
+    with pytest.raises(StackUnderflowError):
+        s.roll(4)
+    assert s._stack == [2, 3, 2, 1]
+
 def test_repr():
     s = Stack([1, 2, 3])
     assert repr(s) == "Stack( [1, 2, 3] )"
     assert str(s) == "Stack( [1, 2, 3] )"
+
+def test_UnboxedStack():
+    from nustack.interpreter import UnboxedStack
+    from nustack.tokenize import Token
+    s = UnboxedStack()
+    s.push(Token("lit_int", 1), Token("lit_symbol", "x"), Token("lit_string", "a"), Token("lit_int", 2.5))
+    # Only Tokens whose type matches their value's Python type are unboxed
+    assert s._stack[0] == 1 and s._stack[2] == "a"
+    assert type(s._stack[1]) is Token and type(s._stack[3]) is Token
+    s.push(2.5)
+    assert s.pop() == Token("lit_float", 2.5)
+    assert s.pop().type == "lit_int"
+    assert s.popN(2) == (Token("lit_symbol", "x"), Token("lit_string", "a"))
+    assert s.pop().type == "lit_int"
+    with pytest.raises(StackUnderflowError):
+        s.pop()
@@ -0,0 +1,67 @@
+import asyncio, time
+from nustack.interpreter import Interpreter
+from nustack.extensionbase import Module, Token
+
+module = Module("test")
+
+@module.register("fail")
+async def fail(env):
+    await asyncio.sleep(0)
+    raise ValueError("failed")
+
+@module.register("later")
+async def later(env):
+    await asyncio.sleep(0)
+    return [Token("lit_int", 7)]
+
+def interpreter():
+    interp = Interpreter()
+    interp.eval("`std::Time import")
+    interp.scope.assign("fail", fail)
+    interp.scope.assign("later", later)
+    return interp
+
+def test_eval_async():
+    interps = [interpreter() for _ in range(50)]
+    async def main():
+        await asyncio.gather(*[interp.eval_async("{ 0.05 Time::sleep.async 1 } `f def f f +") for interp in interps])
+    start = time.perf_counter()
+    asyncio.run(main())
+    # The sleeps overlap instead of taking 5 seconds one after the other
+    assert time.perf_counter() - start < 2
+    assert all(interp.stack.pop().val == 2 for interp in interps)
+
+def test_async_results():
+    interp = interpreter()
+    code = "later { fail } [ [ `ValueError { Seq::len } ] ] try 1"
+    asyncio.run(interp.eval_async("`std::Seq import " + code))
+    assert [t.val for t in interp.stack._stack] == [7, 1, 1]
+    # Without an event loop the words are run to the end where they are called
+    interp.stack.clear()
+    interp.eval("`std::Seq import " + code)
+    assert [t.val for t in interp.stack._stack] == [7, 1, 1]
+    assert len(interp.scope._scopes) == 1
+
+def test_nested_async(tmp_path, monkeypatch):
+    # Async words reached through call, or in the body of a module that is imported, are awaited on
+    # the loop eval_async runs on rather than on one of their own
+    monkeypatch.setenv("NUSTACKPATH", str(tmp_path))
+    for i in range(20):
+        (tmp_path / ("slow%d.nu" % i)).write_text("`std::Time import 0.2 Time::sleep.async %d `n def" % i)
+    interps = [interpreter() for _ in range(20)]
+    async def main():
+        await asyncio.gather(*[interp.eval_async("0.2 `Time::sleep.async lookup call `slow%d import slow%d::n" % (i, i))
+                               for (i, interp) in enumerate(interps)])
+    start = time.perf_counter()
+    asyncio.run(main())
+    # The sleeps overlap instead of taking 8 seconds one after the other
+    assert time.perf_counter() - start < 2
+    assert [interp.stack.pop().val for interp in interps] == list(range(20))
+
+def test_eval_in_loop():
+    # eval can't use the event loop that is running, so the async words it calls wait on one of their own
+    interp = interpreter()
+    async def main():
+        interp.eval("{ 0.01 Time::sleep.async later } `call lookup call")
+    asyncio.run(main())
+    assert interp.stack.pop().val == 7
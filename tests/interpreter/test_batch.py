@@ -0,0 +1,24 @@
+import io
+from nustack import batch
+
+def test_batch(tmp_path):
+    (tmp_path / "ok.nu").write_text('"hello" show argv show')
+    (tmp_path / "bad.nu").write_text("1 0 /")
+    manifest = io.StringIO("# jobs\n%s a 'b c'\n\n%s\n" % (tmp_path / "ok.nu", tmp_path / "bad.nu"))
+    jobs = batch.readmanifest(manifest)
+    assert jobs[0][1] == ["a", "b c"]
+    results = list(batch.run(jobs, 2))
+    assert [res.status for res in results] == [0, 1]
+    assert results[0].output == "hello\n['a', 'b c']\n"
+    assert results[1].error.startswith("ZeroDivisionError")
+    out = io.StringIO()
+    assert batch.report(results, out) == 1
+    assert "2 jobs, 1 failed" in out.getvalue()
+
+def test_batch_parallel(tmp_path):
+    # A job can use map.parallel, which starts worker processes of its own
+    (tmp_path / "p.nu").write_text("[ 1 2 3 ] { 2 * } map.parallel show")
+    (tmp_path / "q.nu").write_text("1 show")
+    results = list(batch.run([(str(tmp_path / "p.nu"), []), (str(tmp_path / "q.nu"), [])], 2))
+    assert [res.error for res in results] == [None, None]
+    assert results[0].output == "[ 2 4 6 ]\n"
@@ -0,0 +1,69 @@
+from nustack import codegen
+from nustack.tokenize import tokenize, Token
+from nustack.interpreter import Interpreter
+import pytest
+
+def run(word, args, **options):
+    interp = Interpreter(**options)
+    interp.stack.push(*args)
+    func = codegen.compile_word(tokenize(word))
+    assert func(interp, interp.stack._stack)
+    return interp.stack._stack
+
+def test_compile_word():
+    sumsq = "`n def 0 `acc def 0 `i def { i n < } { acc i i * + `acc def i 1 + `i def } while acc"
+    assert run(sumsq, [Token("lit_int", 4)]) == [Token("lit_int", 14)]
+    assert run(sumsq, [4], unboxed=True) == [4 + 9 + 1]
+    absval = "dup 0 lt { 0 swap - } { } if"
+    assert run(absval, [Token("lit_float", -2.5)]) == [Token("lit_float", 2.5)]
+    # Items that are only moved around are left as they are
+    sym = Token("lit_symbol", "x")
+    assert run("swap 1 rot", [sym, Token("lit_int", 2)]) == [sym, Token("lit_int", 1), Token("lit_int", 2)]
+    assert run("`x def 'a' x", [sym]) == [Token("lit_string", "a"), sym]
+
+def test_unsupported():
+    for word in ["dup 1 - fact *", "[ 1 ] 2", "'a' 1 +", "x `x def", "{ 1 } `f def f",
+                 "{ 1 } { 2 3 } if", "{ #t } { 1 } while", "Seq::len"]:
+        assert codegen.compile_word(tokenize(word)) is None
+
+def test_fallback():
+    interp = Interpreter()
+    func = codegen.compile_word(tokenize("1 +"))
+    # Not a number, or not enough items
+    interp.stack.push(Token("lit_string", "a"))
+    assert not func(interp, interp.stack._stack)
+    interp.stack.clear()
+    assert not func(interp, interp.stack._stack)
+    # A builtin it uses was redefined
+    interp.eval("{ drop drop 0 } `+ def")
+    interp.stack.push(Token("lit_int", 1))
+    assert not func(interp, interp.stack._stack)
+
+def test_native(monkeypatch):
+    monkeypatch.setattr(codegen, "HOT", 3)
+    interp = Interpreter(native=True)
+    interp.eval("{ `b def `a def a b * a b + - } `f def { 5 3 f } 10 repeat.n")
+    assert [t.val for t in interp.stack._stack] == [7] * 10
+    block = interp.scope.lookup("f").val
+    assert block.native and block.calls == 3
+    # Changing the word forgets its Python version
+    block.append(Token("call", "drop"))
+    assert block.native is None
+
+def test_native_types(monkeypatch):
+    # A word gives numbers of the same types once it is compiled as it did before
+    monkeypatch.setattr(codegen, "HOT", 1)
+    words = ["7 3 %", "1 2.5 +", "2.5 1 +", "3 2 /", "- 2 *",
+             "dup 0 < { 0.5 + } { 2 % } if",
+             "0 + `x def { x 5 < } { x 1 + 1.5 * `x def } while x",
+             "`n def 0 { dup n < } { 1 + 2 * 1.5 / 1 + } while"]
+    for word in words:
+        for unboxed in (False, True):
+            results = []
+            for native in (False, True):
+                interp = Interpreter(unboxed=unboxed, native=native)
+                interp.eval("{ %s } `f def 3 -2 f 4 f 1 f" % word)
+                assert bool(interp.scope.lookup("f").val.native) == native, word
+                stack = interp.stack._stack
+                results.append([(t.type, t.val) if type(t) is Token else (type(t), t) for t in stack])
+            assert results[0] == results[1], word
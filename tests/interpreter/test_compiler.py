@@ -0,0 +1,171 @@
+from nustack.compiler import *
+from nustack.tokenize import tokenize, Token
+from nustack.interpreter import Interpreter
+import pickle
+import pytest
+
+def test_compile_tokens():
+    code = compile_tokens(tokenize("1 2 + [ 1 ] `x def show 1"))
+    # The tokens for 1 are shared, so they are one constant.
+    # 2 + and `x def are superinstructions, followed by the instructions they stand for
+    assert code.ops == [PUSH_CONST, 0, FUSED, 3, PUSH_CONST, 1, CALL, 0,
+                        PUSH_CONST, 2, PUSH_CONST, 0, BUILD_LIST, 0,
+                        FUSED, 6, PUSH_CONST, 3, CALL, 1, CALL, 2, PUSH_CONST, 0]
+    assert code.names == ["+", "def", "show"]
+    assert len(code) == 12
+
+def test_block():
+    toks = tokenize("{ 1 2 + }")
+    code = compile_tokens(toks)
+    block = code.consts[0].val
+    assert type(block) is Block
+    assert block == [Token("lit_int", 1), Token("lit_int", 2), Token("call", "+")]
+    assert get_code(block) is get_code(block)
+    old = get_code(block)
+    block.append(Token("call", "show"))
+    assert get_code(block) is not old
+    assert len(get_code(block)) == 5
+    assert type(pickle.loads(pickle.dumps(block))) is Block
+
+def test_execute():
+    interp = Interpreter()
+    interp.eval("{ dup * } `sq def [ 1 2 3 ] 4 sq")
+    assert interp.stack._stack == [Token("lit_list", [Token("lit_int", i) for i in (1, 2, 3)]),
+                                   Token("lit_int", 16)]
+
+def test_inline_cache():
+    interp = Interpreter()
+    # The same code object sees + redefined, then shadowed by a local, then restored
+    interp.eval("{ 1 2 + } `add3 def add3 { drop drop 10 } `+ def add3 { { drop drop 20 } `+ def add3 } `local def local add3")
+    assert [t.val for t in interp.stack._stack] == [3, 10, 20, 10]
+    # Code objects are shared between interpreters, but the caches are not
+    code = interp.scope.lookup("add3").val.wordcode
+    other = Interpreter()
+    other.execute(code)
+    assert [t.val for t in other.stack._stack] == [3]
+
+def test_qualified():
+    code = compile_tokens(tokenize("Seq::nth ::text Seq::nth"))
+    assert code.ops == [CALL_QUALIFIED, 0, CALL_QUALIFIED, 1, CALL_QUALIFIED, 0]
+    assert code.names == [("Seq", "nth"), ("", "text")]
+    interp = Interpreter()
+    interp.eval("`std::Seq import { [ 5 6 7 ] 1 Seq::nth } `second def second")
+    assert interp.stack.pop() == Token("lit_int", 6)
+    # Rebinding the module name is seen by the cached call
+    from nustack.stdlib.builtins import ScopeWrapper
+    interp.scope.assign("Seq", ScopeWrapper({"nth": Token("lit_code", tokenize("drop drop 42"))}))
+    interp.eval("second")
+    assert interp.stack.pop() == Token("lit_int", 42)
+
+def test_locals():
+    toks = tokenize("`a def a `b define { `c def } call c a")
+    assert localnames(toks) == ["a", "b"]
+    assert compile_tokens(toks).localnames == []
+    code = compile_tokens(toks, word=True)
+    assert code.layout == {"a": 0, "b": 1}
+    assert code.ops[:10] == [STORE_LOCAL, 0, PUSH_CONST, 0, CALL, 0, LOAD_LOCAL, 0, CALL, 1]
+
+def test_frames():
+    interp = Interpreter()
+    interp.eval("""
+    { x 1 + } `inc.x def
+    /* Callees can see the locals of their callers */
+    { `x def inc.x } `f def
+    5 f
+    /* Names defined by code run with if go in the frame too */
+    { `y def #t { y 2 * `x def } { } if x } `g def
+    7 g
+    /* A local read before it is defined comes from outside */
+    { x swap `x def x } `h def
+    100 `x def 8 h
+    """)
+    assert [t.val for t in interp.stack._stack] == [6, 14, 100, 8]
+    assert interp.scope._scopes == [interp.scope._scopes[0]]
+    assert interp.scope.lookup("x") == Token("lit_int", 100)
+
+def test_module_word_locals(tmp_path):
+    (tmp_path / "mod.nu").write_text("10 `ten def { `n def n ten + } `addten def")
+    interp = Interpreter()
+    interp.file = str(tmp_path / "main.nu")
+    interp.eval("`mod import 5 mod::addten")
+    assert interp.stack.pop() == Token("lit_int", 15)
+
+def test_deep_recursion():
+    interp = Interpreter()
+    # Neither calls nor code run by if, while or map nest Python frames
+    interp.eval("""
+    { dup 0 eq { } { 1 - count.down } if } `count.down def
+    20000 count.down
+    { dup 0 eq { drop 0 } { dup 1 - sum + } if } `sum def
+    5000 sum
+    """)
+    assert [t.val for t in interp.stack._stack] == [0, 12502500]
+    assert len(interp.scope._scopes) == 1
+
+def test_tail_call_scopes():
+    interp = Interpreter()
+    # A word in tail position drops the empty frames of its callers
+    depths = []
+    interp.scope.assign("depth", lambda: depths.append(len(interp.scope._scopes)))
+    interp.eval("{ depth } `g def { g } `f def { 1 drop f } `e def e")
+    assert depths == [2]
+    assert len(interp.scope._scopes) == 1
+
+def test_tail_call_locals():
+    interp = Interpreter()
+    # The frames of words that define locals are collapsed instead, and the word still sees its callers' names
+    depths = []
+    interp.scope.assign("depth", lambda: depths.append(len(interp.scope._scopes)))
+    interp.eval("""
+    { `n def n 0 eq { total } { n total + `total def n 1 - count } if } `count def
+    0 `total def 20000 count
+    { `n def n 0 eq { depth } { n 1 - down } if } `down def 50 down
+    """)
+    assert interp.stack.pop().val == 200010000
+    assert depths[0] <= 3
+    assert len(interp.scope._scopes) == 1
+
+def test_unwind():
+    interp = Interpreter()
+    interp.eval("""
+    { dup 0 eq { "boom" Exception raise } { 1 - deep } if } `deep def
+    { 500 deep } [ [ `Exception { drop "caught" } ] ] try
+    """)
+    assert interp.stack.pop() == Token("lit_string", "caught")
+    assert len(interp.scope._scopes) == 1
+
+def test_unboxed():
+    interp = Interpreter(unboxed=True)
+    interp.eval("""
+    { dup 1 eq { } { dup 1 - fact * } if } `fact def
+    10 fact 1 2.5 + "a" "b" + `x `y + 2 3 lt 3 `l def l dup *
+    """)
+    # Words that have no unboxed version still see Tokens
+    assert interp.stack._stack == [3628800, 3.5, "ab", Token("lit_symbol", "xy"), True, 9]
+    assert interp.stack.popN(2) == (Token("lit_bool", True), Token("lit_int", 9))
+    assert interp.scope.lookup("l") == Token("lit_int", 3)
+
+def test_unboxed_failure():
+    # A failing operator leaves the stack the same in both modes
+    code = "5 { 1 0 / } [ [ `ZeroDivisionError { drop } ] ] try"
+    stacks = []
+    for unboxed in (False, True):
+        interp = Interpreter(unboxed=unboxed)
+        interp.eval(code)
+        stacks.append([interp.stack.pop().val for _ in range(len(interp.stack))])
+    assert stacks[0] == stacks[1] == [5]
+
+def test_fusions():
+    code = compile_tokens(tokenize("over over over 1 - `f def"))
+    # Superinstructions don't overlap
+    assert [FUSIONS[arg][0] for (op, arg) in zip(code.ops[::2], code.ops[1::2]) if op == FUSED] == ["over over", "n -", "`x def"]
+    interp = Interpreter()
+    interp.eval("{ dup 0 eq { drop 1 } { dup 1 - f * } if } `f def 5 f 2 3 over over swap drop 2.5 dup *")
+    assert [t.val for t in interp.stack._stack] == [120, 2, 3, 3, 6.25]
+    assert interp.fusionstats() == {"n eq": 6, "n -": 5, "`x def": 1, "over over": 1, "swap drop": 1, "dup *": 1}
+    # They step aside when the words are redefined, or when the stack doesn't hold numbers
+    interp.eval("{ drop drop 42 } `- def 5 1 -")
+    assert interp.stack._stack[-1] == Token("lit_int", 42)
+    assert interp.fusionstats()["n -"] == 5
+    with pytest.raises(TypeError):
+        interp.eval("\"a\" 1 +")
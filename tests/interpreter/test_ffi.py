@@ -0,0 +1,42 @@
+from nustack import ffi
+from nustack.interpreter import Interpreter
+from nustack.tokenize import Token
+import pytest
+
+def test_totoken():
+    assert ffi.totoken(True) == Token("lit_bool", True)
+    assert ffi.totoken(3).type == "lit_int"
+    assert ffi.totoken(3.5).type == "lit_float"
+    assert ffi.totoken("s").type == "lit_string"
+    assert ffi.totoken(b"s").type == "lit_bytes"
+    assert ffi.totoken([1]).type == "lit_any"
+    tok = Token("lit_int", 1)
+    assert ffi.totoken(tok) is tok
+
+def test_adapter_cached(monkeypatch):
+    def add(a, b): return a + b
+    class Thing:
+        def scale(self, n): return n * 2
+    calls = []
+    getnumargs = ffi.getnumargs
+    monkeypatch.setattr(ffi, "getnumargs", lambda f: calls.append(f) or getnumargs(f))
+    assert ffi.adapter(add) is ffi.adapter(add)
+    assert ffi.adapter(add).numargs == 2
+    # Bound methods are made anew on every lookup but share an adapter
+    assert ffi.adapter(Thing().scale) is ffi.adapter(Thing().scale)
+    assert ffi.adapter(Thing().scale).numargs == 1
+    assert ffi.adapter("abc".upper) is ffi.adapter("xyz".upper)
+    assert len(calls) == 3
+
+def test_call_external():
+    interp = Interpreter()
+    interp.scope.assign("py.add", lambda a, b: a + b)
+    interp.scope.assign("py.none", lambda: None)
+    interp.eval("1 2 py.add 3 + py.none 'abc' ::upper")
+    assert interp.stack._stack == [Token("lit_int", 6), Token("lit_string", "ABC")]
+
+def test_classmethod_keys():
+    # Classmethods of different classes with the same name get adapters of their own
+    assert ffi._cachefor(dict.fromkeys)[1] == (dict, "fromkeys")
+    assert ffi._cachefor(bytes.fromhex)[1] != ffi._cachefor(bytearray.fromhex)[1]
+    assert ffi._cachefor("a".upper)[1] == ffi._cachefor("b".upper)[1]
@@ -0,0 +1,67 @@
+import asyncio, sys, time
+import pytest
+from nustack.interpreter import Interpreter
+from nustack.green import DeadlockError
+
+def test_channels():
+    interp = Interpreter()
+    interp.eval("chan `c def { [ 1 2 3 4 5 ] { c swap send } for.each } spawn 0 { c recv + } 5 repeat.n")
+    assert [t.val for t in interp.stack._stack] == [15]
+    assert len(interp.scope._scopes) == 1
+
+def test_sized_channel():
+    interp = Interpreter()
+    # The sender waits whenever a value is already waiting in the channel
+    interp.eval("1 chan.sized `c def { [ 1 2 3 ] { c swap send } for.each `done } spawn { c recv } 3 repeat.n")
+    assert [t.val for t in interp.stack._stack] == [1, 2, 3]
+    assert len(interp.runnable) == 0
+
+def test_yield():
+    interp = Interpreter()
+    interp.eval("{ `a yield `b } spawn { `x yield `y } spawn `m yield `n")
+    assert [t.val for t in interp.stack._stack] == ["m", "n"]
+    interp.eval("[ ] `seen def { `t `seen def } spawn yield seen")
+    assert interp.stack.pop().val == "t"
+
+def test_break():
+    # A break only ends a loop in the green thread that calls it
+    interp = Interpreter(budget=100000)
+    interp.eval("0 `n def { { n 3 lt } { n 1 + `n def yield } while } spawn "
+                "{ break yield } forever { n 3 lt } { yield } while n")
+    assert [t.val for t in interp.stack._stack] == [3]
+
+def test_deadlock():
+    interp = Interpreter()
+    with pytest.raises(DeadlockError):
+        interp.eval("chan recv")
+    interp.eval("{ chan recv } [ [ `DeadlockError { drop 1 } ] ] try")
+    assert interp.stack.pop().val == 1
+    assert len(interp.scope._scopes) == 1
+
+def test_async_parks_thread():
+    interp = Interpreter()
+    interp.eval("`std::Time import chan `c def")
+    start = time.perf_counter()
+    interp.eval("{ { 0.2 Time::sleep.async c 1 send } spawn } 5 repeat.n 0 { c recv + } 5 repeat.n")
+    assert time.perf_counter() - start < 0.8
+    assert interp.stack.pop().val == 5
+    asyncio.run(interp.eval_async("{ { 0.01 Time::sleep.async c 2 send } spawn } 3 repeat.n 0 { c recv + } 3 repeat.n"))
+    assert interp.stack.pop().val == 6
+
+@pytest.mark.skipif(sys.platform == "win32", reason="needs a sleep command")
+def test_shell_run_async():
+    interp = Interpreter()
+    interp.eval("`std::Shell import chan `c def")
+    start = time.perf_counter()
+    interp.eval("{ { \"sleep 0.2\" Shell::run.async c swap send } spawn } 4 repeat.n { c recv } 4 repeat.n")
+    assert time.perf_counter() - start < 0.7
+    assert [t.val[0].val for t in interp.stack._stack] == [0, 0, 0, 0]
+
+def test_step():
+    interp = Interpreter()
+    interp.start("chan `c def { 0 { 1 + } 500 repeat.n c swap send } spawn c recv")
+    steps = 1
+    while not interp.step(100):
+        steps += 1
+    assert steps > 5
+    assert interp.stack.pop().val == 500
@@ -0,0 +1,37 @@
+from nustack.interpreter import Interpreter
+from nustack.tokenize import Token
+from nustack.stdlib.builtins import Memo
+
+FIB = "{ dup 2 lt { } { dup 1 - fib swap 2 - fib + } if } `fib def "
+
+def test_memo_word():
+    interp = Interpreter()
+    interp.eval(FIB + "`fib 1 memo 200 fib 200 fib")
+    assert interp.stack.pop() == interp.stack.pop()
+    memo = interp.scope.lookup("fib").__self__
+    assert memo.info() == {"hits": 199, "misses": 201, "size": 201, "maxsize": 1024}
+    interp.eval("`fib lookup memo.info")
+    assert interp.stack.pop().val[Token("lit_string", "hits")] == Token("lit_int", 199)
+    assert len(interp.scope._scopes) == 1
+
+def test_memo_code():
+    interp = Interpreter()
+    calls = []
+    interp.scope.assign("count", lambda: calls.append(1))
+    # Equal numbers are the same key, and lists are keyed by their contents
+    interp.eval("{ count + } 2 memo `add def 1 2 add 1.0 2 add [ 1 ] [ 2 ] add [ 1 ] [ 2 ] add")
+    assert len(calls) == 2
+    assert [t.val for t in interp.stack._stack[:2]] == [3, 3]
+
+def test_memo_lru():
+    interp = Interpreter()
+    interp.eval("{ 1 + } 1 2 memo.sized `inc def 1 inc 2 inc 1 inc 3 inc")
+    memo = interp.scope.lookup("inc").__self__
+    assert [key[0][1] for key in memo.results] == [1, 3]
+    assert (memo.hits, memo.misses) == (1, 3)
+
+def test_memo_unhashable():
+    interp = Interpreter()
+    interp.eval("`std::Hash import { drop 5 } 1 memo `f def Hash::empty f Hash::empty f")
+    memo = interp.scope.lookup("f").__self__
+    assert memo.info()["size"] == 0 and memo.misses == 2
@@ -0,0 +1,95 @@
+import os
+import pytest
+from nustack.interpreter import Interpreter
+from nustack.stdlib.builtins import modules
+
+def test_module_cache(tmp_path, monkeypatch):
+    # Modules are looked for from the directory the process runs in, not next to the module importing them
+    monkeypatch.setenv("NUSTACKPATH", str(tmp_path))
+    (tmp_path / "a.nu").write_text("`b import 1 `one def { b::two one + } `three def")
+    (tmp_path / "b.nu").write_text("`a import 2 `two def")
+    main = str(tmp_path / "main.nu")
+    before = modules.info()
+    interp = Interpreter()
+    # a and b import each other, and b gets a before a has finished running
+    interp.run("`a import `b import a::three b::two", file=main)
+    assert [t.val for t in interp.stack._stack] == [3, 2]
+    info = modules.info()
+    assert info["misses"] - before["misses"] == 2
+    assert info["hits"] - before["hits"] == 2
+    # Changing a file runs it again
+    path = tmp_path / "b.nu"
+    path.write_text("`a import 20 `two def")
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    interp.run("`b import b::two", file=main)
+    assert interp.stack.pop().val == 20
+    assert modules.info()["misses"] - info["misses"] == 1
+
+def test_module_sharing(tmp_path, monkeypatch):
+    monkeypatch.setenv("NUSTACKPATH", str(tmp_path))
+    (tmp_path / "shared.nu").write_text("0 `n def [ ] `items def")
+    main = str(tmp_path / "main.nu")
+    modules.clear()
+    first, second = Interpreter(), Interpreter()
+    first.run("`shared import 5 `n def n shared::n", file=main)
+    # A program's own definitions don't reach the module
+    assert [t.val for t in first.stack._stack] == [5, 0]
+    second.run("`shared import shared::n shared::items", file=main)
+    assert second.stack._stack[0].val == 0
+    # Every program in the process gets the same module, and so the same mutable values
+    assert modules.info()["size"] == 1
+    items = second.stack._stack[1]
+    assert items is modules.load(tmp_path / "shared.nu")["items"]
+    # Until the modules are cleared
+    modules.clear()
+    first.run("`shared import shared::items", file=main)
+    assert first.stack._stack[-1] is not items
+
+def test_resolver(tmp_path, monkeypatch):
+    from nustack.stdlib.builtins import Resolver
+    resolver = Resolver()
+    resolver.interval = 60
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib" / "Pkg").mkdir()
+    (tmp_path / "lib" / "Pkg" / "mod.nu").write_text("")
+    monkeypatch.setenv("NUSTACKPATH", " %s %s" % (tmp_path / "lib", os.path.pathsep))
+    interp = Interpreter()
+    interp.file = str(tmp_path / "main.nu")
+    assert resolver.searchpath(interp) == [str(tmp_path), str(tmp_path / "lib")]
+    assert resolver.find("Pkg::mod", interp) == str(tmp_path / "lib" / "Pkg" / "mod.nu")
+    assert resolver.find("Missing", interp) is None
+    # A file added within the interval is found, as the listing is checked again before giving up
+    (tmp_path / "Missing.nu").write_text("")
+    assert resolver.find("Missing", interp) == str(tmp_path / "Missing.nu")
+    assert resolver.extension("Seq").module.modname == "std::Seq"
+    assert resolver.extensions[("Seq", False)] == "nustack.stdlib.Seq"
+    with pytest.raises(ImportError):
+        resolver.extension("NoSuchModule")
+    assert resolver.extensions[("NoSuchModule", False)] is None
+
+    # An error inside an extension module that is there is passed on, and it is looked for again next time
+    (tmp_path / "nu_ext_Broken.py").write_text("import nu_no_such_dependency")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    for _ in range(2):
+        with pytest.raises(ModuleNotFoundError) as info:
+            resolver.extension("Broken")
+        assert info.value.name == "nu_no_such_dependency"
+    assert ("Broken", False) not in resolver.extensions
+
+def test_concurrent_async_imports(tmp_path, monkeypatch):
+    import asyncio
+    monkeypatch.setenv("NUSTACKPATH", str(tmp_path))
+    # The module is still running when the second import happens
+    (tmp_path / "slowmod.nu").write_text("`std::Time import 0.1 Time::sleep.async 5 `x def")
+    (tmp_path / "selfmod.nu").write_text("`std::Time import 0.05 Time::sleep.async `selfmod import 6 `y def")
+    before = modules.info()
+    interps = [Interpreter() for _ in range(3)]
+    async def main():
+        await asyncio.gather(*[interp.eval_async("`slowmod import slowmod::x `selfmod import selfmod::y")
+                               for interp in interps])
+    asyncio.run(main())
+    # Each gets the module once it has run, and it only runs once
+    assert [[t.val for t in interp.stack._stack] for interp in interps] == [[5, 6]] * 3
+    assert modules.info()["misses"] - before["misses"] == 2
+    assert not modules.loading
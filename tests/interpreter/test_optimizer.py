@@ -0,0 +1,83 @@
+from nustack.optimizer import optimize, defined_names, stack_effect
+from nustack.tokenize import tokenize, Token
+from nustack.interpreter import Interpreter
+from nustack.stdlib import builtins
+from nustack.utils import StdoutCapture
+import os.path
+
+def opt(code, env=None):
+    return optimize(tokenize(code), env)
+
+def test_stack_effect():
+    assert stack_effect(builtins.plus) == (2, 1)
+    assert stack_effect(builtins.not_) == (1, 1)
+    assert stack_effect(builtins.try_) is None
+
+def test_fold():
+    assert opt("2 3 +") == [Token("lit_int", 5)]
+    assert opt("2 3 + 4 *") == [Token("lit_int", 20)]
+    assert opt("1 2 < not") == [Token("lit_bool", False)]
+    assert opt('"spam" " and eggs" +') == [Token("lit_string", "spam and eggs")]
+    assert opt("x 1 +") == tokenize("x 1 +")
+    # Errors are left for when the program runs
+    assert opt("1 0 /") == tokenize("1 0 /")
+
+def test_noops():
+    assert opt("1 2 swap swap") == tokenize("1 2")
+    assert opt("1 dup drop") == tokenize("1")
+    assert opt("1 2 swap dup drop swap") == tokenize("1 2")
+
+def test_if():
+    assert opt("#t {1 2 +} {3} if show") == tokenize("3 show")
+    assert opt("1 2 > {1} {2 3 * 1 swap swap} if") == tokenize("6 1")
+    assert opt("x {1} {2} if") == tokenize("x {1} {2} if")
+
+def test_nested_code():
+    assert opt("{ 2 3 + }") == [Token("lit_code", [Token("lit_int", 5)])]
+
+def test_redefined():
+    assert defined_names(tokenize("{ 1 } `one def { 2 } 'two' define")) == {"one", "two"}
+    assert defined_names(tokenize("`a 'b' swap def")) is None
+    assert opt("2 3 + { - } `+ def") == tokenize("2 3 + { - } `+ def")
+    assert opt("{ swap } `swap def 1 2 swap swap") == tokenize("{ swap } `swap def 1 2 swap swap")
+    # Nothing is folded if we can't tell what is defined
+    assert opt("'x' to.symbol `n def 1 n def 2 3 +") == tokenize("'x' to.symbol `n def 1 n def 2 3 +")
+
+def test_redefined_dynamically():
+    # def reached through lookup or call can define anything
+    prog = "{ - } `+ `def lookup call 2 3 +"
+    assert defined_names(tokenize(prog)) is None
+    assert opt(prog) == tokenize(prog)
+    assert defined_names(tokenize("`def `d def { - } `+ d lookup call")) is None
+    # A name that is worked out when the program runs could be anything
+    prog = '{ drop drop 42 } "+" "de" "f" + lookup call 1 2 +'
+    assert defined_names(tokenize(prog)) is None
+    assert opt(prog) == tokenize(prog)
+    assert defined_names(tokenize("{ - } `+ f call")) is None
+    assert defined_names(tokenize("`x lookup { 1 } call")) == set()
+    # memo replaces the word it is given the symbol of
+    assert defined_names(tokenize("`+ 2 memo `- 2 10 memo.sized { 1 } 0 memo")) == {"+", "-"}
+    assert opt("`+ 2 memo 2 3 +") == tokenize("`+ 2 memo 2 3 +")
+    assert defined_names(tokenize("x 1 memo")) is None
+    for prog, result in [("{ - } `+ `def lookup call 2 3 +", -1),
+                         ('{ drop drop 42 } "+" "de" "f" + lookup call 1 2 +', 42)]:
+        env = Interpreter(optimize=True)
+        env.run(prog)
+        assert env.stack.pop().val == result
+
+def test_imports():
+    interp = Interpreter()
+    interp.file = os.path.abspath("examples/importing/p1.nu")
+    assert {"p2", "Time", "spam"} <= defined_names(tokenize("`p2 import"), interp)
+    assert "nth" in defined_names(tokenize("`Seq import*"), interp)
+    assert defined_names(tokenize("`NoSuchModule import"), interp) is None
+    assert opt("`Seq imp* 2 3 +", interp) == tokenize("`Seq imp* 5")
+
+def test_run_optimized():
+    with open("examples/fizzbuzz.nu") as f:
+        prog = f.read()
+    with StdoutCapture() as plain:
+        Interpreter().run(prog)
+    with StdoutCapture() as optimized:
+        Interpreter(optimize=True).run(prog)
+    assert plain.getvalue() == optimized.getvalue()
@@ -0,0 +1,16 @@
+from nustack.interpreter import Interpreter
+
+def test_map_parallel():
+    interp = Interpreter()
+    interp.eval("{ dup * } `square def 3 `offset def")
+    interp.eval("[ 1 2 3 4 5 6 7 ] { square offset + } 2 2 map.parallel.with")
+    assert [t.val for t in interp.stack.pop().val] == [4, 7, 12, 19, 28, 39, 52]
+    interp.eval("[ `a `bb ] { } map.parallel [ ] { } map.parallel")
+    assert interp.stack.pop().val == []
+    assert [t.val for t in interp.stack.pop().val] == ["a", "bb"]
+
+def test_filter_parallel():
+    interp = Interpreter()
+    interp.eval("`std::Seq import [ 1 2 3 4 5 6 7 8 ] { 2 % 0 eq } 3 0 filter.parallel.with [ [ 1 ] [ ] [ 2 3 ] ] { Seq::len 0 gt } filter.parallel")
+    assert [[t.val for t in l.val] for l in interp.stack.pop().val] == [[1], [2, 3]]
+    assert [t.val for t in interp.stack.pop().val] == [2, 4, 6, 8]
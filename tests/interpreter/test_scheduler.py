@@ -0,0 +1,61 @@
+import pytest
+from nustack.interpreter import Interpreter, BudgetExceededError
+from nustack.scheduler import Scheduler
+from nustack.extensionbase import Module
+
+module = Module("test")
+
+@module.register("nested")
+def nested(env):
+    "Runs a code object in a _run of its own, as an extension module might"
+    env.eval(env.stack.pop().val)
+
+def test_budget():
+    interp = Interpreter(budget=10000)
+    with pytest.raises(BudgetExceededError):
+        interp.eval("{ { } forever } [ [ `Exception { } ] ] try")
+    assert 10000 <= interp.instructions < 10100
+    assert len(interp.scope._scopes) == 1
+    interp = Interpreter(budget=10000, native=True)
+    with pytest.raises(BudgetExceededError):
+        interp.eval("{ 1 + } `inc def 0 { dup -1 gt } { inc } while")
+
+def test_nested_budget():
+    # Code run in a _run of its own counts against the same budget, however deep it is
+    loop = "0 { dup 1000 lt } { 1 + } while drop"
+    for code in ["%s { { } forever } nested" % loop, "%s { %s { { } forever } nested } nested" % (loop, loop)]:
+        interp = Interpreter(budget=10000)
+        interp.scope.assign("nested", nested)
+        with pytest.raises(BudgetExceededError):
+            interp.eval(code)
+        assert 10000 <= interp.instructions < 10100
+
+def test_nested_slice():
+    interp = Interpreter(budget=100000)
+    interp.scope.assign("nested", nested)
+    interp.start("{ 0 { dup 1000 lt } { 1 + } while } nested { 1 } call")
+    assert not interp.step(100)
+    # The slice ended while nested was running its code, so the rest of it counts against the slice
+    assert interp.instructions > 1000
+    assert interp.step(100)
+    assert interp.stack.pop().val == 1
+
+def test_counters():
+    interp = Interpreter()
+    interp.eval("{ dup 1 + } `f def 1 f f")
+    assert interp.instructions > 0
+    assert interp.walltime > 0
+
+def test_scheduler():
+    sched = Scheduler(slice=100)
+    runaway, counter = Interpreter(budget=50000), Interpreter()
+    sched.add(runaway, "{ } forever")
+    sched.add(counter, "0 `n def { n 1000 lt } { n 1 + `n def } while n")
+    failing = Interpreter()
+    sched.add(failing, "1 0 /")
+    finished = sched.run()
+    # The runaway program doesn't hold up the others
+    assert [interp for (interp, _) in finished] == [failing, counter, runaway]
+    assert type(finished[0][1]) is ZeroDivisionError
+    assert counter.stack.pop().val == 1000
+    assert type(finished[2][1]) is BudgetExceededError
@@ -0,0 +1,22 @@
+from nustack.interpreter import Interpreter
+
+SETUP = "`std::Seq import `std::Hash import { 1 + } `inc def [ 1 2 ] `items def 42"
+
+def test_spawn():
+    base = Interpreter()
+    base.eval(SETUP)
+    snap = base.snapshot()
+    interp = snap.spawn()
+    stack, scope = interp.run("inc items 3 Seq::append drop items Seq::len")
+    assert [t.val for t in stack._stack] == [43, 3]
+    # Definitions are shared, but values that can be changed in place are not
+    assert scope.lookup("inc") is base.scope.lookup("inc")
+    assert [t.val for t in base.scope.lookup("items").val] == [1, 2]
+    assert snap.spawn().run("items Seq::len")[0].pop().val == 2
+
+def test_rerun():
+    interp = Interpreter().snapshot().spawn(["job", "a"])
+    assert interp.argv[1].val == "a"
+    interp.run("1 `x def")
+    _, scope = interp.run("2")
+    assert scope.find("x") is None
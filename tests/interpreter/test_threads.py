@@ -0,0 +1,35 @@
+import io, sys, threading
+from nustack.interpreter import Interpreter
+from nustack import utils
+
+def test_break_per_interpreter():
+    breaker, counter = Interpreter(), Interpreter()
+    switch = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [
+            threading.Thread(target=breaker.eval, args=("{ { break } forever } 2000 repeat.n",)),
+            threading.Thread(target=counter.eval, args=("0 `n def { n 20000 lt } { n 1 + `n def } while n",)),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch)
+    # A break in the other thread must never end this loop early
+    assert counter.stack.pop().val == 20000
+    assert len(breaker.stack) == 0
+
+def test_logging_per_interpreter():
+    out = io.StringIO()
+    interp = Interpreter()
+    interp.config_logging(True, out)
+    def run():
+        interp.run("1 2 +")
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert "DEBUG LOG:" in out.getvalue()
+    assert utils.log_config["on"] is False
+    assert utils.current_log_config.get() is None
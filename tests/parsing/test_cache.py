@@ -0,0 +1,66 @@
+from nustack import cache, tokenize
+from nustack.tokenize import Token
+import os
+import pytest
+
+prog = '"spam" show { 1 [ 2 3 ] } `code def'
+
+def test_load_tokens(tmp_path):
+    src = tmp_path / "prog.nu"
+    src.write_text(prog)
+    toks = cache.load_tokens(str(src))
+    assert toks == tokenize.tokenize(prog)
+    assert os.path.exists(cache.cachepath(str(src)))
+    assert os.path.dirname(cache.cachepath(str(src))) == str(tmp_path / "__nucache__")
+    assert cache.read(str(src)) == toks
+
+def test_stale_entry(tmp_path):
+    src = tmp_path / "prog.nu"
+    src.write_text(prog)
+    cache.load_tokens(str(src))
+    src.write_text('"eggs" show')
+    assert cache.read(str(src)) is None
+    assert cache.load_tokens(str(src)) == [Token("lit_string", "eggs"), Token("call", "show")]
+
+def test_iter_tokens(tmp_path):
+    src = tmp_path / "prog.nu"
+    src.write_text(prog)
+    toks = list(cache.iter_tokens(str(src)))
+    assert toks == tokenize.tokenize(prog)
+    assert cache.read(str(src)) == toks
+    assert list(cache.iter_tokens(str(src))) == toks
+
+def test_iter_tokens_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CHUNKSIZE", 2)
+    src = tmp_path / "prog.nu"
+    src.write_text(prog)
+    toks = list(cache.iter_tokens(str(src)))
+    assert cache.read(str(src)) == toks
+    assert list(cache.iter_tokens(str(src))) == toks
+
+def test_iter_tokens_stopped(tmp_path):
+    src = tmp_path / "prog.nu"
+    src.write_text(prog)
+    # A program that stops early still gets the whole file cached
+    gen = cache.iter_tokens(str(src))
+    assert next(gen) == Token("lit_string", "spam")
+    gen.close()
+    assert cache.read(str(src)) == tokenize.tokenize(prog)
+    assert os.listdir(str(tmp_path / "__nucache__")) == [os.path.basename(cache.cachepath(str(src)))]
+
+def test_iter_tokens_error(tmp_path):
+    src = tmp_path / "bad.nu"
+    src.write_text('1 2 "unclosed')
+    gen = cache.iter_tokens(str(src))
+    with pytest.raises(tokenize.TokenizeError):
+        list(gen)
+    assert cache.read(str(src)) is None
+    assert os.listdir(str(tmp_path / "__nucache__")) == []
+
+def test_disabled(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "enabled", False)
+    src = tmp_path / "prog.nu"
+    src.write_text(prog)
+    assert cache.load_tokens(str(src)) == tokenize.tokenize(prog)
+    assert list(cache.iter_tokens(str(src))) == tokenize.tokenize(prog)
+    assert not os.path.exists(str(tmp_path / "__nucache__"))
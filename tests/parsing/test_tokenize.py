@@ -62,6 +62,16 @@ class Test_Token():
         else:
             assert type(h) == int
 
+    def test_hashkey(self):
+        assert hash(Token("lit_int", 1)) == hash(Token("lit_float", 1.0))
+        l = Token("lit_list", [Token("lit_int", 1)])
+        key = hashkey(l)
+        assert key == hashkey(Token("lit_list", [Token("lit_float", 1.0)]))
+        l.val.append(Token("lit_int", 2))
+        assert key != hashkey(l)
+        with pytest.raises(TypeError):
+            hashkey(Token("lit_hash", {}))
+
     def test_detailstr(self):
         assert Token("lit_int", 5).detailstr() == "Token(type='lit_int', val=5)"
 
@@ -83,6 +93,22 @@ class Test_Token():
         assert t.get("fii") == Token("lit_string", "foo")
         assert t.get("spam") == [1, 2, 3]
 
+    def test_slots(self):
+        t = Token("lit_int", 5)
+        with pytest.raises(AttributeError):
+            t.spam = 1
+
+def test_shared_literals():
+    assert boolean(1) is TRUE and boolean([]) is FALSE
+    assert integer(7) is integer(7)
+    assert integer(1000) is not integer(1000)
+    assert integer(-5) == Token("lit_int", -5)
+    assert literal("lit_string", "") is EMPTY_STRING
+    assert literal("lit_int", 2.5).val == 2.5
+    assert literal("lit_int", True).type == "lit_int"
+    a, b, c = tokenize("#t 3 3")
+    assert a is TRUE and b is c
+
 def test_tokenize():
     expected = [
         Token("lit_string", "spam"),
@@ -129,3 +155,28 @@ def test_tokenize():
     /* The end */""" % (LEGAL_IDS, LEGAL_IDS)
     toks = tokenize(prog)
     assert toks == expected
+
+def test_tokenize_errors():
+    with pytest.raises(TokenizeError):
+        tokenize("1 2 }")
+    with pytest.raises(TokenizeError):
+        tokenize("1 ~ 'unterminated")
+
+def test_iter_tokens():
+    import io
+    prog = '"a long string" /* a comment */ 12 3.5 { 1 { 2 } } b"bytes" `sym // to the end'
+    expected = tokenize(prog)
+    for chunksize in (1, 2, 3, 7, 100):
+        assert list(iter_tokens(io.StringIO(prog), chunksize)) == expected
+
+def test_iter_tokens_is_lazy():
+    class Reader:
+        def __init__(self, chunks):
+            self.chunks = list(chunks)
+        def read(self, size):
+            return self.chunks.pop(0) if self.chunks else ""
+    r = Reader(["1 2 ", "3 ", "4"])
+    toks = iter_tokens(r)
+    assert next(toks) == Token("lit_int", 1)
+    assert r.chunks == ["3 ", "4"]
+    assert list(toks) == [Token("lit_int", 2), Token("lit_int", 3), Token("lit_int", 4)]